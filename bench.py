@@ -0,0 +1,479 @@
+"""
+Офлайн-бенчмарк бота: настоящие хэндлеры dp из main.py гоняются против фейкового
+Bot API и заглушки OpenAI на localhost — без сети и без реальных ключей.
+
+    python bench.py
+    python bench.py --updates 200 --concurrency 16 --oai-latency 800 --tg-latency 30
+    python bench.py --scenarios draft_cmd,on_cb:regen,scheduled_job
+    python bench.py --scenarios nl_draft_any --oai-error-rate 0.1 --oai-slow-rate 0.05
+    python bench.py --scenarios "" --moderation-terms 0,10000,100000
+
+Отчёт: апдейтов в секунду, p50/p99 задержки на апдейт по сценариям, сколько времени
+ушло в SQLite, и вызовы OpenAI / Bot API (из main.metrics). Отдельно — цена модерации
+одного сообщения (мкс) при растущем списке терминов.
+БД и картинки создаются во временном каталоге и удаляются после прогона.
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+ADMIN_ID = 1
+BOT_ID = 42
+CHANNEL_CHAT_ID = -1001000000001
+
+SAMPLE_POST = (
+    "💪 Спина скажет спасибо! В STAVFITNESS26 стартует новая группа «Здоровая спина»: "
+    "мягкая мобилизация, укрепление мышц кора и растяжка без перегрузки.\n\n"
+    "🧘 Подходит новичкам и тем, кто много сидит за компьютером. Занятия в небольших группах, "
+    "тренер следит за техникой каждого.\n\n"
+    "📍 ул. Пирогова 15/2, 3 этаж. Пробная тренировка — бесплатно по записи, пиши в Телеграм!\n\n"
+    "STAVFITNESS26 - твоё тело, твоё здоровье, твоя гармония\n"
+    "#пилатес #здороваяспина #ставрополь #тренировка"
+)
+
+_BODY, _TAIL = SAMPLE_POST.rsplit("\n\n", 1)
+
+
+def sample_post() -> str:
+    """SAMPLE_POST с перемешанными словами: тексты разные, и индекс похожих постов их не склеивает."""
+    words = _BODY.split()
+    random.shuffle(words)
+    return " ".join(words) + "\n\n" + _TAIL
+
+
+DEFAULT_SCENARIOS = [
+    "draft_cmd", "nl_draft_any", "on_cb:regen", "on_cb:image", "on_cb:approve", "plan_week", "scheduled_job",
+]
+
+
+def _jitter(ms: float) -> float:
+    return max(0.0, ms * random.uniform(0.8, 1.2)) / 1000
+
+
+# ---------- FAKE TELEGRAM ----------
+class FakeTelegram:
+    """Минимальный Bot API: отвечает правдоподобными объектами с заданной задержкой."""
+
+    def __init__(self, latency_ms: float):
+        self.latency_ms = latency_ms
+        self.calls: Counter = Counter()
+        self._seq = 1000
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    def _next_id(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def _message(self, chat_id: Any, **extra) -> Dict[str, Any]:
+        try:
+            chat = {"id": int(chat_id), "type": "private" if int(chat_id) > 0 else "channel"}
+        except (TypeError, ValueError):
+            chat = {"id": CHANNEL_CHAT_ID, "type": "channel", "title": str(chat_id)}
+        return {
+            "message_id": self._next_id(),
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "bench"},
+            **extra,
+        }
+
+    def _photo(self) -> List[Dict[str, Any]]:
+        n = self._next_id()
+        return [
+            {"file_id": f"thumb{n}", "file_unique_id": f"t{n}", "width": 90, "height": 120},
+            {"file_id": f"photo{n}", "file_unique_id": f"p{n}", "width": 960, "height": 1280},
+        ]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = await request.post()
+        await asyncio.sleep(_jitter(self.latency_ms))
+        chat_id = data.get("chat_id", ADMIN_ID)
+        if method == "getMe":
+            result: Any = {"id": BOT_ID, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=str(data.get("text", "")))
+        elif method == "sendPhoto":
+            result = self._message(chat_id, photo=self._photo(), caption=str(data.get("caption", "")))
+        elif method == "sendMediaGroup":
+            media = json.loads(data.get("media", "[]"))
+            result = [self._message(chat_id, photo=self._photo(), media_group_id="bench") for _ in media]
+        else:
+            # answerCallbackQuery, setMyCommands, deleteMessage, editMessageReplyMarkup, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+# ---------- FAKE OPENAI ----------
+class FakeOpenAI:
+    """
+    Заглушка OpenAI: chat (обычный, stream, JSON-пачка) и images с заданной задержкой.
+    error_rate — доля ответов 500, slow_rate — доля ответов в SLOW_FACTOR раз медленнее (хвост задержек),
+    dup_rate — доля постов, дословно повторяющих SAMPLE_POST (остальные — sample_post()).
+    """
+
+    SLOW_FACTOR = 10
+
+    def __init__(self, latency_ms: float, image_latency_ms: float, error_rate: float = 0.0, slow_rate: float = 0.0,
+                 dup_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.image_latency_ms = image_latency_ms
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.dup_rate = dup_rate
+        self.calls: Counter = Counter()
+        self.app = web.Application(client_max_size=16 * 1024 * 1024)
+        self.app.router.add_post("/v1/chat/completions", self.chat)
+        self.app.router.add_post("/v1/images/generations", self.images)
+        self._png_b64: Optional[str] = None
+
+    @staticmethod
+    def _usage(prompt: str, text: str) -> Dict[str, int]:
+        p, c = len(prompt) // 3, len(text) // 3
+        return {"prompt_tokens": p, "completion_tokens": c, "total_tokens": p + c}
+
+    def _post(self) -> str:
+        if random.random() < self.dup_rate:
+            self.calls["dup_posts"] += 1
+            return SAMPLE_POST
+        return sample_post()
+
+    def _fault(self) -> Tuple[Optional[web.Response], float]:
+        """(ответ-ошибка или None, во сколько раз замедлить этот ответ)."""
+        if random.random() < self.error_rate:
+            self.calls["errors"] += 1
+            return web.json_response({"error": {"message": "bench: injected failure", "type": "server_error"}},
+                                     status=500), 1.0
+        if random.random() < self.slow_rate:
+            self.calls["slow"] += 1
+            return None, self.SLOW_FACTOR
+        return None, 1.0
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        failed, slow = self._fault()
+        if failed is not None:
+            return failed
+        prompt = "".join(m["content"] for m in body["messages"])
+        if body.get("stream"):
+            self.calls["chat_stream"] += 1
+            return await self._stream(request, body, prompt, self._post(), slow)
+        if body.get("response_format", {}).get("type") == "json_object":
+            # пачка: количество постов берём из промпта, отвечаем дольше пропорционально
+            self.calls["chat_batch"] += 1
+            mt = re.search(r"\((\d+) шт\.\)", prompt)
+            n = int(mt.group(1)) if mt else 1
+            text = json.dumps({"posts": [{"n": i + 1, "kind": "post", "text": self._post()} for i in range(n)]},
+                              ensure_ascii=False)
+            await asyncio.sleep(_jitter(self.latency_ms) * max(1.0, n / 2) * slow)
+        else:
+            self.calls["chat"] += 1
+            text = self._post()
+            await asyncio.sleep(_jitter(self.latency_ms) * slow)
+        return web.json_response({
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", "bench"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": self._usage(prompt, text),
+        })
+
+    async def _stream(self, request: web.Request, body: Dict[str, Any], prompt: str, text: str,
+                      slow: float = 1.0) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        pieces = [text[i:i + 24] for i in range(0, len(text), 24)]
+        step = _jitter(self.latency_ms) / len(pieces)
+        # медленный ответ — это очередь на стороне API: первый кусок приходит с опозданием
+        await asyncio.sleep(_jitter(self.latency_ms) * (slow - 1))
+
+        def event(payload: Dict[str, Any]) -> bytes:
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+
+        base = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": body.get("model", "bench")}
+        try:
+            for piece in pieces:
+                await asyncio.sleep(step)
+                await resp.write(event({**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}))
+            await resp.write(event({**base, "choices": [], "usage": self._usage(prompt, text)}))
+            await resp.write(b"data: [DONE]\n\n")
+            await resp.write_eof()
+        except ConnectionResetError:
+            self.calls["chat_stream_aborted"] += 1  # клиент закрыл stream (проигравший дублирующий запрос)
+        return resp
+
+    def _png(self) -> str:
+        if self._png_b64 is None:
+            from PIL import Image
+            img = Image.linear_gradient("L").resize((1024, 1536)).convert("RGB")
+            buf = io.BytesIO()
+            img.save(buf, "PNG")
+            self._png_b64 = base64.b64encode(buf.getvalue()).decode()
+        return self._png_b64
+
+    async def images(self, request: web.Request) -> web.Response:
+        self.calls["images"] += 1
+        body = await request.json()
+        failed, slow = self._fault()
+        if failed is not None:
+            return failed
+        await asyncio.sleep(_jitter(self.image_latency_ms) * slow)
+        return web.json_response({"created": int(time.time()), "data": [{"b64_json": self._png()}] * body.get("n", 1)})
+
+
+async def _serve(app: web.Application) -> Tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+# ---------- UPDATES ----------
+class UpdateFactory:
+    def __init__(self):
+        self._seq = 0
+
+    def _next(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def _user(self) -> Dict[str, Any]:
+        return {"id": ADMIN_ID, "is_bot": False, "first_name": "Bench", "username": "bench_admin"}
+
+    def message(self, text: str) -> Dict[str, Any]:
+        n = self._next()
+        return {"update_id": n, "message": {
+            "message_id": n, "date": int(time.time()),
+            "chat": {"id": ADMIN_ID, "type": "private"}, "from": self._user(), "text": text,
+        }}
+
+    def callback(self, data: str) -> Dict[str, Any]:
+        n = self._next()
+        return {"update_id": n, "callback_query": {
+            "id": str(n), "from": self._user(), "chat_instance": "bench", "data": data,
+            "message": {
+                "message_id": n, "date": int(time.time()), "chat": {"id": ADMIN_ID, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "bench"}, "text": "draft",
+            },
+        }}
+
+
+def _pct(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _db_seconds(main) -> float:
+    return sum(h.sum for (name, _), h in main.metrics.hists.items() if name == "db")
+
+
+def _db_calls(main) -> int:
+    return sum(h.count for (name, _), h in main.metrics.hists.items() if name == "db")
+
+
+# ---------- RUN ----------
+async def run_scenario(main, factory: UpdateFactory, name: str, updates: int, concurrency: int) -> Dict[str, Any]:
+    from aiogram.types import Update
+
+    slots = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+    # кнопки несут id черновика: у каждого апдейта свой черновик, как у разных сообщений в чате
+    draft_ids = (await main.add_drafts([("offer", SAMPLE_POST, "здоровая спина")] * updates)
+                 if name.startswith("on_cb:") else [])
+    slot_ids: List[int] = []
+    if name == "scheduled_job":
+        # разные минуты — разные слоты (иначе повторный вызов ничего не делает); last_slot_at в прошлом —
+        # как после простоя: каждый вызов публикует свой последний наступивший слот
+        minutes = range(min(updates, 24 * 60))
+        await main.save_slots({f"{i // 60:02d}:{i % 60:02d}": main.ALL_DAYS for i in minutes})
+        db = await main.get_db()
+        await db.execute("UPDATE schedule_slots SET last_slot_at=''")
+        await db.commit()
+        slot_ids = [row[0] for row in await main.get_slots(1)]
+
+    async def one(i: int):
+        nonlocal errors
+        if name == "scheduled_job":
+            call = main.scheduled_job(slot_ids[i % len(slot_ids)])
+        else:
+            if name == "draft_cmd":
+                raw = factory.message(f"/draft kind=offer; extra=новая группа №{i}")
+            elif name == "nl_draft_any":
+                raw = factory.message(f"растяжка спины после офиса, вариант {i}")
+            elif name == "plan_week":
+                raw = factory.message("/plan_week")
+            elif name.startswith("on_cb:"):
+                raw = factory.callback(f"{name.split(':', 1)[1]}:{draft_ids[i]}")
+            else:
+                raise SystemExit(f"unknown scenario {name!r}")
+            call = main.dp.feed_update(main.bot, Update.model_validate(raw, context={"bot": main.bot}))
+        async with slots:
+            start = time.perf_counter()
+            try:
+                await call
+            except Exception as e:
+                errors += 1
+                logging.warning("%s #%s failed: %r", name, i, e)
+            latencies.append(time.perf_counter() - start)
+
+    db_before, db_calls_before = _db_seconds(main), _db_calls(main)
+    wall = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(updates)))
+    # хэндлер картинки только ставит фоновую задачу: p50/p99 — ответ на кнопку, ups — с готовыми вариантами
+    await asyncio.gather(*list(main._image_tasks.values()), return_exceptions=True)
+    wall = time.perf_counter() - wall
+    return {
+        "scenario": name,
+        "n": updates,
+        "errors": errors,
+        "ups": updates / wall if wall else 0.0,
+        "p50": _pct(latencies, 0.5) * 1000,
+        "p99": _pct(latencies, 0.99) * 1000,
+        "db_ms": (_db_seconds(main) - db_before) * 1000 / max(1, updates),
+        "db_calls": (_db_calls(main) - db_calls_before) / max(1, updates),
+    }
+
+
+def moderation_bench(main, term_counts: List[int], messages: int) -> List[Dict[str, Any]]:
+    """
+    Модератор со штатными терминами плюс N случайных (разных правил): сколько микросекунд уходит
+    на сообщение пачкой (check_many) и по одному (check). Тексты — посты и короткие темы вперемешку.
+    """
+    rnd = random.Random(7)
+    letters = "абвгдежзийклмнопрстуфхцчшщыэюя"
+    texts = [sample_post() if i % 2 else f"тема: растяжка №{i}, {rnd.choice(['себя', 'тебе', 'канал'])}"
+             for i in range(messages)]
+    rows = []
+    for n in term_counts:
+        extra = [rnd.choice(["", "=", "*"]) + "".join(rnd.choice(letters) for _ in range(rnd.randint(5, 9)))
+                 for _ in range(n)]
+        start = time.perf_counter()
+        moderator = main.Moderator(main.MODERATION_TERMS + tuple(extra), main.MODERATION_ALLOW)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        flagged = sum(1 for term in moderator.check_many(texts) if term)
+        batch = time.perf_counter() - start
+        start = time.perf_counter()
+        for text in texts:
+            moderator.check(text)
+        single = time.perf_counter() - start
+        rows.append({"terms": len(moderator.patterns), "states": len(moderator.goto), "build_ms": build * 1000,
+                     "batch_us": batch * 1e6 / messages, "single_us": single * 1e6 / messages, "flagged": flagged})
+    return rows
+
+
+async def bench(args) -> int:
+    tmp = tempfile.mkdtemp(prefix="stavfitness-bench-")
+    repo = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(tmp)  # fitness_bot.db создаётся в текущем каталоге
+
+    tg = FakeTelegram(args.tg_latency)
+    oai = FakeOpenAI(args.oai_latency, args.image_latency, args.oai_error_rate, args.oai_slow_rate, args.oai_dup_rate)
+    tg_runner, tg_url = await _serve(tg.app)
+    oai_runner, oai_url = await _serve(oai.app)
+    os.environ.update(
+        BOT_TOKEN="123456:BENCH",
+        OPENAI_API_KEY="sk-bench",
+        OPENAI_BASE_URL=f"{oai_url}/v1",
+        TELEGRAM_API_URL=tg_url,
+        CHANNEL_ID="@bench_channel",
+        ADMIN_IDS=str(ADMIN_ID),
+        IMAGES_DIR=os.path.join(tmp, "images"),
+        POOL_SIZE=str(args.pool_size),
+        OPENAI_MAX_CONCURRENCY=str(args.oai_concurrency),
+        STREAM_EDIT_INTERVAL="0.2",
+        METRICS_PORT="0",
+    )
+    sys.path.insert(0, repo)
+    import main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    await main.init_db()
+    main.setup_middlewares()
+    workers = [asyncio.create_task(main.outbox_worker()) for _ in range(max(1, main.OUTBOX_WORKERS))]
+    if args.pool_size > 0:
+        workers.append(asyncio.create_task(main.pool_refill_loop()))
+
+    results = []
+    try:
+        # LogUserIdMiddleware печатает каждый апдейт — в отчёт это не нужно
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for name in args.scenarios:
+                results.append(await run_scenario(main, UpdateFactory(), name, args.updates, args.concurrency))
+    finally:
+        for w in workers:
+            w.cancel()
+        await main.close_db()
+        await main.bot.session.close()
+        await tg_runner.cleanup()
+        await oai_runner.cleanup()
+        os.chdir(repo)
+        if not args.keep:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\nOpenAI latency {args.oai_latency:.0f} ms (images {args.image_latency:.0f} ms), "
+          f"Telegram latency {args.tg_latency:.0f} ms, {args.updates} updates x concurrency {args.concurrency}\n")
+    print(f"{'scenario':<16}{'upd/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'db ms/upd':>11}{'db calls':>10}{'errors':>8}")
+    for r in results:
+        print(f"{r['scenario']:<16}{r['ups']:>9.1f}{r['p50']:>10.1f}{r['p99']:>10.1f}"
+              f"{r['db_ms']:>11.2f}{r['db_calls']:>10.1f}{r['errors']:>8}")
+    print("\nOpenAI calls:", dict(oai.calls))
+    print("Bot API calls:", dict(tg.calls))
+    print("\n" + main.metrics.render_text())
+    if args.moderation_terms:
+        print(f"\nModeration, {args.moderation_messages} messages (~{len(SAMPLE_POST)} chars per post):\n")
+        print(f"{'terms':>8}{'states':>9}{'build ms':>10}{'us/msg batch':>14}{'us/msg one':>12}{'flagged':>9}")
+        for r in moderation_bench(main, args.moderation_terms, args.moderation_messages):
+            print(f"{r['terms']:>8}{r['states']:>9}{r['build_ms']:>10.1f}{r['batch_us']:>14.1f}"
+                  f"{r['single_us']:>12.1f}{r['flagged']:>9}")
+    return 1 if any(r["errors"] for r in results) else 0
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--updates", type=int, default=50, help="апдейтов на сценарий")
+    p.add_argument("--concurrency", type=int, default=8, help="сколько апдейтов обрабатывается одновременно")
+    p.add_argument("--oai-latency", type=float, default=300, help="задержка ответа OpenAI (текст), мс")
+    p.add_argument("--image-latency", type=float, default=1000, help="задержка генерации картинки, мс")
+    p.add_argument("--oai-error-rate", type=float, default=0.0, help="доля ответов OpenAI с ошибкой 500 (0..1)")
+    p.add_argument("--oai-slow-rate", type=float, default=0.0,
+                   help=f"доля ответов OpenAI в {FakeOpenAI.SLOW_FACTOR} раз медленнее обычного (0..1)")
+    p.add_argument("--oai-dup-rate", type=float, default=0.0,
+                   help="доля постов от OpenAI, дословно повторяющих образец (проверка похожих постов)")
+    p.add_argument("--tg-latency", type=float, default=20, help="задержка Bot API, мс")
+    p.add_argument("--oai-concurrency", type=int, default=8, help="OPENAI_MAX_CONCURRENCY для бота")
+    p.add_argument("--pool-size", type=int, default=0, help="POOL_SIZE тёплого пула (0 — выключен)")
+    p.add_argument("--scenarios", type=lambda s: [x.strip() for x in s.split(",") if x.strip()],
+                   default=DEFAULT_SCENARIOS, help="через запятую: " + ",".join(DEFAULT_SCENARIOS))
+    p.add_argument("--moderation-terms", type=lambda s: [int(x) for x in s.split(",") if x.strip()],
+                   default=[0, 1000, 10000, 50000], help="сколько случайных терминов добавить к модератору, через запятую "
+                   "(пусто — не мерить)")
+    p.add_argument("--moderation-messages", type=int, default=2000, help="сообщений на замер модерации")
+    p.add_argument("--keep", action="store_true", help="не удалять временный каталог с БД")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(bench(parse_args())))
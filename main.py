@@ -1,39 +1,183 @@
-import asyncio, re, json, io, textwrap
-from datetime import datetime, time, timedelta
-from typing import Optional, Dict, Any, Tuple, List
+from time import monotonic as time_monotonic
+_PROCESS_STARTED = time_monotonic()  # отсюда считаем холодный старт (импорты → первый апдейт)
+
+import asyncio, re, json, io, textwrap, hashlib, uuid, bisect, functools, html, socket, signal, sys, random, zlib
+import unicodedata
+import array
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Tuple, List, Callable, Awaitable, TypeVar, TYPE_CHECKING
 
 import aiosqlite
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
-    BufferedInputFile,
-    ReplyKeyboardMarkup, KeyboardButton, BotCommand,
+    FSInputFile, InputMediaPhoto,
+    ReplyKeyboardMarkup, KeyboardButton, BotCommand, ErrorEvent,
 )
-from aiogram.filters import Command, CommandObject
+from aiogram.filters import Command, CommandObject, ExceptionTypeFilter
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramForbiddenError
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums.parse_mode import ParseMode
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from dotenv import load_dotenv
 
+# Pillow, aiohttp.web и multiprocessing нужны не на каждом запуске — импортируем их там, где используем
+if TYPE_CHECKING:
+    from aiohttp import web
+
 import os
 import inspect
 import logging
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
 
-# ---------- SAFETY GUARD (NSFW filter for drafts) ----------
-NSFW_REGEX = re.compile(r"(пизд|хуй|еб|минет|секс|порно|вагин|пенис|оральн|анал|сосать|куннилинг|феллаци|эрот|нюд)", re.IGNORECASE)
+# ---------- MODERATION (NSFW filter for themes and generated posts) ----------
+# Текст нормализуем (регистр, латинские двойники букв, цифры-буквы, разделители внутри слова и
+# «х у й» по буквам, повторы букв), потом один проход автомата Ахо — Корасик по всем терминам сразу:
+# цена сообщения растёт с его длиной (сотни мкс на пост), но не с длиной списка терминов. Правила термина:
+#   «корень» — слово начинается с него (еб → «ебать», но не «себя»/«тебе»)
+#   «=слово» — только целое слово (анал → не «канал», не «анализ»)
+#   «*корень» — где угодно внутри слова (пизд → «распизд…»)
+# Исключения (MODERATION_ALLOW) — в той же записи: совпадение внутри них не считается.
+MODERATION_TERMS = (
+    "*пизд", "*хуй", "хуе", "хуя", "еб", "заеб", "выеб", "наеб", "поеб", "проеб", "уеб", "доеб", "съеб",
+    "въеб", "отъеб", "разъеб", "минет", "секс", "порн", "вагин", "пенис", "оральн", "=анал", "анальн",
+    "сосать", "отсос", "куннилинг", "феллаци", "эрот", "нюд",
+    "porn", "sex", "fuck", "nude", "=anal", "blowjob",
+)
+MODERATION_ALLOW = ("*страхуй", "нюдов", "ебонит", "секстант", "секстет", "sextant", "sextet", "sexton")
+
+# Двойники и невидимые символы меняем regex-ом с заменой только найденного: в русском тексте их
+# единицы, а str.translate со словарём платит поиск по таблице за каждый символ
+_HOMOGLYPHS = {
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м", "n": "п", "o": "о", "p": "р",
+    "r": "г", "t": "т", "u": "и", "x": "х", "y": "у", "ё": "е",
+    "0": "о", "3": "з", "4": "ч", "6": "б", "@": "а", "$": "с",
+}
+_HOMOGLYPH_RE = re.compile(r"[abcehkmnoprtuxyё0346@$\u00ad\u200b-\u200d\u2060\ufeff\u0300-\u036f]")
+_SEP = r"[\s*._\-|/\\~'`\"+]+"
+_INWORD_SEP_RE = re.compile(r"\b[*._\-|/\\~'`\"+]+\b")  # «х*уй», «е-б-а-т-ь»: без пробелов
+_SPELLED_RE = re.compile(rf"\b\w(?:{_SEP}\w\b){{2,}}")  # «х у й», «х.у.й»: от трёх букв
+_SEP_RE = re.compile(_SEP)
+_REPEAT_RE = re.compile(r"(?<=(.))\1+")
+
+def _homoglyph(m: re.Match) -> str:
+    return _HOMOGLYPHS.get(m.group(), "")  # невидимые символы и комбинируемые знаки — убираем
+
+def _spelled(m: re.Match) -> str:
+    # «в с е к с»: первая буква может быть предлогом — добавляем и склейку без неё (и без двух)
+    run = _SEP_RE.sub("", m.group())
+    return " ".join(run[i:] for i in range(min(3, len(run) - 2)))
+
+def normalize_for_moderation(text: str) -> str:
+    """Каноническая форма для матчинга (в пост не попадает): те же шаги применяются и к терминам."""
+    s = (text or "").lower()
+    if not unicodedata.is_normalized("NFKC", s):
+        s = unicodedata.normalize("NFKC", s).lower()
+    s = _HOMOGLYPH_RE.sub(_homoglyph, s)
+    s = _SPELLED_RE.sub(_spelled, s)
+    s = _INWORD_SEP_RE.sub("", s)
+    return _REPEAT_RE.sub("", s)
+
+class Moderator:
+    """Скомпилированный словарь: автомат Ахо — Корасик (goto/fail/выходы) над нормализованными терминами."""
+
+    def __init__(self, terms, allow=()):
+        self.patterns: List[Tuple[int, str, bool, str]] = []  # (длина, правило '', '=' или '*', разрешающий?, термин)
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[Tuple[int, ...]] = [()]
+        for raw, allowed in [(t, False) for t in terms] + [(t, True) for t in allow]:
+            rule = raw[0] if raw[:1] in ("=", "*") else ""
+            key = normalize_for_moderation(raw[len(rule):])
+            if not key:
+                continue
+            state = 0
+            for ch in key:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = self.goto[state][ch] = len(self.goto)
+                    self.goto.append({}); self.fail.append(0); self.out.append(())
+                state = nxt
+            self.out[state] += (len(self.patterns),)
+            self.patterns.append((len(key), rule, allowed, raw[len(rule):]))
+        # fail-ссылки обходом в ширину; выходы суффиксов копируем в состояние, чтобы не ходить по цепочке
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] += self.out[self.fail[nxt]]
+                queue.append(nxt)
+
+    def check_many(self, texts: List[str]) -> List[Optional[str]]:
+        """
+        Пачка текстов одним проходом автомата (тексты склеены через перевод строки — он граница слова).
+        По элементу на текст: первый найденный запрещённый термин или None.
+        """
+        norm = [normalize_for_moderation(t) for t in texts]
+        starts, pos = [], 0
+        for s in norm:
+            starts.append(pos)
+            pos += len(s) + 1
+        joined = "\n".join(norm)
+        goto, fail, out, patterns = self.goto, self.fail, self.out, self.patterns
+        hits: List[Tuple[int, int, int]] = []  # (начало, конец, шаблон)
+        state = 0
+        for i, ch in enumerate(joined):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                for pid in out[state]:
+                    length, rule, _, _ = patterns[pid]
+                    start = i - length + 1
+                    if rule != "*" and start and joined[start - 1].isalnum():
+                        continue  # не с начала слова
+                    if rule == "=" and i + 1 < len(joined) and joined[i + 1].isalnum():
+                        continue  # не конец слова
+                    hits.append((start, i + 1, pid))
+        result: List[Optional[str]] = [None] * len(texts)
+        allowed = [(a, b) for a, b, pid in hits if patterns[pid][2]]
+        for a, b, pid in hits:
+            if patterns[pid][2] or any(x <= a and b <= y for x, y in allowed):
+                continue
+            idx = bisect.bisect_right(starts, a) - 1
+            if result[idx] is None:
+                result[idx] = patterns[pid][3]
+        return result
+
+    def check(self, text: str) -> Optional[str]:
+        return self.check_many([text])[0]
+
+moderator = Moderator(MODERATION_TERMS, MODERATION_ALLOW)
+
+def moderate_many(texts: List[str]) -> List[Optional[str]]:
+    """Пачка тем и/или сгенерированных постов за один проход: по элементу на текст — термин или None."""
+    return moderator.check_many(texts)
 
 def is_nsfw(text: str) -> bool:
-    return bool(NSFW_REGEX.search(text or ""))
+    return moderator.check(text) is not None
 
 # ---------- CONFIG ----------
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
+# Один пост можно публиковать в несколько каналов: CHANNEL_ID=@main,@second,-100123...
+# Это каналы первой студии (tenant 1); остальные студии заводятся командой /tenant
+CHANNEL_IDS = [c.strip() for c in (CHANNEL_ID or "").split(",") if c.strip()]
 
 def _parse_admin_ids() -> set[int]:
     raw = os.getenv("ADMIN_IDS")
@@ -50,40 +194,350 @@ def _parse_admin_ids() -> set[int]:
         return {int(single)}
     return set()
 
+# Админы первой студии и суперадмины: только они управляют студиями через /tenant
 ADMIN_IDS = _parse_admin_ids()
 
-# OpenAI client
-from openai import OpenAI, PermissionDeniedError
+# Лимиты генерации: таймауты (сек) на одну попытку и сколько запросов к OpenAI держим одновременно
+OPENAI_TEXT_TIMEOUT = float(os.getenv("OPENAI_TEXT_TIMEOUT", "60"))
+OPENAI_IMAGE_TIMEOUT = float(os.getenv("OPENAI_IMAGE_TIMEOUT", "120"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "4"))
+# Сбои OpenAI: дедлайн на весь вызов вместе с повторами (сек), число повторов и пауза между ними
+# (экспонента от BASE до MAX с джиттером), после скольких сбоев подряд предохранитель перестаёт
+# слать запросы и на сколько секунд. Интерактивный текст дублируем, если ответа нет дольше
+# квантиля OPENAI_HEDGE_QUANTILE недавних вызовов (0 — не дублировать)
+OPENAI_TEXT_DEADLINE = float(os.getenv("OPENAI_TEXT_DEADLINE", "90"))
+OPENAI_IMAGE_DEADLINE = float(os.getenv("OPENAI_IMAGE_DEADLINE", "240"))
+OPENAI_RETRIES = int(os.getenv("OPENAI_RETRIES", "2"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "8"))
+OPENAI_BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+OPENAI_HEDGE_QUANTILE = float(os.getenv("OPENAI_HEDGE_QUANTILE", "0.95"))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "20"))
+# /plan_week: сколько черновиков генерим параллельно и максимальная длина плана в днях
+PLAN_CONCURRENCY = int(os.getenv("PLAN_CONCURRENCY", str(OPENAI_MAX_CONCURRENCY)))
+PLAN_MAX_DAYS = int(os.getenv("PLAN_MAX_DAYS", "31"))
+# Сколько постов просим у модели одним запросом (1 — по запросу на пост). Пачки маленькие, чтобы
+# неделя шла несколькими параллельными запросами и первый черновик приходил, не дожидаясь всех семи
+PLAN_BATCH_SIZE = int(os.getenv("PLAN_BATCH_SIZE", "2"))
+# Похожие посты: порог сходства (доля общих фраз из 3 слов, 0..1), за сколько дней истории сравниваем
+# и сколько раз перегенерировать слишком похожий текст там, где админ его не видит (автопост, пул)
+DUP_THRESHOLD = float(os.getenv("DUP_THRESHOLD", "0.5"))
+DUP_HISTORY_DAYS = int(os.getenv("DUP_HISTORY_DAYS", "90"))
+DUP_REGEN_ATTEMPTS = int(os.getenv("DUP_REGEN_ATTEMPTS", "2"))
+# Хранение черновиков, по типам: "tip:14,offer:60,*:30" (* — остальные типы, 0 — без ограничения).
+# DRAFT_MAX_AGE_DAYS — сколько дней черновик живёт в drafts, DRAFT_MAX_PER_KIND — сколько последних
+# черновиков типа там держим; лишние уезжают в сжатый drafts_archive (их видно в /history).
+# Отправленные записи outbox и старые расписания живут OUTBOX_RETENTION_DAYS, варианты картинок —
+# IMAGE_JOB_TTL_HOURS. Уборку делает лидер раз в RETENTION_INTERVAL_HOURS
+def _parse_kind_limits(raw: str) -> Dict[str, float]:
+    limits = {}
+    for part in raw.split(","):
+        kind, _, value = part.strip().rpartition(":")
+        try:
+            limits[kind.strip() or "*"] = float(value)
+        except ValueError:
+            continue
+    return limits
+
+DRAFT_MAX_AGE_DAYS = _parse_kind_limits(os.getenv("DRAFT_MAX_AGE_DAYS", "*:30"))
+DRAFT_MAX_PER_KIND = _parse_kind_limits(os.getenv("DRAFT_MAX_PER_KIND", "*:500"))
+OUTBOX_RETENTION_DAYS = float(os.getenv("OUTBOX_RETENTION_DAYS", "30"))
+IMAGE_JOB_TTL_HOURS = float(os.getenv("IMAGE_JOB_TTL_HOURS", "24"))
+RETENTION_INTERVAL_HOURS = float(os.getenv("RETENTION_INTERVAL_HOURS", "6"))
+# Автопост: за сколько минут до публикации готовим текст и нужна ли картинка
+SCHEDULE_LEAD_MINUTES = int(os.getenv("SCHEDULE_LEAD_MINUTES", "20"))
+# Слот, пропущенный из-за простоя, публикуем, если опоздали не больше чем на столько минут
+# (из нескольких пропущенных подряд — только последний); иначе пропускаем и пишем админам
+SCHEDULE_MISFIRE_GRACE_MIN = int(os.getenv("SCHEDULE_MISFIRE_GRACE_MIN", "120"))
+SCHEDULE_WITH_IMAGE = os.getenv("SCHEDULE_WITH_IMAGE", "0") in ("1", "true", "yes")
+# Очередь публикаций: число воркеров, попыток и лимиты Telegram
+# (общий — сообщений в секунду, на один чат — в минуту)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+TG_GLOBAL_PER_SEC = float(os.getenv("TG_GLOBAL_PER_SEC", "25"))
+TG_CHAT_PER_MIN = float(os.getenv("TG_CHAT_PER_MIN", "20"))
+# Кэш генераций: сколько ответов хранить (0 — выключен) и сколько часов они живут
+GEN_CACHE_SIZE = int(os.getenv("GEN_CACHE_SIZE", "500"))
+GEN_CACHE_TTL_HOURS = float(os.getenv("GEN_CACHE_TTL_HOURS", "6"))
+# Prometheus-эндпоинт с метриками (0 — выключен); по умолчанию слушаем только localhost
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Потоковый показ черновика: включён ли и как часто (сек) редактируем сообщение
+STREAM_DRAFTS = os.getenv("STREAM_DRAFTS", "1") not in ("0", "false", "no")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+# Тёплый пул черновиков: какие типы держим наготове, сколько штук на тип (0 — выключено)
+# и сколько часов черновик считается свежим
+POOL_KINDS = [k.strip() for k in os.getenv("POOL_KINDS", "offer,tip,motivation").split(",") if k.strip()]
+POOL_SIZE = int(os.getenv("POOL_SIZE", "2"))
+POOL_TTL_HOURS = float(os.getenv("POOL_TTL_HOURS", "24"))
+# Webhook вместо long polling: публичный адрес (пусто — polling), путь, секрет и где слушать.
+# WEB_WORKERS процессов делят один порт (SO_REUSEPORT) и одну базу SQLite
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+WORKER_PROCESSES = max(1, WEB_WORKERS) if WEBHOOK_URL else 1
+# Лидер (планировщик и тёплый пул) держит аренду в SQLite столько секунд и продлевает её втрое чаще;
+# при нескольких процессах профили и студии перечитываем из базы не реже раза в PROFILE_CACHE_TTL секунд
+LEADER_LEASE_SEC = float(os.getenv("LEADER_LEASE_SEC", "30"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "30"))
+# «✏️ Править» ждёт новый текст столько минут; позже сообщение админа — уже обычная тема черновика
+PENDING_INPUT_TTL_MIN = float(os.getenv("PENDING_INPUT_TTL_MIN", "10"))
 
 # Проверяем обязательные переменные окружения
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY не найден. Заполни .env с OPENAI_API_KEY=sk-...")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN не найден. Заполни .env с BOT_TOKEN=...")
-if not CHANNEL_ID:
+if not CHANNEL_IDS:
     raise RuntimeError("CHANNEL_ID не найден. Укажи @username канала или числовой ID, и сделай бота админом.")
 if not ADMIN_IDS:
     raise RuntimeError("ADMIN_IDS/ADMIN_ID не задан(ы). Укажи в .env ADMIN_IDS=123,456")
 
-# Инициализация клиента OpenAI по новому SDK (ключ возьмётся из окружения)
-oai = OpenAI()
-
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+# Клиент OpenAI по новому SDK (ключ возьмётся из окружения) создаём при первом запросе:
+# импорт SDK — заметная часть холодного старта, а до первой генерации он не нужен.
+# Асинхронный клиент не блокирует event loop aiogram, пока идёт генерация.
+# Повторы делает openai_call (с общим дедлайном и предохранителем), поэтому свои ретраи SDK выключены.
+_oai = None
+
+def get_oai():
+    global _oai
+    if _oai is None:
+        from openai import AsyncOpenAI
+        _oai = AsyncOpenAI(max_retries=0)
+    return _oai
+
+# Общий лимит одновременных запросов к OpenAI (текст + картинки)
+_oai_slots = asyncio.Semaphore(max(1, OPENAI_MAX_CONCURRENCY))
+
+# Свой сервер Bot API (локальный telegram-bot-api или фейковый из bench.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+bot = Bot(
+    BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+)
 dp = Dispatcher()
 scheduler = AsyncIOScheduler(timezone="Europe/Moscow")  # при желании поменяй
+# имя процесса в арендах (leases) и в outbox.claimed_by
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
 
 DB_PATH = "fitness_bot.db"
+# Каталог хранилища картинок черновиков (файлы по sha256)
+IMAGES_DIR = os.getenv("IMAGES_DIR", "images")
+# Постобработка картинок: длинная сторона для канала (Telegram всё равно ужимает фото до 1280),
+# качество JPEG и длинная сторона миниатюры
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1280"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_THUMB_SIDE = int(os.getenv("IMAGE_THUMB_SIDE", "320"))
+# Сколько вариантов картинки рисовать параллельно на одно нажатие (альбом Telegram — до 10)
+IMAGE_VARIANTS = max(1, min(10, int(os.getenv("IMAGE_VARIANTS", "3"))))
+# Размер page cache SQLite (КиБ) и кэша подготовленных выражений на коннект
+DB_CACHE_KIB = int(os.getenv("DB_CACHE_KIB", "16384"))
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+
+# ---------- METRICS ----------
+# Гистограммы времени и счётчики в памяти процесса: handler (хэндлеры aiogram), openai, db,
+# telegram (каждый вызов Bot API), job (фоновые задачи). Смотреть — /metrics в боте или METRICS_PORT в формате Prometheus.
+class Histogram:
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # верхняя граница корзины, в которую попал q-й квантиль
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else self.max
+        return self.max
+
+class Metrics:
+    def __init__(self):
+        self.hists: Dict[Tuple[str, str], Histogram] = {}
+        self.counters: Dict[Tuple[str, str], float] = {}
+        self.started = time_monotonic()
+
+    def observe(self, name: str, label: str, seconds: float):
+        key = (name, label)
+        if key not in self.hists:
+            self.hists[key] = Histogram()
+        self.hists[key].observe(seconds)
+
+    def inc(self, name: str, label: str = "", value: float = 1):
+        self.counters[(name, label)] = self.counters.get((name, label), 0) + value
+
+    @contextmanager
+    def timer(self, name: str, label: str):
+        start = time_monotonic()
+        try:
+            yield
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError):
+                self.inc("errors", f"{name}:{label}")
+            raise
+        finally:
+            self.observe(name, label, time_monotonic() - start)
+
+    def add_usage(self, usage):
+        if usage is not None:
+            self.inc("openai_tokens", "prompt", usage.prompt_tokens or 0)
+            self.inc("openai_tokens", "completion", usage.completion_tokens or 0)
+
+    def render_text(self) -> str:
+        lines = [f"uptime: {time_monotonic() - self.started:.0f} s"]
+        for (name, label), h in sorted(self.hists.items()):
+            lines.append(
+                f"{name} {label}: n={h.count} avg={h.sum / h.count * 1000:.0f}ms "
+                f"p50≤{h.quantile(0.5) * 1000:.0f} p95≤{h.quantile(0.95) * 1000:.0f} "
+                f"p99≤{h.quantile(0.99) * 1000:.0f} max={h.max * 1000:.0f}"
+            )
+        for (name, label), v in sorted(self.counters.items()):
+            lines.append(f"{name} {label}: {v:g}")
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        out = []
+        for name in sorted({n for n, _ in self.hists}):
+            out.append(f"# TYPE bot_{name}_seconds histogram")
+            for (n, label), h in sorted(self.hists.items()):
+                if n != name:
+                    continue
+                seen = 0
+                for le, c in zip(list(h.BUCKETS) + ["+Inf"], h.counts):
+                    seen += c
+                    out.append(f'bot_{name}_seconds_bucket{{label="{label}",le="{le}"}} {seen}')
+                out.append(f'bot_{name}_seconds_sum{{label="{label}"}} {h.sum}')
+                out.append(f'bot_{name}_seconds_count{{label="{label}"}} {h.count}')
+        for name in sorted({n for n, _ in self.counters}):
+            out.append(f"# TYPE bot_{name}_total counter")
+            for (n, label), v in sorted(self.counters.items()):
+                if n == name:
+                    out.append(f'bot_{name}_total{{label="{label}"}} {v}')
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+def timed(name: str, label: Optional[str] = None):
+    """Декоратор для async-функций: время вызова в гистограмму name (label — имя функции)."""
+    def deco(func):
+        lbl = label or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metrics.timer(name, lbl):
+                return await func(*args, **kwargs)
+        return wrapper
+    return deco
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время работы хэндлеров; для колбэков в метку добавляем кнопку (on_cb:approve)."""
+
+    async def __call__(self, handler, event, data):
+        h = data.get("handler")
+        label = getattr(getattr(h, "callback", None), "__name__", "unknown")
+        if isinstance(event, CallbackQuery) and event.data:
+            label = f"{label}:{event.data.split(':', 1)[0]}"
+        with metrics.timer("handler", label):
+            return await handler(event, data)
+
+class MetricsRequestMiddleware(BaseRequestMiddleware):
+    """Время каждого вызова Bot API по имени метода (SendPhoto, EditMessageText, …)."""
+
+    async def __call__(self, make_request, bot, method):
+        with metrics.timer("telegram", type(method).__name__):
+            return await make_request(bot, method)
+
+async def start_metrics_server(port: int = METRICS_PORT) -> Optional["web.AppRunner"]:
+    if not port:
+        return None
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logging.info("Metrics endpoint: http://%s:%s/metrics", METRICS_HOST, port)
+    return runner
 
 # ---------- DB ----------
+# автопосты, подготовленные заранее: slot_at — минута публикации (время планировщика);
+# таблицу создаёт migrate_db — старую (UNIQUE по одному slot_at) она пересобирает
+SCHEDULED_POSTS_SQL = """
+CREATE TABLE IF NOT EXISTS scheduled_posts (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  tenant_id INTEGER NOT NULL DEFAULT 1,
+  slot_at TEXT NOT NULL,            -- 'YYYY-MM-DDTHH:MM'
+  kind TEXT NOT NULL,
+  text TEXT,
+  image_ref TEXT,
+  status TEXT NOT NULL DEFAULT 'pending',  -- pending | ready | published | failed
+  attempts INTEGER NOT NULL DEFAULT 0,
+  error TEXT,
+  created_at TEXT NOT NULL,
+  UNIQUE (tenant_id, slot_at)
+)"""
+
+# Версия схемы (PRAGMA user_version): совпала — init_db пропускает CREATE/миграции/бэкфилл.
+# Поднимать при любом изменении CREATE_TABLES_SQL, TENANT_INDEXES или migrate_db.
+SCHEMA_VERSION = 2
+
 CREATE_TABLES_SQL = """
+-- студии (tenants): у каждой свой профиль, каналы, админы, черновики и автопост
+CREATE TABLE IF NOT EXISTS tenants (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name TEXT NOT NULL,
+  channel_ids TEXT NOT NULL DEFAULT '',   -- через запятую, как CHANNEL_ID
+  created_at TEXT NOT NULL
+);
+-- в какой студии админ работает сейчас (суперадмин переключается через /tenant use)
+CREATE TABLE IF NOT EXISTS tenant_admins (
+  user_id INTEGER PRIMARY KEY,
+  tenant_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tenant_admins_tenant ON tenant_admins(tenant_id);
 CREATE TABLE IF NOT EXISTS studio (
-  id INTEGER PRIMARY KEY CHECK (id=1),
+  tenant_id INTEGER PRIMARY KEY,
   profile_json TEXT NOT NULL
 );
 CREATE TABLE IF NOT EXISTS settings (
-  id INTEGER PRIMARY KEY CHECK (id=1),
-  daily_time TEXT    -- 'HH:MM'
+  tenant_id INTEGER PRIMARY KEY,
+  daily_time TEXT    -- 'HH:MM'; устарело — migrate_db переносит в schedule_slots
+);
+-- слоты автопоста: несколько в день, у каждого свои дни недели
+CREATE TABLE IF NOT EXISTS schedule_slots (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  tenant_id INTEGER NOT NULL,
+  hhmm TEXT NOT NULL,                       -- 'HH:MM' во времени планировщика
+  days TEXT NOT NULL DEFAULT '0123456',     -- дни недели, 0 — пн
+  last_slot_at TEXT NOT NULL,               -- последний отработанный (или пропущенный) слот 'YYYY-MM-DDTHH:MM'
+  UNIQUE (tenant_id, hhmm)
 );
+-- план типов постов по дням недели: i-й слот дня берёт i-й тип из kinds (по кругу)
+CREATE TABLE IF NOT EXISTS kind_plan (
+  tenant_id INTEGER NOT NULL,
+  weekday INTEGER NOT NULL,                 -- 0 — пн
+  kinds TEXT NOT NULL,                      -- 'offer,tip'
+  PRIMARY KEY (tenant_id, weekday)
+) WITHOUT ROWID;
 CREATE TABLE IF NOT EXISTS drafts (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   kind TEXT,          -- тип поста (offer, tip, schedule, review, motivation etc)
@@ -91,6 +545,98 @@ CREATE TABLE IF NOT EXISTS drafts (
   image_prompt TEXT,
   created_at TEXT
 );
+-- тёплый пул готовых черновиков для мгновенных кнопок (profile_rev — ревизия профиля)
+CREATE TABLE IF NOT EXISTS draft_pool (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,
+  text TEXT NOT NULL,
+  profile_rev TEXT NOT NULL,
+  created_at TEXT NOT NULL
+);
+-- очередь исходящих публикаций; dedup_key = '<источник>:<chat_id>' не даёт отправить одно и то же дважды
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  dedup_key TEXT NOT NULL UNIQUE,
+  chat_id TEXT NOT NULL,
+  draft_id INTEGER,
+  text TEXT NOT NULL,
+  image_ref TEXT,
+  image_file_id TEXT,
+  status TEXT NOT NULL DEFAULT 'queued',  -- queued | sending | sent | failed
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_at REAL NOT NULL,                  -- unix time следующей попытки
+  error TEXT,
+  message_id INTEGER,
+  created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox(status, next_at);
+-- кэш ответов модели: key = sha256(model, messages, temperature)
+CREATE TABLE IF NOT EXISTS gen_cache (
+  key TEXT PRIMARY KEY,
+  text TEXT NOT NULL,
+  created_at REAL NOT NULL,
+  last_hit REAL NOT NULL,
+  hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS gen_cache_lru ON gen_cache(last_hit);
+-- аренды между процессами: 'leader' — кто ведёт планировщик, 'worker:<id>' — живые воркеры
+CREATE TABLE IF NOT EXISTS leases (
+  name TEXT PRIMARY KEY,
+  owner TEXT NOT NULL,
+  expires_at REAL NOT NULL   -- unix time
+);
+-- чего бот ждёт от админа следующим сообщением (например, текст после «✏️ Править»)
+CREATE TABLE IF NOT EXISTS pending_input (
+  user_id INTEGER PRIMARY KEY,
+  action TEXT NOT NULL,
+  created_at TEXT NOT NULL
+);
+-- архив черновиков (уборка по DRAFT_MAX_AGE_DAYS / DRAFT_MAX_PER_KIND): id тот же, что был в drafts,
+-- data — zlib(JSON {text, image_prompt}); картинки не храним
+CREATE TABLE IF NOT EXISTS drafts_archive (
+  id INTEGER PRIMARY KEY,
+  tenant_id INTEGER NOT NULL,
+  kind TEXT,
+  status TEXT NOT NULL,
+  created_at TEXT,
+  archived_at TEXT NOT NULL,
+  data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS drafts_archive_tenant_created ON drafts_archive(tenant_id, created_at);
+CREATE INDEX IF NOT EXISTS drafts_archive_tenant_kind_created ON drafts_archive(tenant_id, kind, created_at);
+-- MinHash-подписи текстов (черновики и всё опубликованное) и LSH-корзины для поиска похожих
+CREATE TABLE IF NOT EXISTS dedup_docs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  tenant_id INTEGER NOT NULL DEFAULT 1,
+  ref TEXT NOT NULL UNIQUE,                 -- 'draft:12', 'slot:1:2026-05-01T10:00', 'once:…'
+  sig BLOB NOT NULL,
+  created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dedup_bands (
+  tenant_id INTEGER NOT NULL,
+  bucket INTEGER NOT NULL,                  -- хэш (номер полосы, её значения подписи)
+  doc_id INTEGER NOT NULL,
+  PRIMARY KEY (tenant_id, bucket, doc_id)
+) WITHOUT ROWID;
+-- фоновые генерации картинок: задача на нажатие «Сгенерировать»/«Ещё картинка» и её готовые варианты
+CREATE TABLE IF NOT EXISTS image_jobs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  tenant_id INTEGER NOT NULL DEFAULT 1,
+  draft_id INTEGER NOT NULL,
+  image_prompt TEXT,
+  status TEXT NOT NULL DEFAULT 'running',   -- running | done | failed | cancelled
+  owner TEXT,                               -- INSTANCE_ID процесса, который рисует
+  created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS image_jobs_draft ON image_jobs(draft_id, status);
+CREATE TABLE IF NOT EXISTS image_variants (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  job_id INTEGER NOT NULL,
+  n INTEGER NOT NULL,
+  image_ref TEXT NOT NULL,
+  thumb_ref TEXT,
+  UNIQUE(job_id, n)
+);
 """
 
 DEFAULT_PROFILE = {
@@ -108,73 +654,851 @@ DEFAULT_PROFILE = {
     "image_style": "светлый зал, натуральный свет, динамика, улыбающиеся люди, 3:4"
 }
 
-async def migrate_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("PRAGMA table_info(drafts)")
-        cols = [r[1] for r in await cur.fetchall()]
-        if "image_bytes" not in cols:
-            await db.execute("ALTER TABLE drafts ADD COLUMN image_bytes BLOB")
-            await db.commit()
+# Один долгоживущий коннект на весь процесс: aiosqlite держит под него свой поток,
+# а sqlite3 кэширует подготовленные выражения (cached_statements) между вызовами.
+DB_PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",  # для новой базы; старую переводит init_db (нужен полный VACUUM)
+    "PRAGMA journal_mode=WAL",      # читатели не блокируют писателя
+    "PRAGMA synchronous=NORMAL",    # в WAL безопасно и без fsync на каждый коммит
+    f"PRAGMA cache_size=-{DB_CACHE_KIB}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(CREATE_TABLES_SQL)
-        await db.commit()
-        # ensure profile exists
-        cur = await db.execute("SELECT profile_json FROM studio WHERE id=1")
-        row = await cur.fetchone()
-        if not row:
-            await db.execute("INSERT INTO studio (id, profile_json) VALUES (1, ?)", (json.dumps(DEFAULT_PROFILE, ensure_ascii=False),))
+_db: Optional[aiosqlite.Connection] = None
+_db_open_lock = asyncio.Lock()
+# Все записи идут через db_tx(): на одном коннекте транзакции нельзя перемешивать
+_db_write_lock = asyncio.Lock()
+
+async def get_db() -> aiosqlite.Connection:
+    global _db
+    if _db is None:
+        async with _db_open_lock:
+            if _db is None:
+                conn = await aiosqlite.connect(DB_PATH, cached_statements=DB_CACHED_STATEMENTS)
+                for pragma in DB_PRAGMAS:
+                    await conn.execute(pragma)
+                _db = conn
+    return _db
+
+async def close_db():
+    global _db
+    if _db is not None:
+        conn, _db = _db, None
+        async with _db_write_lock:
+            try:
+                # сбрасываем WAL в основной файл, чтобы после остановки остался один .db
+                await conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            finally:
+                await conn.close()
+
+@asynccontextmanager
+async def db_tx():
+    """Транзакция на общем коннекте: commit при выходе, rollback при ошибке."""
+    db = await get_db()
+    async with _db_write_lock:
+        try:
+            yield db
             await db.commit()
-    await migrate_db()
+        except BaseException:
+            await db.rollback()
+            raise
 
-async def get_profile() -> Dict[str, Any]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT profile_json FROM studio WHERE id=1")
-        row = await cur.fetchone()
-        return json.loads(row[0]) if row else DEFAULT_PROFILE
+async def db_fetchone(sql: str, params: Tuple = ()) -> Optional[Tuple]:
+    db = await get_db()
+    async with db.execute(sql, params) as cur:
+        return await cur.fetchone()
 
-async def set_profile(profile: Dict[str, Any]):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE studio SET profile_json=? WHERE id=1", (json.dumps(profile, ensure_ascii=False),))
-        await db.commit()
+# индексы по студии: выборки одной студии не должны замедляться с ростом числа студий;
+# по типу и дате — /history и уборка старых черновиков на сотнях тысяч строк
+TENANT_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS drafts_tenant ON drafts(tenant_id, id)",
+    "CREATE INDEX IF NOT EXISTS drafts_tenant_created ON drafts(tenant_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS drafts_tenant_kind_created ON drafts(tenant_id, kind, created_at)",
+    "CREATE INDEX IF NOT EXISTS draft_pool_tenant_kind ON draft_pool(tenant_id, kind, profile_rev, id)",
+)
 
-async def get_daily_time() -> Optional[str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT daily_time FROM settings WHERE id=1")
-        row = await cur.fetchone()
-        return row[0] if row and row[0] else None
+async def _table_columns(db: aiosqlite.Connection, table: str) -> List[str]:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    return [r[1] for r in await cur.fetchall()]
+
+async def _rebuild_table(db: aiosqlite.Connection, table: str, create_sql: str, columns: str, select: str):
+    """SQLite не умеет менять ограничения: создаём таблицу заново и переносим строки (в одной транзакции)."""
+    if not db.in_transaction:
+        await db.execute("BEGIN")
+    await db.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+    await db.execute(create_sql)
+    await db.execute(f"INSERT INTO {table} ({columns}) SELECT {select} FROM {table}_old")
+    await db.execute(f"DROP TABLE {table}_old")
+
+async def migrate_db(db: aiosqlite.Connection) -> int:
+    """Доводит схему до актуальной. Возвращает число картинок, вынесенных из BLOB в файлы."""
+    # одна студия → много: studio/settings были с CHECK (id=1), scheduled_posts — UNIQUE(slot_at)
+    if "id" in await _table_columns(db, "studio"):
+        await _rebuild_table(db, "studio", "CREATE TABLE studio (tenant_id INTEGER PRIMARY KEY, profile_json TEXT NOT NULL)",
+                             "tenant_id, profile_json", "id, profile_json")
+    if "id" in await _table_columns(db, "settings"):
+        await _rebuild_table(db, "settings", "CREATE TABLE settings (tenant_id INTEGER PRIMARY KEY, daily_time TEXT)",
+                             "tenant_id, daily_time", "id, daily_time")
+    sp_cols = await _table_columns(db, "scheduled_posts")
+    if sp_cols and "tenant_id" not in sp_cols:
+        cols = "id, slot_at, kind, text, image_ref, status, attempts, error, created_at"
+        await _rebuild_table(db, "scheduled_posts", SCHEDULED_POSTS_SQL, cols, cols)
+    else:
+        await db.execute(SCHEDULED_POSTS_SQL)
+    for table in ("drafts", "draft_pool", "outbox"):
+        if "tenant_id" not in await _table_columns(db, table):
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN tenant_id INTEGER NOT NULL DEFAULT 1")
+    await db.execute("DROP INDEX IF EXISTS draft_pool_kind")
+    for sql in TENANT_INDEXES:
+        await db.execute(sql)
+    cols = await _table_columns(db, "drafts")
+    if "image_bytes" not in cols:
+        await db.execute("ALTER TABLE drafts ADD COLUMN image_bytes BLOB")
+    if "image_ref" not in cols:
+        await db.execute("ALTER TABLE drafts ADD COLUMN image_ref TEXT")
+    if "image_file_id" not in cols:
+        # file_id, который Telegram вернул на превью: повторная отправка без загрузки файла
+        await db.execute("ALTER TABLE drafts ADD COLUMN image_file_id TEXT")
+    if "thumb_ref" not in cols:
+        await db.execute("ALTER TABLE drafts ADD COLUMN thumb_ref TEXT")
+    if "status" not in cols:
+        # draft | published: кнопка «Утвердить» публикует черновик только из draft
+        await db.execute("ALTER TABLE drafts ADD COLUMN status TEXT NOT NULL DEFAULT 'draft'")
+        await db.execute(
+            "UPDATE drafts SET status='published' WHERE id IN (SELECT draft_id FROM outbox WHERE draft_id IS NOT NULL)"
+        )
+    if "claimed_by" not in await _table_columns(db, "outbox"):
+        # какой процесс отправляет запись: после его смерти запись возвращается в очередь
+        await db.execute("ALTER TABLE outbox ADD COLUMN claimed_by TEXT")
+    # старые картинки из drafts.image_bytes → файлы IMAGES_DIR, в строке остаётся только ссылка
+    # (по одной строке, чтобы не поднимать в память все BLOB-ы разом)
+    cur = await db.execute("SELECT id FROM drafts WHERE image_bytes IS NOT NULL")
+    ids = [r[0] for r in await cur.fetchall()]
+    for draft_id in ids:
+        cur = await db.execute("SELECT image_bytes FROM drafts WHERE id=?", (draft_id,))
+        (data,) = await cur.fetchone()
+        ref = await put_image(data)
+        await db.execute("UPDATE drafts SET image_ref=?, image_bytes=NULL WHERE id=?", (ref, draft_id))
+    # одно время автопоста на студию (settings.daily_time) → слот на каждый день; отработанным считаем
+    # последний опубликованный слот, чтобы пропущенный прямо перед обновлением ещё догнать
+    await db.execute(
+        "INSERT OR IGNORE INTO schedule_slots (tenant_id, hhmm, last_slot_at) "
+        "SELECT s.tenant_id, s.daily_time, COALESCE((SELECT MAX(slot_at) FROM scheduled_posts p "
+        "WHERE p.tenant_id=s.tenant_id AND p.status='published'), ?) FROM settings s "
+        "WHERE s.daily_time IS NOT NULL AND s.daily_time<>''",
+        (_slot_key(_sched_now()),),
+    )
+    await db.execute("UPDATE settings SET daily_time=NULL")
+    return len(ids)
 
-async def set_daily_time(hhmm: Optional[str]):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id FROM settings WHERE id=1")
-        row = await cur.fetchone()
-        if row:
-            await db.execute("UPDATE settings SET daily_time=? WHERE id=1", (hhmm,))
+async def init_db():
+    """Один проход по общему коннекту: схема и миграции (если версия отстала), студия из .env и прогрев кэшей."""
+    db = await get_db()
+    async with db.execute("PRAGMA user_version") as cur:
+        upgrade = (await cur.fetchone())[0] != SCHEMA_VERSION
+    moved = 0
+    if upgrade:
+        async with _db_write_lock:
+            await db.executescript(CREATE_TABLES_SQL)
+    async with db_tx() as db:
+        if upgrade:
+            moved = await migrate_db(db)
+            await db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        # первая студия описана в .env: каналы и админов берём оттуда при каждом запуске
+        await db.execute(
+            "INSERT INTO tenants (id, name, channel_ids, created_at) VALUES (1, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET channel_ids=excluded.channel_ids",
+            (DEFAULT_PROFILE["name"], ",".join(CHANNEL_IDS), datetime.now().isoformat()),
+        )
+        await db.execute(
+            f"DELETE FROM tenant_admins WHERE tenant_id=1 AND user_id NOT IN ({','.join('?' * len(ADMIN_IDS))})",
+            tuple(ADMIN_IDS),
+        )
+        await db.executemany(
+            "INSERT OR IGNORE INTO tenant_admins (user_id, tenant_id) VALUES (?, 1)", [(uid,) for uid in ADMIN_IDS]
+        )
+        # ensure profile exists
+        await db.execute(
+            "INSERT OR IGNORE INTO studio (tenant_id, profile_json) VALUES (1, ?)",
+            (json.dumps(DEFAULT_PROFILE, ensure_ascii=False),),
+        )
+        # в той же транзакции читаем студии, админов и профили: первый апдейт не идёт в базу за ними
+        async with db.execute("SELECT id, name, channel_ids FROM tenants") as cur:
+            tenants = await cur.fetchall()
+        async with db.execute("SELECT user_id, tenant_id FROM tenant_admins") as cur:
+            admins = await cur.fetchall()
+        async with db.execute("SELECT tenant_id, profile_json FROM studio") as cur:
+            profiles = await cur.fetchall()
+    now = time_monotonic()
+    for tenant_id, name, channel_ids in tenants:
+        _tenant_cache[tenant_id] = ({"id": tenant_id, "name": name, "channels": _parse_ids(channel_ids)}, now)
+    for user_id, tenant_id in admins:
+        _admin_tenant_cache[user_id] = (tenant_id, now)
+    for tenant_id, profile_json in profiles:
+        _cache_profile(tenant_id, json.loads(profile_json))
+    if not upgrade:
+        return
+    async with db.execute("PRAGMA auto_vacuum") as cur:
+        incremental = (await cur.fetchone())[0] == 2
+    if moved or not incremental:
+        # освобождаем страницы, которые занимали BLOB-ы; база до инкрементального VACUUM
+        # переходит на него только после полного VACUUM (один раз)
+        logging.info("Vacuuming %s (images moved to files: %s, auto_vacuum was off: %s)", DB_PATH, moved, not incremental)
+        async with _db_write_lock:
+            await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await db.execute("VACUUM")
+    await backfill_similar_index()
+
+# ---------- PROFILE CACHE ----------
+# Профиль меняется только через /setup → set_profile, поэтому держим профили студий в памяти процесса
+# вместе с уже склеенными строками для промпта. Возвращаемый dict не мутировать — копировать.
+# В webhook-режиме с несколькими процессами /setup мог прийти в соседний — там кэш живёт PROFILE_CACHE_TTL.
+_profile_cache: Dict[int, Dict[str, Any]] = {}            # tenant_id → профиль
+_profile_loaded_at: Dict[int, float] = {}
+_profile_rendered: Dict[int, Tuple[Dict[str, Any], Dict[str, str]]] = {}  # id(профиля) → (профиль, строки)
+
+def _cache_fresh(loaded_at: Optional[float]) -> bool:
+    if loaded_at is None:
+        return False
+    return WORKER_PROCESSES == 1 or time_monotonic() - loaded_at <= PROFILE_CACHE_TTL
+
+def _render_profile(profile: Dict[str, Any]) -> Dict[str, str]:
+    services = ", ".join(profile["services"])
+    offers = "; ".join(profile["offers"])
+    brand = ", ".join(profile["brand_words"])
+    return {
+        # ревизия профиля: по ней отбраковываем заготовки тёплого пула
+        "rev": hashlib.sha1(json.dumps(profile, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:16],
+        "services": services,
+        "hashtags": " ".join(profile["hashtags"]),
+        "offers": offers,
+        "brand": brand,
+        # акцент для промпта картинки: первые две услуги
+        "accent": ", ".join(profile["services"][:2]),
+        # пропорция картинки из image_style, например "3:4"
+        "aspect": "%d:%d" % parse_aspect(profile.get("image_style", "")),
+        # неизменяемая часть промпта build_user_prompt
+        "prompt_head": f"""Дано:
+- Студия: {profile["name"]}
+- Адрес: {profile["address"]}
+- Телефон: {profile["phone"]}
+- Услуги: {services}
+- Офферы: {offers}
+- Слова бренда: {brand}
+- Тон: {profile["tone"]}
+""",
+    }
+
+def _cache_profile(tenant_id: int, profile: Dict[str, Any]):
+    old = _profile_cache.get(tenant_id)
+    if old is not None:
+        _profile_rendered.pop(id(old), None)
+    _profile_rendered[id(profile)] = (profile, _render_profile(profile))
+    _profile_cache[tenant_id] = profile
+    _profile_loaded_at[tenant_id] = time_monotonic()
+
+def profile_rendered(profile: Dict[str, Any]) -> Dict[str, str]:
+    """Склеенные поля профиля: из кэша для закэшированного профиля, иначе считаем на лету."""
+    hit = _profile_rendered.get(id(profile))
+    if hit is not None and hit[0] is profile:
+        return hit[1]
+    return _render_profile(profile)
+
+@timed("db")
+async def get_profile(tenant_id: int = 1) -> Dict[str, Any]:
+    if not _cache_fresh(_profile_loaded_at.get(tenant_id)):
+        row = await db_fetchone("SELECT profile_json FROM studio WHERE tenant_id=?", (tenant_id,))
+        _cache_profile(tenant_id, json.loads(row[0]) if row else DEFAULT_PROFILE)
+    return _profile_cache[tenant_id]
+
+@timed("db")
+async def set_profile(profile: Dict[str, Any], tenant_id: int = 1):
+    async with db_tx() as db:
+        await db.execute(
+            "INSERT INTO studio (tenant_id, profile_json) VALUES (?, ?) "
+            "ON CONFLICT(tenant_id) DO UPDATE SET profile_json=excluded.profile_json",
+            (tenant_id, json.dumps(profile, ensure_ascii=False)),
+        )
+        # заготовки пула написаны под старый профиль
+        await db.execute("DELETE FROM draft_pool WHERE tenant_id=?", (tenant_id,))
+    # write-through: кэш обновляем только после успешного коммита
+    _cache_profile(tenant_id, profile)
+    _pool_wakeup.set()
+
+# ---------- TENANTS ----------
+# Студия админа и каналы студии нужны на каждый апдейт и каждую публикацию — кэшируем
+# по ключу (поиск не зависит от числа студий), с тем же PROFILE_CACHE_TTL в многопроцессном режиме.
+_tenant_cache: Dict[int, Tuple[Optional[Dict[str, Any]], float]] = {}   # tenant_id → (студия, когда)
+_admin_tenant_cache: Dict[int, Tuple[Optional[int], float]] = {}       # user_id → (tenant_id, когда)
+
+def _parse_ids(raw: str) -> List[str]:
+    return [c.strip() for c in (raw or "").split(",") if c.strip()]
+
+@timed("db")
+async def get_tenant(tenant_id: int) -> Optional[Dict[str, Any]]:
+    """{'id', 'name', 'channels'} или None, если такой студии нет."""
+    hit = _tenant_cache.get(tenant_id)
+    if hit is None or not _cache_fresh(hit[1]):
+        row = await db_fetchone("SELECT id, name, channel_ids FROM tenants WHERE id=?", (tenant_id,))
+        tenant = {"id": row[0], "name": row[1], "channels": _parse_ids(row[2])} if row else None
+        hit = _tenant_cache[tenant_id] = (tenant, time_monotonic())
+    return hit[0]
+
+@timed("db")
+async def tenant_of(user_id: int) -> Optional[int]:
+    """Студия, которой сейчас управляет пользователь (None — не админ)."""
+    hit = _admin_tenant_cache.get(user_id)
+    if hit is None or not _cache_fresh(hit[1]):
+        row = await db_fetchone("SELECT tenant_id FROM tenant_admins WHERE user_id=?", (user_id,))
+        hit = _admin_tenant_cache[user_id] = (row[0] if row else None, time_monotonic())
+    # суперадмин всегда в какой-то студии: init_db заводит ему строку, /tenant use только переставляет
+    if hit[0] is None and user_id in ADMIN_IDS:
+        return 1
+    return hit[0]
+
+async def tenant_channels(tenant_id: int) -> List[str]:
+    tenant = await get_tenant(tenant_id)
+    return tenant["channels"] if tenant else []
+
+@timed("db")
+async def tenant_admin_ids(tenant_id: int) -> List[int]:
+    db = await get_db()
+    async with db.execute("SELECT user_id FROM tenant_admins WHERE tenant_id=?", (tenant_id,)) as cur:
+        return [r[0] for r in await cur.fetchall()]
+
+@timed("db")
+async def list_tenants() -> List[Tuple[int, str, str, Optional[str], int]]:
+    """(id, name, channel_ids, слоты автопоста через запятую, число админов) по всем студиям."""
+    db = await get_db()
+    async with db.execute(
+        "SELECT t.id, t.name, t.channel_ids, "
+        "(SELECT group_concat(hhmm, ', ') FROM (SELECT hhmm FROM schedule_slots s WHERE s.tenant_id=t.id ORDER BY hhmm)), "
+        "(SELECT COUNT(*) FROM tenant_admins a WHERE a.tenant_id=t.id) "
+        "FROM tenants t ORDER BY t.id"
+    ) as cur:
+        return await cur.fetchall()
+
+@timed("db")
+async def add_tenant(name: str, channels: List[str], admins: List[int]) -> int:
+    async with db_tx() as db:
+        cur = await db.execute(
+            "INSERT INTO tenants (name, channel_ids, created_at) VALUES (?, ?, ?) RETURNING id",
+            (name, ",".join(channels), datetime.now().isoformat()),
+        )
+        (tenant_id,) = await cur.fetchone()
+        await db.execute(
+            "INSERT INTO studio (tenant_id, profile_json) VALUES (?, ?)",
+            (tenant_id, json.dumps(dict(DEFAULT_PROFILE, name=name), ensure_ascii=False)),
+        )
+    await set_tenant_admins(tenant_id, admins)
+    return tenant_id
+
+@timed("db")
+async def update_tenant(tenant_id: int, name: Optional[str] = None, channels: Optional[List[str]] = None):
+    async with db_tx() as db:
+        if name is not None:
+            await db.execute("UPDATE tenants SET name=? WHERE id=?", (name, tenant_id))
+        if channels is not None:
+            await db.execute("UPDATE tenants SET channel_ids=? WHERE id=?", (",".join(channels), tenant_id))
+    _tenant_cache.pop(tenant_id, None)
+
+@timed("db")
+async def set_tenant_admins(tenant_id: int, admins: List[int]):
+    """Переводит пользователей в студию (админ работает в одной студии за раз)."""
+    if not admins:
+        return
+    async with db_tx() as db:
+        await db.executemany(
+            "INSERT INTO tenant_admins (user_id, tenant_id) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET tenant_id=excluded.tenant_id",
+            [(uid, tenant_id) for uid in admins],
+        )
+    for uid in admins:
+        _admin_tenant_cache.pop(uid, None)
+
+@timed("db")
+async def get_slots(tenant_id: Optional[int] = None) -> List[Tuple[int, int, str, str, str]]:
+    """Слоты автопоста (id, tenant_id, hhmm, days, last_slot_at): одной студии или всех (для планировщика)."""
+    db = await get_db()
+    if tenant_id is None:
+        sql, params = "SELECT id, tenant_id, hhmm, days, last_slot_at FROM schedule_slots ORDER BY tenant_id, hhmm", ()
+    else:
+        sql, params = ("SELECT id, tenant_id, hhmm, days, last_slot_at FROM schedule_slots WHERE tenant_id=? "
+                       "ORDER BY hhmm", (tenant_id,))
+    async with db.execute(sql, params) as cur:
+        return await cur.fetchall()
+
+@timed("db")
+async def save_slots(slots: Dict[str, str], tenant_id: int = 1, replace: bool = False):
+    """
+    slots — {hhmm: days}. Новый слот отсчитывается от текущей минуты (прошедшее сегодня не догоняем);
+    у существующего меняются только дни. replace — остальные слоты студии удалить.
+    """
+    now_key = _slot_key(_sched_now())
+    async with db_tx() as db:
+        if replace:
+            await db.execute(
+                f"DELETE FROM schedule_slots WHERE tenant_id=? AND hhmm NOT IN ({','.join('?' * len(slots))})",
+                (tenant_id, *slots),
+            )
+        # добавленный день недели не должен догонять уже прошедший сегодня слот
+        await db.executemany(
+            "INSERT INTO schedule_slots (tenant_id, hhmm, days, last_slot_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(tenant_id, hhmm) DO UPDATE SET days=excluded.days, last_slot_at=CASE "
+            "WHEN days<>excluded.days THEN max(last_slot_at, excluded.last_slot_at) ELSE last_slot_at END",
+            [(tenant_id, hhmm, days, now_key) for hhmm, days in slots.items()],
+        )
+
+@timed("db")
+async def remove_slots(tenant_id: int = 1, hhmms: Optional[List[str]] = None) -> int:
+    """Удаляет слоты студии (все, если hhmms не задан). Возвращает, сколько удалено."""
+    async with db_tx() as db:
+        if hhmms is None:
+            cur = await db.execute("DELETE FROM schedule_slots WHERE tenant_id=?", (tenant_id,))
         else:
-            await db.execute("INSERT INTO settings (id, daily_time) VALUES (1, ?)", (hhmm,))
-        await db.commit()
+            cur = await db.execute(
+                f"DELETE FROM schedule_slots WHERE tenant_id=? AND hhmm IN ({','.join('?' * len(hhmms))})",
+                (tenant_id, *hhmms),
+            )
+        return cur.rowcount
+
+@timed("db")
+async def get_kind_plan(tenant_id: int = 1) -> Dict[int, List[str]]:
+    """План типов постов: день недели (0 — пн) → типы слотов дня; незаданные дни — по KINDS_CYCLE."""
+    plan = {d: [KINDS_CYCLE[d % len(KINDS_CYCLE)]] for d in range(7)}
+    db = await get_db()
+    async with db.execute("SELECT weekday, kinds FROM kind_plan WHERE tenant_id=?", (tenant_id,)) as cur:
+        for weekday, kinds in await cur.fetchall():
+            plan[weekday] = kinds.split(",")
+    return plan
+
+@timed("db")
+async def set_kind_plan(plan: Dict[int, List[str]], tenant_id: int = 1):
+    """Задаёт типы на указанные дни; пустой plan — вернуть план по умолчанию."""
+    async with db_tx() as db:
+        if not plan:
+            await db.execute("DELETE FROM kind_plan WHERE tenant_id=?", (tenant_id,))
+        await db.executemany(
+            "INSERT INTO kind_plan (tenant_id, weekday, kinds) VALUES (?, ?, ?) "
+            "ON CONFLICT(tenant_id, weekday) DO UPDATE SET kinds=excluded.kinds",
+            [(tenant_id, weekday, ",".join(kinds)) for weekday, kinds in plan.items()],
+        )
 
-async def add_draft(kind: str, text: str, image_prompt: Optional[str], image_bytes: Optional[bytes] = None):
-    async with aiosqlite.connect(DB_PATH) as db:
+@timed("db")
+async def set_pending_input(user_id: int, action: str):
+    async with db_tx() as db:
         await db.execute(
-            "INSERT INTO drafts (kind, text, image_prompt, created_at, image_bytes) VALUES (?, ?, ?, ?, ?)",
-            (kind, text, image_prompt or "", datetime.now().isoformat(), image_bytes)
+            "INSERT INTO pending_input (user_id, action, created_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET action=excluded.action, created_at=excluded.created_at",
+            (user_id, action, datetime.now().isoformat()),
         )
-        await db.commit()
 
-async def get_latest_draft() -> Optional[Tuple[int, str, str, str, Optional[bytes]]]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, kind, text, image_prompt, image_bytes FROM drafts ORDER BY id DESC LIMIT 1")
-        return await cur.fetchone()
+def _pending_fresh(created_at: str) -> bool:
+    return datetime.now() - datetime.fromisoformat(created_at) <= timedelta(minutes=PENDING_INPUT_TTL_MIN)
+
+@timed("db")
+async def get_pending_input(user_id: int) -> Optional[str]:
+    """Ожидание пользователя; просроченное (старше PENDING_INPUT_TTL_MIN) удаляем и не возвращаем."""
+    row = await db_fetchone("SELECT action, created_at FROM pending_input WHERE user_id=?", (user_id,))
+    if row and not _pending_fresh(row[1]):
+        await pop_pending_input(user_id)
+        return None
+    return row[0] if row else None
+
+@timed("db")
+async def pop_pending_input(user_id: int) -> Optional[str]:
+    """Забирает ожидание атомарно: если сообщение обработал другой процесс или оно просрочено, вернёт None."""
+    async with db_tx() as db:
+        cur = await db.execute("DELETE FROM pending_input WHERE user_id=? RETURNING action, created_at", (user_id,))
+        row = await cur.fetchone()
+    return row[0] if row and _pending_fresh(row[1]) else None
+
+@timed("db")
+async def add_draft(kind: str, text: str, image_prompt: Optional[str], image_ref: Optional[str] = None,
+                    tenant_id: int = 1) -> int:
+    async with db_tx() as db:
+        cur = await db.execute(
+            "INSERT INTO drafts (tenant_id, kind, text, image_prompt, created_at, image_ref) VALUES (?, ?, ?, ?, ?, ?)",
+            (tenant_id, kind, text, image_prompt or "", datetime.now().isoformat(), image_ref)
+        )
+        draft_id = cur.lastrowid
+    await index_texts([(f"draft:{draft_id}", text)], tenant_id)
+    return draft_id
+
+@timed("db")
+async def add_drafts(rows: List[Tuple[str, str, Optional[str]]], tenant_id: int = 1) -> List[int]:
+    """Пакетная вставка черновиков (kind, text, image_prompt) одной транзакцией. Возвращает их id."""
+    if not rows:
+        return []
+    now = datetime.now().isoformat()
+    ids = []
+    async with db_tx() as db:
+        # по одному execute, чтобы знать id (нужны кнопкам), но коммит всё равно один
+        for kind, text, image_prompt in rows:
+            cur = await db.execute(
+                "INSERT INTO drafts (tenant_id, kind, text, image_prompt, created_at) VALUES (?, ?, ?, ?, ?)",
+                (tenant_id, kind, text, image_prompt or "", now),
+            )
+            ids.append(cur.lastrowid)
+    await index_texts([(f"draft:{draft_id}", text) for draft_id, (_, text, _) in zip(ids, rows)], tenant_id)
+    return ids
+
+@timed("db")
+async def get_draft(draft_id: int, tenant_id: int = 1) -> Optional[Tuple[int, str, str, str, Optional[str], Optional[str], str]]:
+    """
+    (id, kind, text, image_prompt, image_ref, image_file_id, status) по первичному ключу; None — нет
+    такого черновика у этой студии. Сама картинка грузится лениво через image_input().
+    """
+    return await db_fetchone(
+        "SELECT id, kind, text, image_prompt, image_ref, image_file_id, status FROM drafts WHERE id=? AND tenant_id=?",
+        (draft_id, tenant_id),
+    )
 
-async def set_draft_image(draft_id: int, image_bytes: Optional[bytes], image_prompt: Optional[str] = None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        if image_bytes is None:
-            await db.execute("UPDATE drafts SET image_bytes=NULL WHERE id=?", (draft_id,))
+@timed("db")
+async def set_draft_status(draft_id: int, status: str, expect: Optional[str] = None) -> bool:
+    """Меняет статус; с expect — только из этого статуса (атомарно, в т.ч. между процессами). True — поменяли."""
+    async with db_tx() as db:
+        if expect is None:
+            cur = await db.execute("UPDATE drafts SET status=? WHERE id=?", (status, draft_id))
+        else:
+            cur = await db.execute("UPDATE drafts SET status=? WHERE id=? AND status=?", (status, draft_id, expect))
+        return cur.rowcount > 0
+
+@timed("db")
+async def set_draft_image(draft_id: int, image_ref: Optional[str], image_prompt: Optional[str] = None,
+                          thumb_ref: Optional[str] = None):
+    # новая картинка — старый file_id больше не про неё
+    async with db_tx() as db:
+        if image_ref is None:
+            await db.execute("UPDATE drafts SET image_ref=NULL, thumb_ref=NULL, image_file_id=NULL WHERE id=?", (draft_id,))
         else:
-            await db.execute("UPDATE drafts SET image_bytes=?, image_prompt=? WHERE id=?", (image_bytes, image_prompt or "", draft_id))
-        await db.commit()
+            await db.execute(
+                "UPDATE drafts SET image_ref=?, thumb_ref=?, image_prompt=?, image_file_id=NULL WHERE id=?",
+                (image_ref, thumb_ref, image_prompt or "", draft_id),
+            )
+
+@timed("db")
+async def set_draft_file_id(draft_id: int, file_id: Optional[str]):
+    async with db_tx() as db:
+        await db.execute("UPDATE drafts SET image_file_id=? WHERE id=?", (file_id, draft_id))
+
+@timed("db")
+async def create_image_job(draft_id: int, image_prompt: str, tenant_id: int = 1) -> Optional[int]:
+    """Новая задача на картинки черновика; None — по нему уже рисует живой процесс."""
+    async with db_tx() as db:
+        cur = await db.execute(
+            "SELECT id FROM image_jobs WHERE draft_id=? AND status='running' AND (owner=? OR "
+            "owner IN (SELECT owner FROM leases WHERE name LIKE 'worker:%' AND expires_at>=?))",
+            (draft_id, INSTANCE_ID, datetime.now().timestamp()),
+        )
+        if await cur.fetchone():
+            return None
+        cur = await db.execute(
+            "INSERT INTO image_jobs (tenant_id, draft_id, image_prompt, owner, created_at) VALUES (?, ?, ?, ?, ?)",
+            (tenant_id, draft_id, image_prompt, INSTANCE_ID, datetime.now().isoformat()),
+        )
+        return cur.lastrowid
+
+@timed("db")
+async def finish_image_job(job_id: int, status: str, tenant_id: Optional[int] = None) -> bool:
+    """running → status; False — задача уже завершена (например, её отменили из другого процесса)."""
+    sql, params = "UPDATE image_jobs SET status=? WHERE id=? AND status='running'", (status, job_id)
+    if tenant_id is not None:
+        sql, params = sql + " AND tenant_id=?", params + (tenant_id,)
+    async with db_tx() as db:
+        cur = await db.execute(sql, params)
+        return cur.rowcount > 0
+
+@timed("db")
+async def get_image_job_status(job_id: int) -> Optional[str]:
+    row = await db_fetchone("SELECT status FROM image_jobs WHERE id=?", (job_id,))
+    return row[0] if row else None
+
+@timed("db")
+async def add_image_variants(job_id: int, rows: List[Tuple[int, str, Optional[str]]]) -> List[int]:
+    """rows: (номер, image_ref, thumb_ref) → id вариантов (они уходят в кнопки выбора)."""
+    ids = []
+    async with db_tx() as db:
+        for n, ref, thumb_ref in rows:
+            cur = await db.execute(
+                "INSERT INTO image_variants (job_id, n, image_ref, thumb_ref) VALUES (?, ?, ?, ?)",
+                (job_id, n, ref, thumb_ref),
+            )
+            ids.append(cur.lastrowid)
+    return ids
+
+@timed("db")
+async def get_image_variant(variant_id: int, tenant_id: int = 1) -> Optional[Tuple[int, str, Optional[str], str]]:
+    """(draft_id, image_ref, thumb_ref, image_prompt) варианта; None — нет такого у этой студии."""
+    return await db_fetchone(
+        "SELECT j.draft_id, v.image_ref, v.thumb_ref, j.image_prompt FROM image_variants v "
+        "JOIN image_jobs j ON j.id=v.job_id WHERE v.id=? AND j.tenant_id=?",
+        (variant_id, tenant_id),
+    )
+
+# ---------- IMAGE STORE ----------
+# Картинки лежат файлами с именем sha256(содержимого) в IMAGES_DIR/<2 символа>/,
+# в drafts хранится только имя файла (image_ref). Одинаковые картинки не дублируются.
+def image_path(ref: str) -> str:
+    return os.path.join(IMAGES_DIR, ref[:2], ref)
+
+def _write_blob(data: bytes, ext: str) -> str:
+    ref = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+    path = image_path(ref)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)  # атомарно: читатель не увидит недописанный файл
+    else:
+        os.utime(path)  # свежий mtime: уборка не удалит файл, на который ссылку ещё не записали
+    return ref
+
+async def put_image(data: bytes, ext: str = "png") -> str:
+    """Сохраняет картинку в хранилище (вне event loop) и возвращает её ref."""
+    return await asyncio.to_thread(_write_blob, data, ext)
+
+def image_input(ref: str, filename: str = "post.png") -> FSInputFile:
+    """Файл для отправки в Telegram: aiogram читает его с диска кусками при загрузке."""
+    return FSInputFile(image_path(ref), filename=filename)
+
+# ---------- IMAGE PROCESSING ----------
+def build_image_prompt(prof: Dict[str, Any], theme: Optional[str]) -> str:
+    theme_text = f" Тема: {theme}." if theme else ""
+    return (
+        f"Фитнес-студия {prof['name']}. Стиль: {prof['image_style']}. "
+        f"Акцент: {profile_rendered(prof)['accent']}." + theme_text
+    )
+
+def parse_aspect(style: str) -> Tuple[int, int]:
+    """Соотношение сторон из image_style профиля ('..., 3:4'), по умолчанию квадрат."""
+    mt = re.search(r"(\d+)\s*[:x×]\s*(\d+)", style or "")
+    if mt and int(mt.group(1)) > 0 and int(mt.group(2)) > 0:
+        return int(mt.group(1)), int(mt.group(2))
+    return 1, 1
+
+def generation_size(aspect: Tuple[int, int]) -> str:
+    # ближайший размер, который умеет gpt-image-1; точную пропорцию доводим кропом
+    w, h = aspect
+    if w < h:
+        return "1024x1536"
+    if w > h:
+        return "1536x1024"
+    return "1024x1024"
+
+def _process_image(data: bytes, aspect: Tuple[int, int]) -> Tuple[bytes, bytes]:
+    """PNG от модели → (JPEG для канала в нужной пропорции, миниатюра JPEG)."""
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as src:
+        img = src.convert("RGB")
+    w, h = img.size
+    aw, ah = aspect
+    # центрированный кроп до нужной пропорции
+    if w * ah > h * aw:
+        new_w = h * aw // ah
+        img = img.crop(((w - new_w) // 2, 0, (w - new_w) // 2 + new_w, h))
+    elif w * ah < h * aw:
+        new_h = w * ah // aw
+        img = img.crop((0, (h - new_h) // 2, w, (h - new_h) // 2 + new_h))
+    img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)  # только уменьшаем
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+    img.thumbnail((IMAGE_THUMB_SIDE, IMAGE_THUMB_SIDE), Image.LANCZOS)
+    thumb = io.BytesIO()
+    img.save(thumb, "JPEG", quality=70, optimize=True)
+    return out.getvalue(), thumb.getvalue()
+
+async def store_processed_image(data: bytes, aspect: Tuple[int, int]) -> Tuple[str, str]:
+    """Обрабатывает картинку вне event loop и кладёт оба варианта в хранилище → (image_ref, thumb_ref)."""
+    full, thumb = await asyncio.to_thread(_process_image, data, aspect)
+    logging.info("Image processed: %s KiB → %s KiB (thumb %s KiB)", len(data) // 1024, len(full) // 1024, len(thumb) // 1024)
+    return await put_image(full, "jpg"), await put_image(thumb, "jpg")
+
+# ---------- OPENAI RESILIENCE ----------
+# Каждый запрос к OpenAI идёт через openai_call: дедлайн на весь вызов, повторы временных ошибок
+# (сеть, таймаут, 429, 5xx) с экспоненциальной паузой и джиттером, предохранитель на тип запросов.
+# Для интерактивного текста — дублирующий запрос, если первый завис дольше обычного (hedging).
+T = TypeVar("T")
+
+class GenerationError(Exception):
+    """OpenAI не дал результат; текст — для админа (его показывает on_generation_error)."""
+
+class ModerationError(GenerationError):
+    """Текст не прошёл модерацию (moderator): сгенерированный пост или пост на публикацию."""
+
+class CircuitBreaker:
+    """
+    failures сбоев подряд → «разомкнут» на cooldown секунд: запросы сразу получают GenerationError.
+    Потом пропускаем один пробный запрос: успех замыкает, сбой размыкает снова.
+    """
+
+    def __init__(self, name: str, failures: int, cooldown: float):
+        self.name = name
+        self.failures = max(1, failures)
+        self.cooldown = cooldown
+        self.errors = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    def before_call(self) -> bool:
+        """GenerationError — разомкнут; True — этот вызов и есть пробный."""
+        if self.opened_at is None:
+            return False
+        left = self.opened_at + self.cooldown - time_monotonic()
+        if left > 0 or self._probing:
+            raise GenerationError(f"OpenAI сейчас не отвечает — повтори через {max(1, round(left))} с.")
+        self._probing = True
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info("OpenAI %s breaker closed", self.name)
+        self.errors = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.errors += 1
+        self._probing = False
+        if self.opened_at is not None or self.errors >= self.failures:
+            if self.opened_at is None:
+                logging.warning("OpenAI %s breaker opened after %s failures", self.name, self.errors)
+                metrics.inc("openai_breaker", self.name)
+            self.opened_at = time_monotonic()
+
+    def release_probe(self):
+        """
+        Пробный вызов оборвался не по вине OpenAI (отмена — кнопка «Отменить», потеря лидерства,
+        остановка; ошибка в нашем коде): сбоем не считаем, но пробу освобождаем.
+        """
+        self._probing = False
+
+_breakers = {
+    kind: CircuitBreaker(kind, OPENAI_BREAKER_FAILURES, OPENAI_BREAKER_COOLDOWN) for kind in ("text", "image")
+}
+
+class LatencyWindow:
+    """Последние size успешных задержек — для порога дублирующего запроса."""
+
+    def __init__(self, size: int = 200):
+        self.values: deque = deque(maxlen=size)
+
+    def observe(self, value: float):
+        self.values.append(value)
+
+    def hedge_after(self) -> Optional[float]:
+        if OPENAI_HEDGE_QUANTILE <= 0 or len(self.values) < OPENAI_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.values)
+        return ordered[min(len(ordered) - 1, int(OPENAI_HEDGE_QUANTILE * len(ordered)))]
+
+# chat — весь ответ, chat_first — до первого куска stream (его и ждёт админ)
+_latency = {"chat": LatencyWindow(), "chat_first": LatencyWindow()}
+
+def _retry_delay(e: BaseException, attempt: int) -> Optional[float]:
+    """Пауза перед повтором (full jitter) или None, если ошибка не временная."""
+    from openai import APIConnectionError, RateLimitError, InternalServerError
+    if not isinstance(e, (APIConnectionError, RateLimitError, InternalServerError, TimeoutError)):
+        return None
+    delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+    if isinstance(e, RateLimitError):
+        try:
+            delay = max(delay, float(e.response.headers.get("retry-after") or 0))
+        except (TypeError, ValueError):
+            pass
+    return delay
+
+async def openai_call(kind: str, attempt: Callable[[float], Awaitable[T]], timeout: float, deadline: float) -> T:
+    """
+    attempt(timeout) — одна попытка; слот _oai_slots держим только на время попытки, не на паузу.
+    Таймаут попытки не выходит за общий дедлайн. Сбой или отказ OpenAI → GenerationError (причина
+    в __cause__); прочие исключения из attempt (ошибки в нашем коде) пробрасываются как есть.
+    """
+    breaker = _breakers[kind]
+    end = time_monotonic() + deadline
+    n = 0
+    while True:
+        probe = breaker.before_call()
+        try:
+            async with _oai_slots:
+                left = end - time_monotonic()
+                if left <= 0:
+                    raise TimeoutError
+                budget = min(timeout, left)
+                async with asyncio.timeout(budget):
+                    result = await attempt(budget)
+        except GenerationError:
+            raise
+        except asyncio.CancelledError:
+            # без этого отменённая проба оставит предохранитель разомкнутым до рестарта
+            if probe:
+                breaker.release_probe()
+            raise
+        except Exception as e:
+            delay = _retry_delay(e, n)
+            if delay is None:
+                from openai import APIStatusError
+                if not isinstance(e, APIStatusError):
+                    # не ответ OpenAI, а ошибка в attempt: о здоровье сервиса она ничего не говорит
+                    if probe:
+                        breaker.release_probe()
+                    raise
+                breaker.record_success()  # API ответил, просто отказал (4xx) — это не сбой сервиса
+                raise GenerationError(f"OpenAI отклонил запрос: {e}") from e
+            breaker.record_failure()
+            out_of_time = time_monotonic() + delay >= end
+            if n >= OPENAI_RETRIES or out_of_time or breaker.opened_at is not None:
+                if isinstance(e, TimeoutError) or out_of_time:
+                    raise GenerationError(f"OpenAI не ответил за {deadline:.0f} с. Попробуй ещё раз.") from e
+                raise GenerationError(f"OpenAI временно недоступен ({type(e).__name__}). Попробуй ещё раз чуть позже.") from e
+            logging.warning("OpenAI %s attempt %s failed (%r), retry in %.1f s", kind, n + 1, e, delay)
+            metrics.inc("openai_retry", kind)
+            n += 1
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+async def hedged(start: Callable[[], Awaitable[T]], after: Optional[float], label: str,
+                 discard: Optional[Callable[[T], Awaitable[Any]]] = None) -> T:
+    """
+    start() и, если за after секунд ответа нет и есть свободный слот OpenAI, — второй такой же запрос.
+    Побеждает первый успешный, второй отменяем (discard — закрыть лишний результат, например stream).
+    """
+    first = asyncio.create_task(start())
+    if after is None:
+        return await first
+    try:
+        done, _ = await asyncio.wait({first}, timeout=after)
+    except BaseException:
+        first.cancel()  # дедлайн openai_call: wait() сам задачу не отменяет
+        raise
+    if done or _oai_slots.locked():
+        return await first  # уже готово, или дубль отнимет слот у чужого запроса
+    await _oai_slots.acquire()
+    metrics.inc("openai_hedge", f"{label}:sent")
+    second = asyncio.create_task(start())
+    pending = {first, second}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # отменённая задача на exception() сама бросает CancelledError — её просто не считаем победителем
+            winners = [t for t in done if not t.cancelled() and t.exception() is None]
+            if winners:
+                if winners[0] is second:
+                    metrics.inc("openai_hedge", f"{label}:won")
+                for t in winners[1:]:
+                    if discard:
+                        await discard(t.result())
+                return winners[0].result()
+        # оба не удались: ошибка первого, а если его отменили — второго (отменены оба — CancelledError)
+        raise (second if first.cancelled() else first).exception()
+    finally:
+        _oai_slots.release()
+        for t in pending:
+            t.cancel()
 
 # ---------- OPENAI HELPERS ----------
 GEN_SYSTEM = """Ты — SMM-редактор фитнес-студии. Пишешь короткие сочные посты для Telegram:
@@ -186,76 +1510,477 @@ GEN_SYSTEM = """Ты — SMM-редактор фитнес-студии. Пиш
 """
 
 def build_user_prompt(profile: Dict[str, Any], kind: str, extra: str = "") -> str:
-    services = ", ".join(profile["services"])
-    hashtags = " ".join(profile["hashtags"])
-    offers = "; ".join(profile["offers"])
-    brand = ", ".join(profile["brand_words"])
-    tone = profile["tone"]
-    base = f"""Дано:
-- Студия: {profile["name"]}
-- Адрес: {profile["address"]}
-- Телефон: {profile["phone"]}
-- Услуги: {services}
-- Офферы: {offers}
-- Слова бренда: {brand}
-- Тон: {tone}
-
-Задача: Напиши пост типа "{kind}" для Telegram-канала студии. В конце добавь хештеги: {hashtags}.
+    r = profile_rendered(profile)
+    base = r["prompt_head"] + f"""
+Задача: Напиши пост типа "{kind}" для Telegram-канала студии. В конце добавь хештеги: {r["hashtags"]}.
 Если уместно, вставь явный оффер (но не всегда). Укажи адрес/связь ненавязчиво.
 Доп. условия: {extra}
 """
     return base
 
-async def generate_post(profile: Dict[str, Any], kind: str, extra: str = "") -> str:
-    prompt = build_user_prompt(profile, kind, extra)
-    resp = oai.chat.completions.create(
-        model="gpt-4.1-mini",
-        messages=[
-            {"role": "system", "content": GEN_SYSTEM},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.8,
+GEN_MODEL = "gpt-4.1-mini"
+GEN_TEMPERATURE = 0.8
+
+def _gen_messages(profile: Dict[str, Any], kind: str, extra: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": GEN_SYSTEM},
+        {"role": "user", "content": build_user_prompt(profile, kind, extra)}
+    ]
+
+# ---------- GENERATION CACHE ----------
+# Ответы модели по хэшу (model, messages, temperature) в SQLite: одинаковый запрос
+# (тот же тип, те же условия, тот же профиль) не идёт в OpenAI повторно.
+# Вытеснение — по возрасту (GEN_CACHE_TTL_HOURS) и по размеру (LRU по last_hit).
+gen_cache_stats = {"hits": 0, "misses": 0}
+
+def gen_cache_key(profile: Dict[str, Any], kind: str, extra: str = "") -> str:
+    payload = {"model": GEN_MODEL, "messages": _gen_messages(profile, kind, extra), "temperature": GEN_TEMPERATURE}
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+@timed("db")
+async def gen_cache_get(key: str) -> Optional[str]:
+    if GEN_CACHE_SIZE <= 0:
+        return None
+    now = datetime.now().timestamp()
+    row = await db_fetchone(
+        "SELECT text FROM gen_cache WHERE key=? AND created_at>=?", (key, now - GEN_CACHE_TTL_HOURS * 3600)
     )
-    return resp.choices[0].message.content.strip()
+    if row is None:
+        gen_cache_stats["misses"] += 1
+        metrics.inc("gen_cache", "miss")
+        return None
+    gen_cache_stats["hits"] += 1
+    metrics.inc("gen_cache", "hit")
+    async with db_tx() as db:
+        await db.execute("UPDATE gen_cache SET last_hit=?, hits=hits+1 WHERE key=?", (now, key))
+    return row[0]
+
+@timed("db")
+async def gen_cache_put(key: str, text: str):
+    if GEN_CACHE_SIZE <= 0:
+        return
+    now = datetime.now().timestamp()
+    async with db_tx() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO gen_cache (key, text, created_at, last_hit, hits) VALUES (?, ?, ?, ?, 0)",
+            (key, text, now, now),
+        )
+        await db.execute("DELETE FROM gen_cache WHERE created_at<?", (now - GEN_CACHE_TTL_HOURS * 3600,))
+        await db.execute(
+            "DELETE FROM gen_cache WHERE key IN (SELECT key FROM gen_cache ORDER BY last_hit DESC LIMIT -1 OFFSET ?)",
+            (GEN_CACHE_SIZE,),
+        )
 
-async def generate_image_bytes(image_prompt: str) -> Tuple[Optional[bytes], Optional[str]]:
+async def _chat_once(messages: List[Dict[str, str]], timeout: float) -> str:
+    started = time_monotonic()
+    with metrics.timer("openai", "chat"):
+        resp = await get_oai().chat.completions.create(
+            model=GEN_MODEL,
+            messages=messages,
+            temperature=GEN_TEMPERATURE,
+            timeout=timeout,
+        )
+    _latency["chat"].observe(time_monotonic() - started)
+    metrics.add_usage(resp.usage)
+    return resp.choices[0].message.content
+
+async def _open_stream(messages: List[Dict[str, str]], timeout: float):
+    """Открывает stream и ждёт первый кусок → (stream, chunk или None для пустого ответа)."""
+    started = time_monotonic()
+    stream = await get_oai().chat.completions.create(
+        model=GEN_MODEL,
+        messages=messages,
+        temperature=GEN_TEMPERATURE,
+        timeout=timeout,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    try:
+        chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        chunk = None
+    except BaseException:
+        await stream.close()
+        raise
+    _latency["chat_first"].observe(time_monotonic() - started)
+    return stream, chunk
+
+async def _stream_once(messages: List[Dict[str, str]], on_partial: Callable[[str], None], hedge: bool,
+                       timeout: float) -> str:
+    with metrics.timer("openai", "chat_stream"):
+        stream, chunk = await hedged(lambda: _open_stream(messages, timeout),
+                                     _latency["chat_first"].hedge_after() if hedge else None, "chat_stream",
+                                     discard=lambda opened: opened[0].close())
+        text = ""
+        try:
+            while chunk is not None:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    on_partial(text)
+                if getattr(chunk, "usage", None):
+                    metrics.add_usage(chunk.usage)
+                chunk = await anext(stream, None)
+        finally:
+            await stream.close()
+    return text
+
+async def generate_post(profile: Dict[str, Any], kind: str, extra: str = "",
+                        on_partial: Optional[Callable[[str], None]] = None, use_cache: bool = True,
+                        hedge: bool = False) -> str:
+    """
+    Генерирует текст поста. С on_partial запрос идёт в режиме stream, и колбэк
+    получает накопленный текст по мере прихода токенов.
+    use_cache=False — всегда свежий вариант (regen, пул, контент-план, автопост).
+    hedge=True — админ ждёт ответа: при долгом ответе шлём дублирующий запрос.
+    Сбой OpenAI (после повторов) → GenerationError.
+    """
+    messages = _gen_messages(profile, kind, extra)
+    key = gen_cache_key(profile, kind, extra) if use_cache else None
+    if key:
+        cached = await gen_cache_get(key)
+        if cached is not None:
+            if on_partial:
+                on_partial(cached)
+            return cached
+    if on_partial is None:
+        attempt = lambda timeout: hedged(lambda: _chat_once(messages, timeout),
+                                         _latency["chat"].hedge_after() if hedge else None, "chat")
+    else:
+        attempt = lambda timeout: _stream_once(messages, on_partial, hedge, timeout)
+    text = await openai_call("text", attempt, OPENAI_TEXT_TIMEOUT, OPENAI_TEXT_DEADLINE)
+    text = (text or "").strip()
+    if key:
+        await gen_cache_put(key, text)
+    return text
+
+def build_batch_prompt(profile: Dict[str, Any], items: List[Tuple[str, str]]) -> str:
+    r = profile_rendered(profile)
+    lines = "\n".join(
+        f'{i}. тип "{kind}"' + (f"; доп. условия: {extra}" if extra else "")
+        for i, (kind, extra) in enumerate(items, 1)
+    )
+    return r["prompt_head"] + f"""
+Задача: Напиши разные посты для Telegram-канала студии ({len(items)} шт.), по одному на каждый пункт:
+{lines}
+Каждый пост — самостоятельный, с разной подачей. В конце каждого добавь хештеги: {r["hashtags"]}.
+Если уместно, вставь явный оффер (но не всегда). Укажи адрес/связь ненавязчиво.
+Ответ — строго JSON без пояснений: {{"posts": [{{"n": 1, "kind": "...", "text": "..."}}, ...]}}, элементов в posts: {len(items)}, в порядке пунктов.
+"""
+
+async def generate_posts_batch(profile: Dict[str, Any], items: List[Tuple[str, str]]) -> List[str]:
+    """
+    Несколько постов (kind, extra) одним запросом со структурированным JSON-ответом:
+    системный промпт и блок профиля оплачиваются один раз. ValueError — если ответ не разобрать.
+    """
+    async def attempt(timeout: float):
+        with metrics.timer("openai", "chat_batch"):
+            return await get_oai().chat.completions.create(
+                model=GEN_MODEL,
+                messages=[
+                    {"role": "system", "content": GEN_SYSTEM},
+                    {"role": "user", "content": build_batch_prompt(profile, items)}
+                ],
+                temperature=GEN_TEMPERATURE,
+                response_format={"type": "json_object"},
+                timeout=timeout,
+            )
+
+    resp = await openai_call("text", attempt, OPENAI_TEXT_TIMEOUT * 2, OPENAI_TEXT_DEADLINE * 2)
+    metrics.add_usage(resp.usage)
+    try:
+        posts = json.loads(resp.choices[0].message.content)["posts"]
+    except (TypeError, KeyError, json.JSONDecodeError) as e:
+        raise ValueError(f"batch response is not valid JSON: {e}") from e
+    if not isinstance(posts, list) or len(posts) != len(items):
+        raise ValueError(f"batch returned {len(posts) if isinstance(posts, list) else '?'} posts, expected {len(items)}")
+    texts = []
+    for post, (kind, _) in zip(posts, items):
+        text = post.get("text") if isinstance(post, dict) else None
+        if not isinstance(text, str) or len(text.strip()) < 50:
+            raise ValueError(f"batch post for {kind!r} is empty or malformed")
+        texts.append(text.strip())
+    return texts
+
+async def generate_posts(profile: Dict[str, Any], items: List[Tuple[str, str]]) -> List[Any]:
+    """
+    Пачка постов: один batch-запрос, а если ответ кривой — по запросу на пост.
+    Возвращает по элементу на пункт: текст или исключение (одна ошибка не рушит остальные).
+    """
+    results: List[Any] = []
+    if len(items) > 1:
+        try:
+            results = await generate_posts_batch(profile, items)
+        except Exception as e:
+            logging.warning("Batch generation of %s posts failed, falling back to single calls: %r", len(items), e)
+    if not results:
+        results = await asyncio.gather(
+            *(generate_post(profile, kind, extra, use_cache=False) for kind, extra in items),
+            return_exceptions=True,
+        )
+    # вся пачка — одним проходом модератора; неприемлемый пост становится ошибкой своего пункта
+    texts = [(i, r) for i, r in enumerate(results) if isinstance(r, str)]
+    for (i, _), term in zip(texts, moderate_many([r for _, r in texts])):
+        if term:
+            metrics.inc("moderation", "generated")
+            results[i] = ModerationError(f"модель написала неприемлемое («{term}»), пост отброшен")
+    return results
+
+async def generate_image_bytes(image_prompt: str, size: str = "1024x1024") -> Tuple[Optional[bytes], Optional[str]]:
     """
     Генерирует PNG через OpenAI Images и возвращает (data, error).
     При 403 (нужна Verify Organization) делаем фолбэк без картинки.
     """
     if not image_prompt:
         return None, None
+
+    async def attempt(timeout: float):
+        with metrics.timer("openai", "image"):
+            return await get_oai().images.generate(
+                model="gpt-image-1",
+                prompt=image_prompt,
+                size=size,
+                timeout=timeout,
+            )
+
     try:
-        img = oai.images.generate(
-            model="gpt-image-1",
-            prompt=image_prompt,
-            size="1024x1024"
-        )
+        img = await openai_call("image", attempt, OPENAI_IMAGE_TIMEOUT, OPENAI_IMAGE_DEADLINE)
         b64 = img.data[0].b64_json
         import base64
         return base64.b64decode(b64), None
-    except PermissionDeniedError as e:
-        return None, (
-            "Нет доступа к модели gpt-image-1: нужна верификация организации на platform.openai.com (Settings → Organization → Verify). "
-            "Сделал фолбэк: публикуем без картинки."
-        )
+    except GenerationError as e:
+        from openai import PermissionDeniedError
+        if isinstance(e.__cause__, PermissionDeniedError):
+            return None, (
+                "Нет доступа к модели gpt-image-1: нужна верификация организации на platform.openai.com (Settings → Organization → Verify). "
+                "Сделал фолбэк: публикуем без картинки."
+            )
+        return None, str(e)
     except Exception as e:
         return None, f"Ошибка генерации изображения: {e}"
 
+# ---------- SIMILAR POSTS ----------
+# Индекс похожих текстов: текст → множество фраз из 3 слов (шинглов) → MinHash-подпись из
+# DUP_BANDS × DUP_ROWS чисел. Подпись режем на полосы, хэш полосы — корзина в dedup_bands:
+# кандидаты — тексты, совпавшие хотя бы в одной корзине (поиск не растёт с историей),
+# сходство оцениваем по доле совпавших чисел подписи. Параметры не менять: подписи в базе станут чужими.
+DUP_SHINGLE = 3
+DUP_BANDS, DUP_ROWS = 16, 4  # порог срабатывания LSH ≈ (1/16)^(1/4) ≈ 0.5
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(2611)
+_MINHASH_PERMS = [
+    (_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(_MINHASH_PRIME))
+    for _ in range(DUP_BANDS * DUP_ROWS)
+]
+_SHINGLE_NOISE_RE = re.compile(r"[#@]\w+|https?://\S+|<[^>]+>")
+
+def _shingles(text: str) -> set:
+    # хештеги, упоминания, ссылки и HTML одинаковы во всех постах — на сходство не влияют
+    words = re.findall(r"\w+", _SHINGLE_NOISE_RE.sub(" ", text.lower()).replace("ё", "е"))
+    if len(words) <= DUP_SHINGLE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + DUP_SHINGLE]) for i in range(len(words) - DUP_SHINGLE + 1)}
+
+@functools.lru_cache(maxsize=512)  # один и тот же текст сначала сравниваем, потом кладём в индекс
+def minhash(text: str) -> Optional[Tuple[int, ...]]:
+    """MinHash-подпись текста (None — в тексте нет слов). Чистый CPU: звать через asyncio.to_thread."""
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "little") for s in _shingles(text)]
+    if not hashes:
+        return None
+    return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PERMS)
+
+def _band_buckets(sig: Tuple[int, ...]) -> List[int]:
+    buckets = []
+    for band in range(DUP_BANDS):
+        part = array.array("Q", [band, *sig[band * DUP_ROWS:(band + 1) * DUP_ROWS]]).tobytes()
+        buckets.append(int.from_bytes(hashlib.blake2b(part, digest_size=8).digest(), "little", signed=True))
+    return buckets
+
+def similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """Оценка коэффициента Жаккара множеств шинглов по двум подписям."""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+@timed("db")
+async def _store_signatures(rows: List[Tuple[str, Tuple[int, ...]]], tenant_id: int):
+    now = datetime.now().isoformat()
+    async with db_tx() as db:
+        for ref, sig in rows:
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO dedup_docs (tenant_id, ref, sig, created_at) VALUES (?, ?, ?, ?)",
+                (tenant_id, ref, array.array("Q", sig).tobytes(), now),
+            )
+            if cur.rowcount:
+                await db.executemany(
+                    "INSERT OR IGNORE INTO dedup_bands (tenant_id, bucket, doc_id) VALUES (?, ?, ?)",
+                    [(tenant_id, bucket, cur.lastrowid) for bucket in _band_buckets(sig)],
+                )
+
+async def index_texts(rows: List[Tuple[str, str]], tenant_id: int = 1):
+    """Кладёт тексты (ref, text) в индекс похожих; ref уже в индексе — пропускаем."""
+    sigs = await asyncio.to_thread(lambda: [(ref, minhash(text)) for ref, text in rows])
+    sigs = [(ref, sig) for ref, sig in sigs if sig]
+    if sigs:
+        await _store_signatures(sigs, tenant_id)
+
+@timed("db")
+async def _similar_candidates(buckets: List[int], tenant_id: int) -> List[Tuple[str, bytes]]:
+    db = await get_db()
+    since = (datetime.now() - timedelta(days=DUP_HISTORY_DAYS)).isoformat()
+    async with db.execute(
+        f"SELECT ref, sig FROM dedup_docs WHERE created_at>=? AND id IN "
+        f"(SELECT doc_id FROM dedup_bands WHERE tenant_id=? AND bucket IN ({','.join('?' * len(buckets))}))",
+        (since, tenant_id, *buckets),
+    ) as cur:
+        return await cur.fetchall()
+
+async def find_similar(text: str, tenant_id: int = 1, exclude: Optional[str] = None) -> Optional[Tuple[str, float]]:
+    """Самый похожий текст из истории студии → (ref, сходство), если сходство не ниже DUP_THRESHOLD."""
+    sig = await asyncio.to_thread(minhash, text)
+    if sig is None:
+        return None
+    best = None
+    for ref, blob in await _similar_candidates(_band_buckets(sig), tenant_id):
+        if ref == exclude:
+            continue
+        sim = similarity(sig, tuple(array.array("Q", blob)))
+        if sim >= DUP_THRESHOLD and (best is None or sim > best[1]):
+            best = (ref, sim)
+    if best:
+        metrics.inc("similar", "found")
+    return best
+
+def moderation_note(text: str) -> str:
+    """Приписка к черновику, если модерация его не пропустит (опубликовать такой не получится)."""
+    term = moderator.check(text)
+    if not term:
+        return ""
+    metrics.inc("moderation", "draft")
+    return f"\n\n<i>⛔️ В тексте неприемлемое выражение («{html.escape(term)}») — опубликовать не выйдет. Жми «🎲 Ещё вариант» или отредактируй.</i>"
+
+def similar_note(match: Optional[Tuple[str, float]]) -> str:
+    """Приписка к черновику для админа (в сам текст поста не попадает)."""
+    if not match:
+        return ""
+    ref, sim = match
+    what = f"черновик #{ref.split(':', 1)[1]}" if ref.startswith("draft:") else "уже опубликованный пост"
+    return f"\n\n<i>⚠️ Похоже на {what} (сходство ~{sim:.0%}). Нужен другой — жми «🎲 Ещё вариант».</i>"
+
+async def backfill_similar_index():
+    """Индексирует историю, которой ещё нет в индексе (первый запуск с индексом), за DUP_HISTORY_DAYS."""
+    since = (datetime.now() - timedelta(days=DUP_HISTORY_DAYS)).isoformat()
+    db = await get_db()
+    async with db.execute(
+        "SELECT tenant_id, 'draft:' || id, text FROM drafts WHERE created_at>=? AND 'draft:' || id NOT IN "
+        "(SELECT ref FROM dedup_docs) "
+        "UNION ALL SELECT tenant_id, 'slot:' || tenant_id || ':' || slot_at, text FROM scheduled_posts "
+        "WHERE status='published' AND created_at>=? AND 'slot:' || tenant_id || ':' || slot_at NOT IN "
+        "(SELECT ref FROM dedup_docs)",
+        (since, since),
+    ) as cur:
+        rows = await cur.fetchall()
+    by_tenant: Dict[int, List[Tuple[str, str]]] = {}
+    for tenant_id, ref, text in rows:
+        by_tenant.setdefault(tenant_id, []).append((ref, text))
+    for tenant_id, docs in by_tenant.items():
+        await index_texts(docs, tenant_id)
+    if rows:
+        logging.info("Similar-posts index: added %s texts from history", len(rows))
+
+# ---------- WARM DRAFT POOL ----------
+# Фоновая задача держит по POOL_SIZE готовых черновиков каждого типа из POOL_KINDS,
+# кнопки забирают их из SQLite без похода в OpenAI. Пул ограничен размером и TTL.
+_pool_wakeup = asyncio.Event()
+
+@timed("db")
+async def take_pooled_draft(kind: str, tenant_id: int = 1) -> Optional[str]:
+    """Забирает свежий черновик нужного типа из пула студии (или None)."""
+    if POOL_SIZE <= 0 or kind not in POOL_KINDS:
+        return None
+    rev = profile_rendered(await get_profile(tenant_id))["rev"]
+    fresh_after = (datetime.now() - timedelta(hours=POOL_TTL_HOURS)).isoformat()
+    async with db_tx() as db:
+        cur = await db.execute(
+            "DELETE FROM draft_pool WHERE id = (SELECT id FROM draft_pool "
+            "WHERE tenant_id=? AND kind=? AND profile_rev=? AND created_at>=? ORDER BY id LIMIT 1) RETURNING text",
+            (tenant_id, kind, rev, fresh_after),
+        )
+        row = await cur.fetchone()
+    _pool_wakeup.set()  # добираем взятое
+    return row[0] if row else None
+
+async def refill_pool():
+    for tenant_id, *_ in await list_tenants():
+        await refill_tenant_pool(tenant_id)
+
+async def refill_tenant_pool(tenant_id: int):
+    prof = await get_profile(tenant_id)
+    rev = profile_rendered(prof)["rev"]
+    fresh_after = (datetime.now() - timedelta(hours=POOL_TTL_HOURS)).isoformat()
+    async with db_tx() as db:
+        await db.execute(
+            "DELETE FROM draft_pool WHERE tenant_id=? AND (profile_rev<>? OR created_at<?)", (tenant_id, rev, fresh_after)
+        )
+        cur = await db.execute("SELECT kind, COUNT(*) FROM draft_pool WHERE tenant_id=? GROUP BY kind", (tenant_id,))
+        have = dict(await cur.fetchall())
+    # похожие на историю заготовки выбрасываем и добираем заново (не больше DUP_REGEN_ATTEMPTS раз)
+    for attempt in range(1 + max(0, DUP_REGEN_ATTEMPTS)):
+        missing = [kind for kind in POOL_KINDS for _ in range(POOL_SIZE - have.get(kind, 0))]
+        dropped = 0
+        # добираем пачками одним запросом, чтобы не занимать слоты OpenAI у интерактивных запросов
+        for i in range(0, len(missing), max(1, PLAN_BATCH_SIZE)):
+            chunk = missing[i:i + max(1, PLAN_BATCH_SIZE)]
+            extra = "" if attempt == 0 else "другая тема и подача, не повторяй недавние посты"
+            results = await generate_posts(prof, [(kind, extra) for kind in chunk])
+            if profile_rendered(await get_profile(tenant_id))["rev"] != rev:
+                return  # профиль поменяли во время генерации — начнём заново
+            now = datetime.now().isoformat()
+            rows = []
+            for kind, text in zip(chunk, results):
+                if isinstance(text, BaseException):
+                    logging.warning("Draft pool: tenant %s: %s generation failed: %r", tenant_id, kind, text)
+                elif await find_similar(text, tenant_id):
+                    dropped += 1
+                    metrics.inc("similar", "pool_dropped")
+                else:
+                    rows.append((tenant_id, kind, text, rev, now))
+                    have[kind] = have.get(kind, 0) + 1
+            async with db_tx() as db:
+                await db.executemany(
+                    "INSERT INTO draft_pool (tenant_id, kind, text, profile_rev, created_at) VALUES (?, ?, ?, ?, ?)", rows
+                )
+        if not dropped:
+            return
+
+async def pool_refill_loop():
+    while True:
+        _pool_wakeup.clear()
+        try:
+            await refill_pool()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Draft pool refill failed")
+        try:
+            # просыпаемся, когда пул тронули, или раз в час — выкинуть протухшее;
+            # соседние процессы нас разбудить не могут, поэтому тогда заглядываем чаще
+            await asyncio.wait_for(_pool_wakeup.wait(), timeout=3600 if WORKER_PROCESSES == 1 else 60)
+        except asyncio.TimeoutError:
+            pass
+
 # ---------- UI ----------
-def post_kb(has_image: bool = False):
+def post_kb(draft_id: int, has_image: bool = False):
+    # в callback_data — id черновика: кнопки под старым сообщением работают с ним, а не с последним
     rows = [
-        [InlineKeyboardButton(text="✅ Утвердить и опубликовать", callback_data="approve")],
-        [InlineKeyboardButton(text="🎲 Ещё вариант текста", callback_data="regen"),
-         InlineKeyboardButton(text="✏️ Править", callback_data="edit")]
+        [InlineKeyboardButton(text="✅ Утвердить и опубликовать", callback_data=f"approve:{draft_id}")],
+        [InlineKeyboardButton(text="🎲 Ещё вариант текста", callback_data=f"regen:{draft_id}"),
+         InlineKeyboardButton(text="✏️ Править", callback_data=f"edit:{draft_id}")]
     ]
     if has_image:
         rows.append([
-            InlineKeyboardButton(text="🖼 Ещё картинка", callback_data="regen_image"),
-            InlineKeyboardButton(text="🗑 Удалить картинку", callback_data="remove_image"),
+            InlineKeyboardButton(text="🖼 Ещё картинка", callback_data=f"regen_image:{draft_id}"),
+            InlineKeyboardButton(text="🗑 Удалить картинку", callback_data=f"remove_image:{draft_id}"),
         ])
     else:
-        rows.append([InlineKeyboardButton(text="🖼 Сгенерировать картинку", callback_data="image")])
+        rows.append([InlineKeyboardButton(text="🖼 Сгенерировать картинку", callback_data=f"image:{draft_id}")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 def main_menu_kb():
@@ -274,22 +1999,140 @@ async def setup_bot_commands():
         BotCommand(command="menu", description="Показать меню"),
         BotCommand(command="setup", description="Настроить профиль"),
         BotCommand(command="draft", description="Сделать черновик"),
-        BotCommand(command="plan_week", description="План на неделю"),
+        BotCommand(command="plan_week", description="План на неделю (days=N — на N дней)"),
         BotCommand(command="schedule", description="Автопост ежедневно"),
         BotCommand(command="status", description="Статус"),
+        BotCommand(command="history", description="История черновиков (kind=, since=)"),
+        BotCommand(command="metrics", description="Метрики и задержки"),
+        BotCommand(command="tenant", description="Студии (для суперадминов)"),
     ])
 
 def only_admin(func):
+    @functools.wraps(func)  # имя хэндлера нужно метрикам
     async def wrapper(event, *args, **kwargs):
         uid = event.from_user.id if isinstance(event, Message) else event.from_user.id
-        if uid not in ADMIN_IDS:
+        tenant_id = await tenant_of(uid)
+        if tenant_id is None:
             return await (event.answer if isinstance(event, Message) else event.message.answer)("Доступ только для администраторов.")
+        # студия, которой управляет админ, — хэндлер получает её как tenant_id
+        kwargs["tenant_id"] = tenant_id
         # Пропускаем в целевой хэндлер только те kwargs, которые он реально принимает (например, command)
         sig = inspect.signature(func)
         allowed_kwargs = {k: v for k, v in kwargs.items() if k in sig.parameters}
         return await func(event, *args, **allowed_kwargs)
     return wrapper
 
+# ---------- DRAFT DELIVERY ----------
+class DraftPreview:
+    """
+    Сообщение-заглушка, которое дописывается по мере генерации.
+    update() только запоминает текст; правки шлёт отдельная задача не чаще
+    раза в STREAM_EDIT_INTERVAL, так что лимиты Telegram на edit не задеваем.
+    """
+
+    def __init__(self, m: Message, title: str):
+        self.m = m
+        self.title = title
+        self.msg: Optional[Message] = None
+        self._text = ""
+        self._shown = ""
+        self._dirty = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.msg = await self.m.answer(f"{self.title}\n\n⏳ Пишу…")
+        self._task = asyncio.create_task(self._edit_loop())
+
+    def update(self, text: str):
+        self._text = text
+        self._dirty.set()
+
+    async def _edit_loop(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            text = self._text
+            if text != self._shown:
+                try:
+                    await self.msg.edit_text(f"{self.title}\n\n{text} ▌")
+                    self._shown = text
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    self._dirty.set()
+                except TelegramBadRequest:
+                    pass  # недописанный HTML или "message is not modified" — дождёмся следующего куска
+            await asyncio.sleep(STREAM_EDIT_INTERVAL)
+
+    async def _stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def finish(self, text: str, reply_markup=None):
+        await self._stop()
+        try:
+            await self.msg.edit_text(f"{self.title}\n\n{text}", reply_markup=reply_markup)
+        except TelegramBadRequest:
+            # не смогли отредактировать — присылаем итог отдельным сообщением
+            await self.m.answer(f"{self.title}\n\n{text}", reply_markup=reply_markup)
+
+    async def fail(self, note: str):
+        await self._stop()
+        try:
+            await self.msg.edit_text(f"{self.title}\n\n{note}")
+        except TelegramBadRequest:
+            pass
+
+async def reply_draft(m: Message, kind: str, extra: str = "", image_prompt: Optional[str] = None,
+                      title: Optional[str] = None, pooled: Optional[bool] = None, fresh: bool = False,
+                      tenant_id: int = 1) -> str:
+    """
+    Делает черновик и отправляет его админу с клавиатурой post_kb: берёт готовый
+    из тёплого пула (по умолчанию — если нет доп. условий) или из кэша генераций,
+    иначе генерирует, показывая текст по мере печати (STREAM_DRAFTS).
+    fresh=True — мимо кэша генераций (кнопка «Ещё вариант»).
+    """
+    title = title or f"<b>Черновик ({kind}):</b>"
+    text = await take_pooled_draft(kind, tenant_id) if (not extra if pooled is None else pooled) else None
+    cached = False
+    if text is None:
+        prof = await get_profile(tenant_id)
+        key = None if fresh else gen_cache_key(prof, kind, extra)
+        text = await gen_cache_get(key) if key else None
+        cached = text is not None
+    if text is None:
+        if STREAM_DRAFTS:
+            preview = DraftPreview(m, title)
+            await preview.start()
+            try:
+                text = await generate_post(prof, kind, extra, on_partial=preview.update, use_cache=False, hedge=True)
+            except GenerationError as e:
+                # причину показываем прямо в заглушке, а не отдельным сообщением
+                await preview.fail(f"Не удалось сгенерировать черновик 😔 {e}")
+                return ""
+            except Exception:
+                await preview.fail("Не удалось сгенерировать черновик 😔 Попробуй ещё раз.")
+                raise
+            if key:
+                await gen_cache_put(key, text)
+            note = moderation_note(text) + similar_note(await find_similar(text, tenant_id))
+            draft_id = await add_draft(kind, text, image_prompt=image_prompt, tenant_id=tenant_id)
+            await preview.finish(text + note, post_kb(draft_id))
+            return text
+        text = await generate_post(prof, kind, extra, use_cache=False, hedge=True)
+        if key:
+            await gen_cache_put(key, text)
+    # админ видит черновик сразу, поэтому похожий не перегенерируем, а помечаем. Текст из кэша генераций
+    # уже лежит в индексе как черновик, с которым его сгенерировали, — сам с собой он «похож» на 100%
+    match = None if cached else await find_similar(text, tenant_id)
+    note = moderation_note(text) + similar_note(match)
+    draft_id = await add_draft(kind, text, image_prompt=image_prompt, tenant_id=tenant_id)
+    await m.answer(f"{title}\n\n{text}{note}", reply_markup=post_kb(draft_id))
+    return text
+
 # ---------- COMMANDS ----------
 @dp.message(Command("start"))
 @only_admin
@@ -311,11 +2154,8 @@ async def _mk_draft(m: Message):
 
 @dp.message(F.text == "Сделать черновик с картинкой")
 @only_admin
-async def _mk_draft_with_img(m: Message):
-    prof = await get_profile()
-    text = await generate_post(prof, "offer", "")
-    await add_draft("offer", text, image_prompt=None, image_bytes=None)
-    await m.answer(f"<b>Черновик (offer):</b>\n\n{text}", reply_markup=post_kb(False))
+async def _mk_draft_with_img(m: Message, tenant_id: int = 1):
+    await reply_draft(m, "offer", tenant_id=tenant_id)
 
 @dp.message(F.text == "План на неделю")
 @only_admin
@@ -329,47 +2169,61 @@ async def _status_btn(m: Message):
 
 @dp.message(F.text == "Автопост выкл/вкл")
 @only_admin
-async def _toggle_autopost(m: Message):
-    cur = await get_daily_time()
-    if cur:
-        await set_daily_time(None); reschedule_daily(None)
+async def _toggle_autopost(m: Message, tenant_id: int = 1):
+    if await get_slots(tenant_id):
+        await remove_slots(tenant_id); await sync_schedule_now()
         await m.answer("Ежедневная автопубликация: выключена")
     else:
         time_str = "10:00"
-        await set_daily_time(time_str); reschedule_daily(time_str)
+        await save_slots({time_str: ALL_DAYS}, tenant_id); await sync_schedule_now()
         await m.answer(f"Ежедневная автопубликация: включена ({time_str})")
 
 
+# ---------- Pending input ----------
+# Ожидание хранится в SQLite, а не в регистрации хэндлера: следующее сообщение
+# может попасть в другой процесс. Стоит раньше текстовых хэндлеров, иначе его перехватит nl_draft_any.
+async def _awaiting_input(m: Message) -> bool:
+    # ожидание бывает только у админов (суперадмины tenant_of тоже находит): остальных отсекаем
+    # по кэшу tenant_of, не трогая базу
+    if m.from_user is None or await tenant_of(m.from_user.id) is None:
+        return False
+    return await get_pending_input(m.from_user.id) is not None
+
+@dp.message(F.text, ~F.text.startswith("/"), _awaiting_input)
+@only_admin
+async def one_shot_publish(m: Message, tenant_id: int = 1):
+    action, _, draft_id = (await pop_pending_input(m.from_user.id) or "").partition(":")
+    if action != "edit":
+        return
+    await publish_to_channel(m.html_text, None, tenant_id=tenant_id)
+    if draft_id.isdigit():
+        await set_draft_status(int(draft_id), "published")
+    await m.answer("Опубликовано ✅")
+
 # ---------- Natural language draft handlers ----------
 @dp.message(F.text.regexp(r"^черновик\s+(.+)$", flags=re.IGNORECASE))
 @only_admin
-async def nl_draft_ru(m: Message):
+async def nl_draft_ru(m: Message, tenant_id: int = 1):
     theme = m.text.split(None, 1)[1].strip()
     if is_nsfw(theme):
         return await m.answer(
             "Не могу сгенерировать такой текст. Давай сформулируем по-спортивному: например, ‘растяжка приводящих мышц’, ‘наклон вперёд в бабочке’, ‘складка’."
         )
-    prof = await get_profile()
     # Привязываем тему к тексту поста и сохраняем её для картинки
     extra = f"Тема поста: {theme}. Отрази тему в тексте."
-    text = await generate_post(prof, "tip", extra)
-    await add_draft("tip", text, image_prompt=theme, image_bytes=None)
-    await m.answer(f"<b>Черновик (tip):</b>\n\n{text}", reply_markup=post_kb(False))
+    await reply_draft(m, "tip", extra, image_prompt=theme, tenant_id=tenant_id)
 
 
 @dp.message(F.text.regexp(r"^draft\s+(.+)$", flags=re.IGNORECASE))
 @only_admin
-async def nl_draft_en(m: Message):
+async def nl_draft_en(m: Message, tenant_id: int = 1):
     theme = m.text.split(None, 1)[1].strip()
     if is_nsfw(theme):
         return await m.answer(
             "I can’t generate explicit content. Please rephrase in a sports/fitness way, e.g., ‘adductor stretch’, ‘seated butterfly forward fold’, ‘hamstring fold’."
         )
-    prof = await get_profile()
     extra = f"Post theme: {theme}. Reflect the theme in the text."
-    text = await generate_post(prof, "tip", extra)
-    await add_draft("tip", text, image_prompt=theme, image_bytes=None)
-    await m.answer(f"<b>Draft (tip):</b>\n\n{text}", reply_markup=post_kb(False))
+    await reply_draft(m, "tip", extra, image_prompt=theme, title="<b>Draft (tip):</b>", tenant_id=tenant_id)
 
 # ---------- Natural language ANY-TEXT → draft ----------
 @dp.message(
@@ -384,26 +2238,24 @@ async def nl_draft_en(m: Message):
     })
 )
 @only_admin
-async def nl_draft_any(m: Message):
+async def nl_draft_any(m: Message, tenant_id: int = 1):
     theme = m.text.strip()
     if is_nsfw(theme):
         return await m.answer(
             "Не могу сгенерировать такой текст. Перефразируй по‑спортивному (например: ‘растяжка приводящих’, ‘наклон в бабочке’, ‘складка’)."
         )
-    prof = await get_profile()
     extra = f"Тема поста: {theme}. Отрази тему в тексте."
-    text = await generate_post(prof, "tip", extra)
-    await add_draft("tip", text, image_prompt=theme, image_bytes=None)
-    await m.answer(f"<b>Черновик (tip):</b>\n\n{text}", reply_markup=post_kb(False))
+    await reply_draft(m, "tip", extra, image_prompt=theme, tenant_id=tenant_id)
 
 @dp.message(Command("setup"))
 @only_admin
-async def setup_cmd(m: Message, command: CommandObject):
+async def setup_cmd(m: Message, command: CommandObject, tenant_id: int = 1):
     """
     Пример:
     /setup name=StavFitness; address=ул. Пирогова 15/2, 3 этаж; phone=+7988...; services=пилатес,стрейчинг; hashtags=#пилатес,#стрейчинг; offers=Скидка 10%,Пробная; tone=дружелюбно
     """
-    prof = await get_profile()
+    # копия: закэшированный профиль меняем только через set_profile
+    prof = dict(await get_profile(tenant_id))
     if command.args:
         # парсим key=value; key=value; ...
         pairs = [p.strip() for p in command.args.split(";") if p.strip()]
@@ -414,7 +2266,7 @@ async def setup_cmd(m: Message, command: CommandObject):
                     prof[k] = [x.strip() for x in re.split(r"[;,]", v) if x.strip()]
                 else:
                     prof[k] = v
-    await set_profile(prof)
+    await set_profile(prof, tenant_id)
     pretty = textwrap.dedent(f"""
     Профиль сохранён:
     • name: {prof['name']}
@@ -429,11 +2281,10 @@ async def setup_cmd(m: Message, command: CommandObject):
 
 @dp.message(Command("draft"))
 @only_admin
-async def draft_cmd(m: Message, command: CommandObject):
+async def draft_cmd(m: Message, command: CommandObject, tenant_id: int = 1):
     """
     /draft kind=offer|tip|schedule|motivation|review|news; extra=про новую группу по пилатесу
     """
-    prof = await get_profile()
     kind = "offer"
     extra = ""
     if command.args:
@@ -448,137 +2299,698 @@ async def draft_cmd(m: Message, command: CommandObject):
     theme = extra if extra else ""
     if 'theme' in locals() and theme and is_nsfw(theme):
         return await m.answer("Тема содержит неприемлемые выражения. Перефразируй в спортивных терминах (например: ‘растяжка приводящих’, ‘наклон в бабочке’, ‘складка’).")
-    text = await generate_post(prof, kind, extra)
-    await add_draft(kind, text, image_prompt=(extra or None), image_bytes=None)
-    await m.answer(f"<b>Черновик ({kind}):</b>\n\n{text}", reply_markup=post_kb(False))
+    await reply_draft(m, kind, extra, image_prompt=(extra or None), tenant_id=tenant_id)
+
+SCHEDULE_USAGE = (
+    "Формат:\n"
+    "/schedule 10:00 18:00 — ежедневно в эти часы (остальные слоты убрать)\n"
+    "/schedule add 12:00 days=пн-пт — добавить слот или поменять ему дни\n"
+    "/schedule del 12:00 — убрать слот\n"
+    "/schedule off — выключить автопост\n"
+    "/schedule plan пн=offer,tip сб=review — типы постов по дням (i-й слот дня — i-й тип)\n"
+    "/schedule plan reset — план по умолчанию"
+)
+
+def _parse_hhmm(raw: str) -> Optional[str]:
+    m = re.fullmatch(r"(\d{1,2}):(\d{2})", raw)
+    if not m or int(m.group(1)) > 23 or int(m.group(2)) > 59:
+        return None
+    return f"{int(m.group(1)):02d}:{m.group(2)}"
+
+def _parse_days(raw: str) -> Optional[str]:
+    """'пн-пт,сб' → '012345'; None — не разобрали."""
+    days = set()
+    for part in raw.lower().split(","):
+        first, _, last = part.strip().partition("-")
+        if first not in WEEKDAYS or (last and last not in WEEKDAYS):
+            return None
+        a, b = WEEKDAYS.index(first), WEEKDAYS.index(last or first)
+        days.update(range(a, b + 1) if a <= b else [*range(a, 7), *range(0, b + 1)])
+    return "".join(str(d) for d in sorted(days))
+
+async def _schedule_text(tenant_id: int) -> str:
+    slots = await get_slots(tenant_id)
+    plan = await get_kind_plan(tenant_id)
+    lines = [f"Слоты: {format_slots(slots) or 'нет'}", "План типов:"]
+    lines += [f"• {WEEKDAYS[d]}: {', '.join(plan[d])}" for d in range(7)]
+    return "\n".join(lines)
 
 @dp.message(Command("schedule"))
 @only_admin
-async def schedule_cmd(m: Message, command: CommandObject):
+async def schedule_cmd(m: Message, command: CommandObject, tenant_id: int = 1):
     """
-    /schedule 10:00  — ежедневная автопубликация
-    /schedule off     — выключить
+    /schedule                    — слоты и план типов
+    /schedule 10:00 18:00        — ежедневная автопубликация в эти часы
+    /schedule add 12:00 days=пн-пт, /schedule del 12:00, /schedule off
+    /schedule plan пн=offer,tip  — типы постов по дням недели
     """
     if not command.args:
-        hhmm = await get_daily_time()
-        return await m.answer(f"Текущее расписание: {hhmm or 'нет'}")
-    arg = command.args.strip().lower()
-    if arg == "off":
-        await set_daily_time(None)
-        reschedule_daily(None)
+        return await m.answer(await _schedule_text(tenant_id) + "\n\n" + SCHEDULE_USAGE)
+    action, *rest = command.args.strip().lower().split()
+    if action == "off":
+        await remove_slots(tenant_id)
+        await sync_schedule_now()
         return await m.answer("Ежедневная автопубликация выключена.")
-    if not re.match(r"^\d{2}:\d{2}$", arg):
-        return await m.answer("Укажи время в формате HH:MM (напр. 10:00)")
-    await set_daily_time(arg)
-    reschedule_daily(arg)
-    await m.answer(f"Готово. Буду публиковать ежедневно в {arg}.")
+    if action == "plan":
+        if rest == ["reset"]:
+            await set_kind_plan({}, tenant_id)
+            return await m.answer("План типов сброшен.\n\n" + await _schedule_text(tenant_id))
+        plan: Dict[int, List[str]] = {}
+        for part in rest:
+            day, _, kinds = part.partition("=")
+            days = _parse_days(day)
+            kinds_list = [k for k in kinds.split(",") if k]
+            if not days or not kinds_list or any(k not in KINDS_CYCLE for k in kinds_list):
+                return await m.answer(f"Не понял «{html.escape(part)}». Типы: {', '.join(KINDS_CYCLE)}.\n\n{SCHEDULE_USAGE}")
+            plan.update({int(d): kinds_list for d in days})
+        if not plan:
+            return await m.answer(SCHEDULE_USAGE)
+        await set_kind_plan(plan, tenant_id)
+        return await m.answer("Готово.\n\n" + await _schedule_text(tenant_id))
+    if action in ("add", "del"):
+        hhmms = [_parse_hhmm(p) for p in rest if not p.startswith("days=")]
+        if not hhmms or None in hhmms:
+            return await m.answer("Укажи время в формате HH:MM (напр. 10:00)\n\n" + SCHEDULE_USAGE)
+        if action == "del":
+            removed = await remove_slots(tenant_id, hhmms)
+            await sync_schedule_now()
+            return await m.answer(f"Убрано слотов: {removed}.\n\n" + await _schedule_text(tenant_id))
+        days = next((_parse_days(p[5:]) for p in rest if p.startswith("days=")), ALL_DAYS)
+        if not days:
+            return await m.answer("Дни — через запятую или диапазоном: days=пн,ср,пт или days=пн-пт")
+        await save_slots({hhmm: days for hhmm in hhmms}, tenant_id)
+        await sync_schedule_now()
+        return await m.answer("Готово.\n\n" + await _schedule_text(tenant_id))
+    hhmms = [_parse_hhmm(p) for p in (action, *rest)]
+    if None in hhmms:
+        return await m.answer("Укажи время в формате HH:MM (напр. 10:00)\n\n" + SCHEDULE_USAGE)
+    await save_slots({hhmm: ALL_DAYS for hhmm in hhmms}, tenant_id, replace=True)
+    await sync_schedule_now()
+    await m.answer(f"Готово. Буду публиковать ежедневно в {', '.join(sorted(hhmms))}.")
+
+PLAN_KINDS = ["offer", "tip", "schedule", "motivation", "review", "news", "tip"]
 
 @dp.message(Command("plan_week"))
 @only_admin
-async def plan_week_cmd(m: Message, command: CommandObject):
-    prof = await get_profile()
-    kinds = ["offer", "tip", "schedule", "motivation", "review", "news", "tip"]
-    await m.answer("Генерю 7 черновиков на неделю…")
-    for k in kinds:
-        text = await generate_post(prof, k, "")
-        await add_draft(k, text, image_prompt=None, image_bytes=None)
-        await m.answer(f"<b>Черновик ({k}):</b>\n\n{text}", reply_markup=post_kb(False))
+async def plan_week_cmd(m: Message, command: CommandObject, tenant_id: int = 1):
+    """
+    /plan_week           — 7 черновиков на неделю
+    /plan_week days=30   — контент-план на N дней (до PLAN_MAX_DAYS)
+    """
+    days = 7
+    if command.args:
+        mt = re.search(r"days\s*=\s*(\d+)", command.args)
+        if not mt:
+            return await m.answer("Формат: /plan_week или /plan_week days=30")
+        days = max(1, min(int(mt.group(1)), PLAN_MAX_DAYS))
+    prof = await get_profile(tenant_id)
+    kinds = [PLAN_KINDS[i % len(PLAN_KINDS)] for i in range(days)]
+    await m.answer(f"Генерю {days} черновиков…" if days != 7 else "Генерю 7 черновиков на неделю…")
+
+    # Дни режем на пачки по PLAN_BATCH_SIZE (одна пачка — один запрос к модели), пачки
+    # генерируем параллельно (не больше PLAN_CONCURRENCY за раз) и отдаём черновики по мере готовности
+    slots = asyncio.Semaphore(max(1, PLAN_CONCURRENCY))
+    batch = max(1, PLAN_BATCH_SIZE)
+    plan = list(enumerate(kinds, 1))
+
+    async def _chunk(part: List[Tuple[int, str]]) -> List[Any]:
+        # для планов длиннее недели просим разную подачу, иначе одинаковые типы повторяются
+        items = [
+            (kind, f"день {day} из {days} контент-плана, не повторяй подачу других дней" if days > len(PLAN_KINDS) else "")
+            for day, kind in part
+        ]
+        async with slots:
+            return await generate_posts(prof, items)
+
+    tasks = {asyncio.create_task(_chunk(plan[i:i + batch])): plan[i:i + batch] for i in range(0, days, batch)}
+    pending = set(tasks)
+    failed = 0
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            ready = []
+            for t in sorted(done, key=lambda t: tasks[t][0][0]):
+                part = tasks[t]
+                results = [t.exception()] * len(part) if t.exception() is not None else t.result()
+                for (day, k), res in zip(part, results):
+                    if isinstance(res, BaseException):
+                        failed += 1
+                        logging.warning("plan_week: day %s (%s) failed: %r", day, k, res)
+                        await m.answer(f"Не удалось сгенерировать черновик ({k}), день {day}: {res}")
+                        continue
+                    ready.append((day, k, res))
+            # всё, что успело догенериться одновременно, пишем одной транзакцией
+            ids = await add_drafts([(k, text, None) for _, k, text in ready], tenant_id)
+            for (day, k, text), draft_id in zip(ready, ids):
+                # сравниваем и с днями этого же плана — они уже в индексе
+                note = similar_note(await find_similar(text, tenant_id, exclude=f"draft:{draft_id}"))
+                # черновики приходят не по порядку, поэтому подписываем день
+                await m.answer(f"<b>Черновик ({k}) — день {day}:</b>\n\n{text}{note}", reply_markup=post_kb(draft_id))
+    finally:
+        for t in pending:
+            t.cancel()
+    if failed:
+        await m.answer(f"Готово: {days - failed} из {days}. Ошибок: {failed}.")
 
 @dp.message(Command("status"))
 @only_admin
-async def status_cmd(m: Message, command: CommandObject):
-    prof = await get_profile()
-    hhmm = await get_daily_time()
+async def status_cmd(m: Message, command: CommandObject, tenant_id: int = 1):
+    prof = await get_profile(tenant_id)
+    slots = await get_slots(tenant_id)
+    tenant = await get_tenant(tenant_id)
     await m.answer(
         textwrap.dedent(f"""
         Статус:
-        • Канал: {CHANNEL_ID}
-        • Автопост: {hhmm or 'выкл'}
+        • Студия в боте: №{tenant_id} ({tenant['name'] if tenant else '—'})
+        • Каналы: {', '.join(await tenant_channels(tenant_id)) or 'не заданы'}
+        • Автопост: {format_slots(slots) or 'выкл'}
         • Студия: {prof['name']} | Тон: {prof['tone']}
         • Хэштеги: {' '.join(prof['hashtags'])}
+        • Кэш генераций: {gen_cache_stats['hits']} попаданий / {gen_cache_stats['misses']} промахов
+        • Процесс: {INSTANCE_ID}{' (лидер)' if _is_leader else ''}
         """).strip()
     )
 
+@dp.message(Command("metrics"))
+@only_admin
+async def metrics_cmd(m: Message, command: CommandObject):
+    text = html.escape(metrics.render_text())
+    # длинный отчёт режем под лимит сообщения Telegram
+    await m.answer(f"<pre>{text[:3900]}</pre>")
+
+HISTORY_USAGE = "Формат: /history kind=tip since=2026-05-01 (или since=7d, since=12h) limit=20"
+
+@dp.message(Command("history"))
+@only_admin
+async def history_cmd(m: Message, command: CommandObject, tenant_id: int = 1):
+    """
+    /history                           — последние 20 черновиков (и архивных)
+    /history kind=tip since=7d limit=30 — по типу и с даты (YYYY-MM-DD, Nd, Nh)
+    """
+    opts = dict(re.findall(r"(\w+)\s*=\s*(\S+)", command.args or ""))
+    since = opts.get("since")
+    if since:
+        mt = re.fullmatch(r"(\d+)([dh])", since)
+        if mt:
+            delta = timedelta(days=int(mt.group(1))) if mt.group(2) == "d" else timedelta(hours=int(mt.group(1)))
+            since = (datetime.now() - delta).isoformat()
+        else:
+            try:
+                since = datetime.fromisoformat(since).isoformat()
+            except ValueError:
+                return await m.answer(HISTORY_USAGE)
+    limit = max(1, min(int(opts["limit"]) if opts.get("limit", "").isdigit() else 20, 30))
+    rows = await draft_history(tenant_id, opts.get("kind"), since, limit)
+    if not rows:
+        return await m.answer("Ничего не нашёл. " + HISTORY_USAGE)
+    lines = []
+    for draft_id, kind, status, created_at, text, archived in rows:
+        snippet = re.sub(r"<[^>]+>|\s+", " ", text or "").strip()
+        snippet = snippet[:80] + ("…" if len(snippet) > 80 else "")
+        mark = "✅" if status == "published" else "📝"
+        lines.append(f"{mark} #{draft_id} · {(created_at or '')[:16].replace('T', ' ')} · {kind}"
+                     f"{' · архив' if archived else ''}\n{html.escape(snippet)}")
+    await m.answer("\n\n".join(lines))
+
+TENANT_USAGE = (
+    "/tenant — список студий\n"
+    "/tenant add Название; channels=@канал,-100123; admins=123,456 — новая студия\n"
+    "/tenant set 3; name=…; channels=…; admins=… — поменять студию (admins переводятся в неё)\n"
+    "/tenant use 3 — переключиться на студию"
+)
+
+@dp.message(Command("tenant"))
+async def tenant_cmd(m: Message, command: CommandObject):
+    """Управление студиями — только для суперадминов из ADMIN_IDS."""
+    if m.from_user.id not in ADMIN_IDS:
+        return await m.answer("Только для суперадминов.")
+    args = (command.args or "").strip()
+    if not args:
+        current = await tenant_of(m.from_user.id)
+        lines = [
+            f"{'▶️' if tid == current else '•'} №{tid} {html.escape(name)} — каналы: {html.escape(ch) or 'нет'}, "
+            f"автопост: {hhmm or 'выкл'}, админов: {admins}"
+            for tid, name, ch, hhmm, admins in await list_tenants()
+        ]
+        return await m.answer("Студии:\n" + "\n".join(lines) + "\n\n" + TENANT_USAGE)
+    action, _, rest = args.partition(" ")
+    parts = [p.strip() for p in rest.split(";") if p.strip()]
+    head = next((p for p in parts if "=" not in p), "")
+    opts = {k.strip(): v.strip() for k, _, v in (p.partition("=") for p in parts if "=" in p)}
+    channels = _parse_ids(opts["channels"]) if "channels" in opts else None
+    admins = [int(x) for x in _parse_ids(opts.get("admins", "")) if x.isdigit()]
+    if action == "add":
+        if not head:
+            return await m.answer("Формат: /tenant add Название; channels=@канал; admins=123")
+        tenant_id = await add_tenant(head, channels or [], admins)
+        return await m.answer(
+            f"Студия №{tenant_id} «{html.escape(head)}» создана. Профиль — по умолчанию: "
+            f"/tenant use {tenant_id}, затем /setup."
+        )
+    if action in ("set", "use"):
+        if not head.isdigit() or not await get_tenant(int(head)):
+            return await m.answer("Нет студии с таким номером. Список — /tenant")
+        tenant_id = int(head)
+        if action == "use":
+            await set_tenant_admins(tenant_id, [m.from_user.id])
+            return await m.answer(f"Теперь ты управляешь студией №{tenant_id}. /status — что там.")
+        if tenant_id == 1 and (channels is not None or admins):
+            return await m.answer("Каналы и админов первой студии задают CHANNEL_ID и ADMIN_IDS в .env.")
+        await update_tenant(tenant_id, name=opts.get("name"), channels=channels)
+        await set_tenant_admins(tenant_id, admins)
+        return await m.answer(f"Студия №{tenant_id} обновлена.")
+    await m.answer(TENANT_USAGE)
+
+# ---------- IMAGE JOBS ----------
+# Картинка рисуется десятки секунд, поэтому кнопка только ставит задачу: IMAGE_VARIANTS вариантов
+# рендерятся параллельно, прогресс и «Отменить» — в одном сообщении, готовые варианты приходят
+# альбомом, а под ним — кнопки «Вариант N». Отмена из другого процесса видна через image_jobs.status.
+_image_tasks: Dict[int, asyncio.Task] = {}
+
+def image_job_kb(job_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✖️ Отменить", callback_data=f"img_cancel:{job_id}")]
+    ])
+
+def image_pick_kb(draft_id: int, variant_ids: List[int]):
+    buttons = [InlineKeyboardButton(text=f"✅ {i}", callback_data=f"img_use:{vid}")
+               for i, vid in enumerate(variant_ids, 1)]
+    rows = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+    rows.append([InlineKeyboardButton(text="🔁 Другие варианты", callback_data=f"regen_image:{draft_id}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def _image_progress_text(done: int, total: int) -> str:
+    return f"🎨 Рисую варианты картинки: {done}/{total}\n" + "▰" * done + "▱" * (total - done)
+
+async def start_image_job(m: Message, draft_id: int, image_prompt: str, tenant_id: int = 1):
+    prof = await get_profile(tenant_id)
+    img_prompt = build_image_prompt(prof, image_prompt)
+    if image_prompt and is_nsfw(image_prompt):
+        return await m.answer("Тема черновика содержит неприемлемые формулировки для изображения. Перефразируй, и попробуем снова.")
+    aspect = parse_aspect(profile_rendered(prof)["aspect"])
+    job_id = await create_image_job(draft_id, img_prompt, tenant_id)
+    if job_id is None:
+        return await m.answer("Картинки для этого черновика уже рисуются — дождись вариантов или отмени.")
+    try:
+        progress = await m.answer(_image_progress_text(0, IMAGE_VARIANTS), reply_markup=image_job_kb(job_id))
+    except Exception:
+        await finish_image_job(job_id, "failed")
+        raise
+    task = asyncio.create_task(run_image_job(job_id, draft_id, img_prompt, aspect, progress))
+    _image_tasks[job_id] = task
+    task.add_done_callback(lambda _: _image_tasks.pop(job_id, None))
+    return progress
+
+async def _watch_image_job(job_id: int, msg: Message, state: Dict[str, int], job: asyncio.Task):
+    """Обновляет прогресс (не чаще STREAM_EDIT_INTERVAL) и замечает отмену из другого процесса."""
+    shown = 0
+    while True:
+        await asyncio.sleep(max(STREAM_EDIT_INTERVAL, 0.1))
+        if await get_image_job_status(job_id) == "cancelled":
+            job.cancel()
+            return
+        if state["done"] != shown:
+            shown = state["done"]
+            try:
+                await msg.edit_text(_image_progress_text(shown, IMAGE_VARIANTS), reply_markup=image_job_kb(job_id))
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest:
+                pass
+
+async def run_image_job(job_id: int, draft_id: int, img_prompt: str, aspect: Tuple[int, int], msg: Message):
+    size = generation_size(aspect)
+    state = {"done": 0}
+    errors: List[str] = []
+
+    async def render(n: int) -> Optional[Tuple[int, str, Optional[str]]]:
+        try:
+            data, err = await generate_image_bytes(img_prompt, size)
+            if not data:
+                errors.append(err or "пустой ответ модели")
+                return None
+            ref, thumb_ref = await store_processed_image(data, aspect)
+            return n, ref, thumb_ref
+        except Exception as e:
+            # один сломанный вариант не роняет остальные
+            logging.exception("Image job %s: variant %s failed", job_id, n)
+            errors.append(f"Ошибка обработки изображения: {e}")
+            return None
+        finally:
+            state["done"] += 1
+
+    watcher = asyncio.create_task(_watch_image_job(job_id, msg, state, asyncio.current_task()))
+    try:
+        with metrics.timer("job", "image"):
+            results = await asyncio.gather(*(render(n) for n in range(1, IMAGE_VARIANTS + 1)))
+    except asyncio.CancelledError:
+        # «Отменить» или остановка процесса: недорисованные варианты gather уже отменил
+        await finish_image_job(job_id, "cancelled")
+        try:
+            await msg.edit_text("Генерация картинки отменена.")
+        except Exception:
+            pass
+        raise
+    finally:
+        watcher.cancel()
+
+    ready = [r for r in results if r]
+    if not ready:
+        await finish_image_job(job_id, "failed")
+        reason = errors[0] if errors else "Не удалось сгенерировать изображение"
+        return await msg.edit_text("Не удалось сгенерировать картинку:\n\n" + reason)
+    variant_ids = await add_image_variants(job_id, ready)
+    if not await finish_image_job(job_id, "done"):
+        return  # отменили, пока сохраняли
+    note = f" (не получилось: {len(errors)})" if errors else ""
+    if len(ready) == 1:
+        n, ref, thumb_ref = ready[0]
+        await bot.send_photo(msg.chat.id, image_input(thumb_ref or ref, "variant.jpg"),
+                             caption="Вариант картинки" + note, reply_markup=image_pick_kb(draft_id, variant_ids))
+    else:
+        await bot.send_media_group(msg.chat.id, [
+            InputMediaPhoto(media=image_input(thumb_ref or ref, f"variant{i}.jpg"), caption=str(i))
+            for i, (n, ref, thumb_ref) in enumerate(ready, 1)
+        ])
+        await bot.send_message(msg.chat.id, "Какой вариант ставим в черновик?" + note,
+                               reply_markup=image_pick_kb(draft_id, variant_ids))
+    try:
+        await msg.delete()
+    except Exception:
+        pass
+
+@dp.callback_query(F.data.regexp(r"^img_(use|cancel):\d+$"))
+async def on_image_cb(q: CallbackQuery):
+    tenant_id = await tenant_of(q.from_user.id)
+    if tenant_id is None:
+        return await q.answer("Только админ.", show_alert=True)
+    action, _, raw_id = q.data.partition(":")
+    if action == "img_cancel":
+        job_id = int(raw_id)
+        if not await finish_image_job(job_id, "cancelled", tenant_id):
+            return await _safe_cb_answer(q, "Генерация уже закончилась.")
+        task = _image_tasks.get(job_id)
+        if task:
+            task.cancel()  # в другом процессе задачу остановит его _watch_image_job
+        return await _safe_cb_answer(q, "Отменяю…")
+
+    variant = await get_image_variant(int(raw_id), tenant_id)
+    if not variant:
+        return await _safe_cb_answer(q, "Вариант не найден.", show_alert=True)
+    draft_id, ref, thumb_ref, img_prompt = variant
+    await _safe_cb_answer(q, "⏳ Ставлю картинку…")
+    async with draft_lock(draft_id):
+        draft = await get_draft(draft_id, tenant_id)
+        if not draft:
+            return await q.message.answer("Черновик не найден.")
+        if draft[6] == "published":
+            return await q.message.answer("Этот черновик уже опубликован.")
+        await set_draft_image(draft_id, ref, img_prompt, thumb_ref)
+        preview = await q.message.answer_photo(photo=image_input(ref, "preview.jpg"), caption=draft[2],
+                                               reply_markup=post_kb(draft_id, True))
+        await set_draft_file_id(draft_id, _photo_file_id(preview))
+        return preview
+
 # ---------- CALLBACKS ----------
-@dp.callback_query(F.data.in_({"approve","regen","edit","image","regen_image","remove_image"}))
+DRAFT_ACTIONS = ("approve", "regen", "edit", "image", "regen_image", "remove_image")
+# Кнопки одного черновика выполняются по очереди (двойной тап, картинка во время публикации),
+# разные черновики — параллельно. Лок живёт, пока его кто-то держит или ждёт.
+_draft_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def draft_lock(draft_id: int) -> asyncio.Lock:
+    lock = _draft_locks.get(draft_id)
+    if lock is None:
+        lock = _draft_locks[draft_id] = asyncio.Lock()
+    return lock
+
+@dp.callback_query(F.data.regexp(rf"^({'|'.join(DRAFT_ACTIONS)})(:\d+)?$"))
 async def on_cb(q: CallbackQuery):
-    if q.from_user.id not in ADMIN_IDS:
+    tenant_id = await tenant_of(q.from_user.id)
+    if tenant_id is None:
         return await q.answer("Только админ.", show_alert=True)
-    draft = await get_latest_draft()
+    action, _, raw_id = q.data.partition(":")
+    if not raw_id:
+        # клавиатура из старой версии бота — не знаем, к какому черновику она относится
+        return await _safe_cb_answer(q, "Кнопка устарела — сделай черновик заново.", show_alert=True)
+    draft_id = int(raw_id)
+    draft = await get_draft(draft_id, tenant_id)
     if not draft:
-        return await q.message.answer("Нет черновика.")
-    draft_id, kind, text, image_prompt, image_bytes = draft
+        return await _safe_cb_answer(q, "Черновик не найден.", show_alert=True)
 
     # Immediately answer the callback to avoid timeout
     await _safe_cb_answer(q, "⏳ Обрабатываю…")
 
-    if q.data == "approve":
-        await publish_to_channel(text, image_bytes if image_bytes else None)
-        return await q.message.answer("Опубликовано ✅")
-
-    if q.data == "regen":
-        prof = await get_profile()
-        new_text = await generate_post(prof, kind, "сделай другой угол и подачу")
-        await add_draft(kind, new_text, image_prompt=None, image_bytes=None)
-        return await q.message.answer(f"<b>Черновик ({kind}) — новый вариант:</b>\n\n{new_text}", reply_markup=post_kb(False))
+    if action == "regen":
+        # черновик не меняется — лок не нужен; заготовка из пула — тоже другой вариант того же типа
+        kind = draft[1]
+        await reply_draft(q.message, kind, "сделай другой угол и подачу",
+                          title=f"<b>Черновик ({kind}) — новый вариант:</b>", pooled=True, fresh=True,
+                          tenant_id=tenant_id)
+        return
 
-    if q.data == "edit":
+    async with draft_lock(draft_id):
+        # пока ждали лок, черновик могли опубликовать или сменить картинку — перечитываем
+        _, kind, text, image_prompt, image_ref, image_file_id, status = await get_draft(draft_id, tenant_id)
+        if status == "published":
+            return await q.message.answer("Этот черновик уже опубликован.")
+        return await _draft_action(q, action, tenant_id, draft_id, kind, text, image_prompt, image_ref, image_file_id)
+
+async def _draft_action(q: CallbackQuery, action: str, tenant_id: int, draft_id: int, kind: str, text: str,
+                        image_prompt: str, image_ref: Optional[str], image_file_id: Optional[str]):
+    if action == "approve":
+        if not await tenant_channels(tenant_id):
+            return await q.message.answer("У студии не заданы каналы — их добавляет суперадмин: /tenant set.")
+        # условный UPDATE: из другого процесса тот же черновик второй раз не пройдёт
+        if not await set_draft_status(draft_id, "published", expect="draft"):
+            return await q.message.answer("Этот черновик уже опубликован.")
+        try:
+            queued = await publish_to_channel(text, image_ref, image_file_id, source=f"draft:{draft_id}",
+                                              draft_id=draft_id, tenant_id=tenant_id)
+        except Exception:
+            await set_draft_status(draft_id, "draft")
+            raise
+        if not queued:
+            return await q.message.answer("Этот черновик уже опубликован.")
+        return await q.message.answer(f"Опубликовано ✅ (каналов: {queued})")
+
+    if action == "edit":
+        await set_pending_input(q.from_user.id, f"edit:{draft_id}")
         await q.message.answer("Пришли новый текст одним сообщением. Я опубликую его.")
-        dp.message.register(one_shot_publish)
         return
 
-    if q.data == "image":
-        prof = await get_profile()
-        theme_text = f" Тема: {image_prompt}." if image_prompt else ""
-        img_prompt = (
-            f"Фитнес-студия {prof['name']}. Стиль: {prof['image_style']}. "
-            f"Акцент: {', '.join(prof['services'][:2])}." + theme_text
-        )
-        if image_prompt and is_nsfw(image_prompt):
-            return await q.message.answer("Тема черновика содержит неприемлемые формулировки для изображения. Перефразируй, и попробуем снова.")
-        data, err = await generate_image_bytes(img_prompt)
-        if err:
-            return await q.message.answer("Не удалось добавить картинку:\n\n" + err)
-        if not data:
-            return await q.message.answer("Не удалось сгенерировать изображение")
-        await set_draft_image(draft_id, data, img_prompt)
-        return await q.message.answer_photo(photo=BufferedInputFile(data, filename="preview.png"), caption=text, reply_markup=post_kb(True))
-
-    if q.data == "regen_image":
-        prof = await get_profile()
-        theme_text = f" Тема: {image_prompt}." if image_prompt else ""
-        img_prompt = (
-            f"Фитнес-студия {prof['name']}. Стиль: {prof['image_style']}. "
-            f"Акцент: {', '.join(prof['services'][:2])}." + theme_text
-        )
-        if image_prompt and is_nsfw(image_prompt):
-            return await q.message.answer("Тема черновика содержит неприемлемые формулировки для изображения. Перефразируй, и попробуем снова.")
-        data, err = await generate_image_bytes(img_prompt)
-        if err or not data:
-            return await q.message.answer("Не удалось обновить картинку." + (f"\n\n{err}" if err else ""))
-        await set_draft_image(draft_id, data, img_prompt)
-        return await q.message.answer_photo(photo=BufferedInputFile(data, filename="preview.png"), caption=text, reply_markup=post_kb(True))
-
-    if q.data == "remove_image":
-        await set_draft_image(draft_id, None)
-        return await q.message.answer(f"<b>Черновик ({kind}) без картинки:</b>\n\n{text}", reply_markup=post_kb(False))
+    if action in ("image", "regen_image"):
+        if action == "image" and image_ref:
+            # второй тап по «Сгенерировать»: картинка уже сделана, пока ждали лок
+            return await q.message.answer("Картинка уже есть — для другой жми «🖼 Ещё картинка» под превью.")
+        # рендер идёт в фоне, хэндлер (и лок черновика) освобождается сразу
+        return await start_image_job(q.message, draft_id, image_prompt, tenant_id)
 
-async def one_shot_publish(m: Message):
-    # снимаем хэндлер сразу после использования
-    dp.message.unregister(one_shot_publish)
-    await publish_to_channel(m.html_text, None)
-    await m.answer("Опубликовано ✅")
+    if action == "remove_image":
+        await set_draft_image(draft_id, None)
+        return await q.message.answer(f"<b>Черновик ({kind}) без картинки:</b>\n\n{text}", reply_markup=post_kb(draft_id, False))
 
 # ---------- PUBLISH ----------
-async def publish_to_channel(text: str, image_bytes: Optional[bytes]):
-    if image_bytes:
-        await bot.send_photo(
-            chat_id=CHANNEL_ID,
-            photo=BufferedInputFile(image_bytes, filename="post.png"),
+# Публикация не шлёт в Telegram напрямую: пост попадает в очередь outbox (по строке на канал),
+# а воркеры отправляют её с учётом лимитов Telegram, retry_after и ретраев.
+_outbox_wakeup = asyncio.Event()
+
+async def publish_to_channel(text: str, image_ref: Optional[str], image_file_id: Optional[str] = None,
+                             source: Optional[str] = None, draft_id: Optional[int] = None,
+                             targets: Optional[List[str]] = None, tenant_id: int = 1) -> int:
+    """
+    Ставит пост в очередь на все каналы (targets, по умолчанию — каналы студии tenant_id).
+    source — ключ идемпотентности ('draft:12', 'slot:...'): повторный вызов с ним ничего не добавит.
+    Возвращает, сколько отправок реально поставлено. ModerationError — текст не прошёл модерацию.
+    """
+    # последний рубеж: сюда приходят и одобренные черновики, и автопост, и отредактированный админом текст
+    term = moderator.check(text)
+    if term:
+        metrics.inc("moderation", "publish")
+        raise ModerationError(f"Пост не опубликован: в тексте неприемлемое выражение («{term}»). Отредактируй и попробуй снова.")
+    source = source or f"once:{uuid.uuid4().hex}"
+    targets = targets or await tenant_channels(tenant_id)
+    now = datetime.now()
+    async with db_tx() as db:
+        before = db.total_changes
+        await db.executemany(
+            "INSERT OR IGNORE INTO outbox (dedup_key, tenant_id, chat_id, draft_id, text, image_ref, image_file_id, "
+            "next_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(f"{source}:{chat}", tenant_id, chat, draft_id, text, image_ref, image_file_id, now.timestamp(),
+              now.isoformat()) for chat in targets],
+        )
+        queued = db.total_changes - before
+    _outbox_wakeup.set()
+    if queued:
+        # опубликованное — тоже история для поиска похожих (черновик под тем же ref уже там)
+        await index_texts([(source, text)], tenant_id)
+    return queued
+
+async def _send_post(chat_id: str, text: str, image_ref: Optional[str], image_file_id: Optional[str]) -> Message:
+    """
+    Отправляет пост. Картинку шлём по file_id (без повторной загрузки),
+    а если Telegram его не принял — загружаем файл из хранилища.
+    """
+    if image_file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=image_file_id, caption=text)
+        except TelegramBadRequest as e:
+            if not image_ref:
+                raise
+            logging.warning("file_id rejected (%s), uploading image %s", e, image_ref)
+    if image_ref:
+        return await bot.send_photo(
+            chat_id=chat_id,
+            photo=image_input(image_ref, "post.jpg"),
             caption=text
         )
+    return await bot.send_message(chat_id=chat_id, text=text)
+
+def _photo_file_id(msg: Optional[Message]) -> Optional[str]:
+    # самый крупный размер — тот, что мы загрузили
+    if msg is None or not msg.photo:
+        return None
+    return msg.photo[-1].file_id
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity про запас. reserve() → сколько ждать."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time_monotonic()
+
+    def _refill(self):
+        now = time_monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self) -> float:
+        """Сколько ждать до свободного токена (ничего не расходуя)."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1  # уходим в минус: следующие будут ждать дольше
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        # Telegram попросил подождать (retry_after) — обнуляем запас на это время
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+# лимиты Telegram общие на бота — при нескольких процессах каждому достаётся своя доля
+_global_bucket = TokenBucket(TG_GLOBAL_PER_SEC / WORKER_PROCESSES, TG_GLOBAL_PER_SEC / WORKER_PROCESSES)
+_chat_buckets: Dict[str, TokenBucket] = {}
+
+def _chat_bucket(chat_id: str) -> TokenBucket:
+    if chat_id not in _chat_buckets:
+        _chat_buckets[chat_id] = TokenBucket(TG_CHAT_PER_MIN / 60 / WORKER_PROCESSES, 3)
+    return _chat_buckets[chat_id]
+
+@timed("db")
+async def _outbox_claim() -> Optional[Tuple]:
+    async with db_tx() as db:
+        cur = await db.execute(
+            "UPDATE outbox SET status='sending', attempts=attempts+1, claimed_by=? WHERE id = ("
+            "SELECT id FROM outbox WHERE status='queued' AND next_at<=? ORDER BY next_at, id LIMIT 1) "
+            "RETURNING id, tenant_id, chat_id, draft_id, text, image_ref, image_file_id, attempts",
+            (INSTANCE_ID, datetime.now().timestamp()),
+        )
+        return await cur.fetchone()
+
+@timed("db")
+async def _outbox_finish(job_id: int, **fields):
+    cols = ", ".join(f"{k}=?" for k in fields)
+    async with db_tx() as db:
+        await db.execute(f"UPDATE outbox SET {cols} WHERE id=?", (*fields.values(), job_id))
+
+async def _outbox_retry(job: Tuple, e: BaseException):
+    """Попытка не удалась: запись — обратно в очередь с паузой, а после OUTBOX_MAX_ATTEMPTS — в failed."""
+    job_id, tenant_id, chat_id, *_, attempts = job
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        await _outbox_finish(job_id, status="failed", error=repr(e))
+        await _notify_admins(f"Не удалось опубликовать в {chat_id} после {attempts} попыток: {e}", tenant_id)
     else:
-        await bot.send_message(chat_id=CHANNEL_ID, text=text)
+        await _outbox_finish(job_id, status="queued", error=repr(e),
+                             next_at=datetime.now().timestamp() + min(5 * 2 ** attempts, 600))
+
+async def _outbox_deliver(job: Tuple):
+    job_id, tenant_id, chat_id, draft_id, text, image_ref, image_file_id, attempts = job
+    chat_wait = _chat_bucket(chat_id).delay()
+    if chat_wait > 1:
+        # этот чат упёрся в лимит — не держим воркер, вернём запись в очередь ко времени
+        await _outbox_finish(job_id, status="queued", attempts=attempts - 1,
+                             next_at=datetime.now().timestamp() + chat_wait)
+        return
+    wait = max(_global_bucket.reserve(), _chat_bucket(chat_id).reserve())
+    if wait:
+        await asyncio.sleep(wait)
+    try:
+        sent = await _send_post(chat_id, text, image_ref, image_file_id)
+    except TelegramRetryAfter as e:
+        # флуд-контроль: не считаем попыткой, просто переносим
+        _chat_bucket(chat_id).pause(e.retry_after)
+        metrics.inc("outbox", "retry_after")
+        await _outbox_finish(job_id, status="queued", attempts=attempts - 1,
+                             next_at=datetime.now().timestamp() + e.retry_after, error=str(e))
+        return
+    except (TelegramBadRequest, TelegramForbiddenError) as e:
+        # канал не найден, бот не админ, битый текст — ретраи не помогут
+        await _outbox_finish(job_id, status="failed", error=str(e))
+        await _notify_admins(f"Не удалось опубликовать в {chat_id}: {e}", tenant_id)
+        return
+    except Exception as e:
+        await _outbox_retry(job, e)
+        return
+    await _outbox_finish(job_id, status="sent", message_id=sent.message_id, error=None)
+    metrics.inc("outbox", "sent")
+    file_id = _photo_file_id(sent)
+    if image_ref and file_id and file_id != image_file_id:
+        # картинку пришлось загрузить — остальные каналы и повторные публикации пойдут по file_id
+        async with db_tx() as db:
+            await db.execute(
+                "UPDATE outbox SET image_file_id=? WHERE image_ref=? AND status='queued'", (file_id, image_ref)
+            )
+            if draft_id:
+                await db.execute("UPDATE drafts SET image_file_id=? WHERE id=?", (file_id, draft_id))
+
+async def outbox_worker():
+    while True:
+        try:
+            job = await _outbox_claim()
+            if job:
+                try:
+                    await _outbox_deliver(job)
+                except Exception as e:
+                    # упало вне отправки (пауза лимита, запись в базу, уведомление админам) — запись,
+                    # если она ещё «sending», не ждёт рестарта, а идёт по обычному кругу ретраев
+                    logging.exception("Outbox delivery of %s failed", job[0])
+                    row = await db_fetchone("SELECT status FROM outbox WHERE id=?", (job[0],))
+                    if row and row[0] == "sending":
+                        await _outbox_retry(job, e)
+                continue
+            _outbox_wakeup.clear()
+            row = await db_fetchone("SELECT MIN(next_at) FROM outbox WHERE status='queued'")
+            timeout = 30.0 if not row or row[0] is None else max(0.05, min(30.0, row[0] - datetime.now().timestamp()))
+            try:
+                await asyncio.wait_for(_outbox_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Outbox worker error")
+            await asyncio.sleep(5)
+
+async def outbox_recover():
+    # процесс упал посреди отправки — вернём его записи в очередь (у живых воркеров аренда не истекла)
+    async with db_tx() as db:
+        await db.execute(
+            "UPDATE outbox SET status='queued' WHERE status='sending' AND (claimed_by IS NULL OR "
+            "claimed_by NOT IN (SELECT owner FROM leases WHERE name LIKE 'worker:%' AND expires_at>=?))",
+            (datetime.now().timestamp(),),
+        )
 
 
 # ---------- HELPERS ----------
@@ -607,6 +3019,13 @@ class LogUserIdMiddleware(BaseMiddleware):
             logging.debug("LogUserIdMiddleware error: %s", e)
         return await handler(event, data)
 
+async def _notify_admins(text: str, tenant_id: int = 1):
+    for uid in await tenant_admin_ids(tenant_id):
+        try:
+            await bot.send_message(uid, text)
+        except Exception as e:
+            logging.warning("Cannot notify admin %s: %s", uid, e)
+
 # Helper to safely answer callback queries (avoid late answer errors)
 async def _safe_cb_answer(q: CallbackQuery, text: str | None = None, show_alert: bool = False):
     try:
@@ -614,37 +3033,770 @@ async def _safe_cb_answer(q: CallbackQuery, text: str | None = None, show_alert:
     except Exception:
         pass
 
+@dp.errors(ExceptionTypeFilter(GenerationError))
+async def on_generation_error(event: ErrorEvent):
+    # сбой OpenAI после всех повторов — понятный ответ админу вместо трейсбека в логах aiogram
+    logging.warning("Generation failed: %s", event.exception)
+    upd = event.update
+    msg = upd.message or (upd.callback_query.message if upd.callback_query else None)
+    if msg:
+        try:
+            await msg.answer(f"⚠️ {event.exception}")
+        except Exception as e:
+            logging.warning("Cannot report generation error: %s", e)
+    return True
+
 # ---------- SCHEDULER ----------
-def reschedule_daily(hhmm: Optional[str]):
-    # убираем старую задачу
-    for job in scheduler.get_jobs():
-        job.remove()
-    if not hhmm:
+# Автопост по слотам из schedule_slots (несколько в день, по дням недели), тип поста — из плана недели
+# kind_plan. За SCHEDULE_LEAD_MINUTES до слота prepare_scheduled_post генерирует текст (с ретраями)
+# и кладёт его в scheduled_posts, а в саму минуту scheduled_job только публикует.
+# Задачи APScheduler — только будильники: что отработано, помнит schedule_slots.last_slot_at, поэтому
+# лидер после простоя догоняет пропущенный слот — один раз и только последний (SCHEDULE_MISFIRE_GRACE_MIN).
+# План недели по умолчанию: день недели → тип по кругу
+KINDS_CYCLE = ["offer","tip","schedule","motivation","review","news"]
+WEEKDAYS = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+ALL_DAYS = "0123456"
+
+def _sched_now() -> datetime:
+    # время в часовом поясе планировщика (без tzinfo), в нём же храним slot_at
+    return datetime.now(scheduler.timezone).replace(tzinfo=None)
+
+def _slot_key(slot: datetime) -> str:
+    return slot.strftime("%Y-%m-%dT%H:%M")
+
+def _prev_slot(hhmm: str, days: str, now: Optional[datetime] = None) -> Optional[datetime]:
+    """Последний слот не позже now (None — у слота нет дней)."""
+    now = now or _sched_now()
+    h, m = map(int, hhmm.split(":"))
+    slot = now.replace(hour=h, minute=m, second=0, microsecond=0)
+    if slot > now:
+        slot -= timedelta(days=1)
+    for _ in range(7):
+        if str(slot.weekday()) in days:
+            return slot
+        slot -= timedelta(days=1)
+    return None
+
+def _next_slot(hhmm: str, days: str, now: Optional[datetime] = None) -> Optional[datetime]:
+    """Ближайший слот позже now (None — у слота нет дней)."""
+    now = now or _sched_now()
+    h, m = map(int, hhmm.split(":"))
+    slot = now.replace(hour=h, minute=m, second=0, microsecond=0)
+    if slot <= now:
+        slot += timedelta(days=1)
+    for _ in range(7):
+        if str(slot.weekday()) in days:
+            return slot
+        slot += timedelta(days=1)
+    return None
+
+def format_days(days: str) -> str:
+    """'012346' → 'пн-пт,вс'."""
+    runs: List[List[int]] = []
+    for d in map(int, days):
+        if runs and runs[-1][1] == d - 1:
+            runs[-1][1] = d
+        else:
+            runs.append([d, d])
+    return ",".join(WEEKDAYS[a] if a == b else f"{WEEKDAYS[a]}-{WEEKDAYS[b]}" for a, b in runs)
+
+def format_slots(slots: List[Tuple[int, int, str, str, str]]) -> str:
+    return ", ".join(f"{hhmm} ({format_days(days)})" if days != ALL_DAYS else hhmm for _, _, hhmm, days, _ in slots)
+
+_slot_jobs: Dict[int, Tuple[int, str, str]] = {}  # id слота → (студия, hhmm, days), под которые стоят задачи
+
+def _slot_job_ids(slot_id: int) -> Tuple[str, ...]:
+    return (f"slot_post:{slot_id}", f"slot_prepare:{slot_id}", f"slot_prepare_now:{slot_id}", f"slot_catch_up:{slot_id}")
+
+def _unschedule_slot(slot_id: int):
+    for job_id in _slot_job_ids(slot_id):
+        if scheduler.get_job(job_id):
+            scheduler.remove_job(job_id)
+    _slot_jobs.pop(slot_id, None)
+
+def _schedule_slot(slot_id: int, tenant_id: int, hhmm: str, days: str):
+    """Ставит (или переставляет) задачи одного слота; задачи других слотов не трогаем."""
+    _unschedule_slot(slot_id)
+    _slot_jobs[slot_id] = (tenant_id, hhmm, days)
+    if not days:
         return
     h, m = map(int, hhmm.split(":"))
-    trigger = CronTrigger(hour=h, minute=m)
-    scheduler.add_job(func=scheduled_job, trigger=trigger, id="daily_post")
+    # опоздание будильника (занятый event loop) в пределах окна — публикуем; пропущенные подряд — один раз
+    opts = dict(misfire_grace_time=SCHEDULE_MISFIRE_GRACE_MIN * 60, coalesce=True)
+    # часы и дни недели — в поясе планировщика (как _sched_now), а не в поясе хоста
+    tz = scheduler.timezone
+    scheduler.add_job(func=scheduled_job, trigger=CronTrigger(day_of_week=",".join(days), hour=h, minute=m, timezone=tz),
+                      args=[slot_id, tenant_id], id=f"slot_post:{slot_id}", **opts)
+    # подготовка — каждый день: в дни без слота prepare_scheduled_post сам ничего не делает
+    prep = datetime(2000, 1, 1, h, m) - timedelta(minutes=SCHEDULE_LEAD_MINUTES)
+    scheduler.add_job(func=prepare_scheduled_post, trigger=CronTrigger(hour=prep.hour, minute=prep.minute, timezone=tz),
+                      args=[slot_id, tenant_id], id=f"slot_prepare:{slot_id}", **opts)
+    # слот уже внутри окна подготовки (включили автопост впритык или перезапустились) — готовим сразу
+    if _next_slot(hhmm, days) - _sched_now() <= timedelta(minutes=SCHEDULE_LEAD_MINUTES):
+        scheduler.add_job(func=prepare_scheduled_post, args=[slot_id, tenant_id], id=f"slot_prepare_now:{slot_id}")
+
+def unschedule_all():
+    for slot_id in list(_slot_jobs):
+        _unschedule_slot(slot_id)
+
+async def sync_schedules():
+    """
+    Приводит задачи к schedule_slots всех студий одним запросом: ставит новые и изменившиеся слоты,
+    снимает удалённые, остальные не трогает. Заодно догоняет слоты, пропущенные во время простоя.
+    """
+    slots = await get_slots()
+    for slot_id, tenant_id, hhmm, days, _ in slots:
+        if _slot_jobs.get(slot_id) != (tenant_id, hhmm, days):
+            _schedule_slot(slot_id, tenant_id, hhmm, days)
+    for slot_id in set(_slot_jobs) - {row[0] for row in slots}:
+        _unschedule_slot(slot_id)
+    await catch_up_slots(slots)
+
+async def catch_up_slots(slots: List[Tuple[int, int, str, str, str]]):
+    now = _sched_now()
+    for slot_id, tenant_id, hhmm, days, last_slot_at in slots:
+        slot = _prev_slot(hhmm, days, now)
+        if slot is None or _slot_key(slot) <= last_slot_at:
+            continue
+        if slot_id in _publishing or scheduler.get_job(f"slot_catch_up:{slot_id}"):
+            continue  # уже публикуется или стоит в очереди
+        key = _slot_key(slot)
+        if now - slot <= timedelta(minutes=SCHEDULE_MISFIRE_GRACE_MIN):
+            # из нескольких пропущенных публикуем последний: scheduled_job сдвинет last_slot_at на него
+            logging.info("Catching up missed slot %s (tenant %s)", key, tenant_id)
+            metrics.inc("schedule_misfire", "caught_up")
+            scheduler.add_job(func=scheduled_job, args=[slot_id, tenant_id], id=f"slot_catch_up:{slot_id}",
+                              replace_existing=True)
+            continue
+        async with db_tx() as db:
+            if not await _mark_slot_done(db, slot_id, key):
+                continue  # уже отметил другой процесс
+        metrics.inc("schedule_misfire", "skipped")
+        logging.warning("Missed slot %s (tenant %s) is past the grace window, skipping", key, tenant_id)
+        await _notify_admins(f"Автопост на {slot:%d.%m %H:%M} пропущен: бот был недоступен.", tenant_id)
+
+async def _mark_slot_done(db: aiosqlite.Connection, slot_id: int, key: str) -> bool:
+    """Сдвигает last_slot_at вперёд до key (в транзакции вызывающего); False — уже отмечен или удалён."""
+    cur = await db.execute("UPDATE schedule_slots SET last_slot_at=? WHERE id=? AND last_slot_at<?", (key, slot_id, key))
+    return cur.rowcount > 0
+
+async def slot_kind(slot: datetime, tenant_id: int = 1) -> str:
+    """Тип поста слота по плану недели: i-й слот дня — i-й тип плана на этот день."""
+    kinds = (await get_kind_plan(tenant_id))[slot.weekday()]
+    day_slots = [hhmm for _, _, hhmm, days, _ in await get_slots(tenant_id) if str(slot.weekday()) in days]
+    hhmm = slot.strftime("%H:%M")
+    return kinds[(day_slots.index(hhmm) if hhmm in day_slots else 0) % len(kinds)]
+
+async def _generate_scheduled(kind: str, tenant_id: int = 1) -> Tuple[str, Optional[str]]:
+    prof = await get_profile(tenant_id)
+    extra = "коротко, для утреннего чтения"
+    text = await generate_post(prof, kind, extra, use_cache=False)
+    # неприемлемый текст не публикуем (publish_to_channel его и не пропустит) — перегенерируем
+    for _ in range(DUP_REGEN_ATTEMPTS):
+        if not moderator.check(text):
+            break
+        metrics.inc("moderation", "regenerated")
+        text = await generate_post(prof, kind, extra, use_cache=False)
+    if moderator.check(text):
+        raise ModerationError("модель раз за разом пишет неприемлемый текст")
+    # автопост никто не проверяет — слишком похожий на историю перегенерируем, берём наименее похожий
+    best, match = text, await find_similar(text, tenant_id)
+    for _ in range(DUP_REGEN_ATTEMPTS):
+        if not match:
+            break
+        metrics.inc("similar", "regenerated")
+        text = await generate_post(prof, kind, extra + "; другая тема и подача, не повторяй недавние посты",
+                                   use_cache=False)
+        if moderator.check(text):
+            continue
+        again = await find_similar(text, tenant_id)
+        if not again or again[1] < match[1]:
+            best, match = text, again
+    if match:
+        logging.warning("Scheduled post for tenant %s is still similar to %s (%.0f%%)", tenant_id, match[0], match[1] * 100)
+    text = best
+    image_ref = None
+    if SCHEDULE_WITH_IMAGE:
+        aspect = parse_aspect(profile_rendered(prof)["aspect"])
+        data, err = await generate_image_bytes(build_image_prompt(prof, None), generation_size(aspect))
+        if data:
+            image_ref, _ = await store_processed_image(data, aspect)
+        else:
+            logging.warning("Scheduled post image skipped: %s", err)
+    return text, image_ref
+
+_preparing: set[Tuple[int, str]] = set()  # (студия, слот), которые уже готовятся в этом процессе
+
+@timed("job")
+async def prepare_scheduled_post(slot_id: int, tenant_id: int = 1):
+    row = await db_fetchone("SELECT hhmm, days FROM schedule_slots WHERE id=?", (slot_id,))
+    if not row:
+        return  # слот удалили
+    now = _sched_now()
+    slot = _next_slot(row[0], row[1], now)
+    # подготовка стоит на каждый день, а слот — только на свои дни
+    if slot is None or slot - now > timedelta(minutes=SCHEDULE_LEAD_MINUTES + 1):
+        return
+    key = _slot_key(slot)
+    if (tenant_id, key) in _preparing:
+        return
+    _preparing.add((tenant_id, key))
+    try:
+        await _prepare_slot(slot, key, tenant_id)
+    finally:
+        _preparing.discard((tenant_id, key))
 
-async def scheduled_job():
-    prof = await get_profile()
-    # ротируем типы постов по кругу
-    kinds_cycle = ["offer","tip","schedule","motivation","review","news"]
-    kind = kinds_cycle[datetime.now().weekday() % len(kinds_cycle)]
-    text = await generate_post(prof, kind, "коротко, для утреннего чтения")
-    await publish_to_channel(text, None)
+async def _prepare_slot(slot: datetime, key: str, tenant_id: int = 1):
+    kind = await slot_kind(slot, tenant_id)
+    async with db_tx() as db:
+        await db.execute(
+            "INSERT OR IGNORE INTO scheduled_posts (tenant_id, slot_at, kind, created_at) VALUES (?, ?, ?, ?)",
+            (tenant_id, key, kind, datetime.now().isoformat()),
+        )
+    row = await db_fetchone(
+        "SELECT status, attempts FROM scheduled_posts WHERE tenant_id=? AND slot_at=?", (tenant_id, key)
+    )
+    if row[0] in ("ready", "published"):
+        return
+    attempts = row[1]
+    # ретраим с экспоненциальной паузой, пока до публикации остаётся время
+    deadline = slot - timedelta(seconds=30)
+    while True:
+        attempts += 1
+        try:
+            text, image_ref = await _generate_scheduled(kind, tenant_id)
+        except Exception as e:
+            delay = min(10 * 2 ** (attempts - 1), 300)
+            left = (deadline - _sched_now()).total_seconds()
+            logging.warning("Scheduled post %s (tenant %s): attempt %s failed: %r", key, tenant_id, attempts, e)
+            async with db_tx() as db:
+                await db.execute(
+                    "UPDATE scheduled_posts SET attempts=?, error=?, status=? WHERE tenant_id=? AND slot_at=?",
+                    (attempts, repr(e), "pending" if left > delay else "failed", tenant_id, key),
+                )
+            if left <= delay:
+                return
+            await asyncio.sleep(delay)
+            continue
+        async with db_tx() as db:
+            await db.execute(
+                "UPDATE scheduled_posts SET text=?, image_ref=?, status='ready', attempts=?, error=NULL "
+                "WHERE tenant_id=? AND slot_at=?",
+                (text, image_ref, attempts, tenant_id, key),
+            )
+        logging.info("Scheduled post %s (%s) for tenant %s is ready", key, kind, tenant_id)
+        return
+
+_publishing: set[int] = set()  # id слотов, которые сейчас публикуются в этом процессе
+
+@timed("job")
+async def scheduled_job(slot_id: int, tenant_id: int = 1):
+    """
+    Публикует последний наступивший слот, если он ещё не отработан. Будильник и догонялка после простоя
+    могут сработать оба: второй увидит сдвинутый last_slot_at, а outbox по ключу slot:… не даст дубля,
+    даже если слот публикуют два процесса при смене лидера.
+    """
+    if slot_id in _publishing:
+        return
+    _publishing.add(slot_id)
+    try:
+        row = await db_fetchone("SELECT hhmm, days, last_slot_at FROM schedule_slots WHERE id=?", (slot_id,))
+        if not row:
+            return  # слот удалили
+        slot = _prev_slot(row[0], row[1])
+        if slot is None or _slot_key(slot) <= row[2]:
+            return
+        await _publish_slot(slot_id, slot, _slot_key(slot), tenant_id)
+    finally:
+        _publishing.discard(slot_id)
+
+async def _publish_slot(slot_id: int, slot: datetime, key: str, tenant_id: int = 1):
+    row = await db_fetchone(
+        "SELECT kind, text, image_ref, status FROM scheduled_posts WHERE tenant_id=? AND slot_at=?", (tenant_id, key)
+    )
+    try:
+        if row and row[3] == "published":
+            pass
+        elif row and row[3] == "ready":
+            await publish_to_channel(row[1], row[2], source=f"slot:{tenant_id}:{key}", tenant_id=tenant_id)
+        else:
+            # заранее не подготовили (рестарт, OpenAI лежал) — последний шанс сгенерировать сейчас
+            kind = row[0] if row else await slot_kind(slot, tenant_id)
+            text, image_ref = await _generate_scheduled(kind, tenant_id)
+            await publish_to_channel(text, image_ref, source=f"slot:{tenant_id}:{key}", tenant_id=tenant_id)
+            row = (kind, text, image_ref, "ready")
+    except Exception as e:
+        logging.exception("Scheduled post %s (tenant %s) failed", key, tenant_id)
+        # не повторяем: слот отмечен, админы знают
+        async with db_tx() as db:
+            await _mark_slot_done(db, slot_id, key)
+        await _notify_admins(f"Автопост на {slot:%H:%M} не опубликован: {e}", tenant_id)
+        return
+    async with db_tx() as db:
+        await db.execute(
+            "INSERT INTO scheduled_posts (tenant_id, slot_at, kind, text, image_ref, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, 'published', ?) ON CONFLICT(tenant_id, slot_at) DO UPDATE SET "
+            "text=excluded.text, image_ref=excluded.image_ref, status='published'",
+            (tenant_id, key, row[0], row[1], row[2], datetime.now().isoformat()),
+        )
+        await _mark_slot_done(db, slot_id, key)
+
+# ---------- RETENTION ----------
+# Черновики старше DRAFT_MAX_AGE_DAYS или сверх DRAFT_MAX_PER_KIND последних (по типу и студии) уезжают
+# в drafts_archive пачками по RETENTION_BATCH — запись не держит базу подолгу. Черновики, которые сейчас
+# отправляются или для которых рисуется картинка, не трогаем. После уборки — incremental_vacuum и
+# удаление файлов картинок, на которые больше ничего не ссылается.
+RETENTION_BATCH = 500
+# файл моложе этого могли только что записать, а ссылку на него — ещё нет
+IMAGE_GC_GRACE_SEC = 3600
+
+def _kind_limit(limits: Dict[str, float], kind: Optional[str]) -> float:
+    return limits.get(kind or "", limits.get("*", 0))
+
+_PINNED_DRAFTS_SQL = (
+    "SELECT draft_id FROM outbox WHERE draft_id IS NOT NULL AND status IN ('queued', 'sending') "
+    "UNION SELECT draft_id FROM image_jobs WHERE status='running'"
+)
+
+@timed("db")
+async def _expired_draft_ids() -> List[int]:
+    """id черновиков, которые пора в архив, по политикам DRAFT_MAX_AGE_DAYS и DRAFT_MAX_PER_KIND."""
+    db = await get_db()
+    async with db.execute("SELECT DISTINCT tenant_id, kind FROM drafts") as cur:
+        groups = await cur.fetchall()
+    ids = set()
+    for tenant_id, kind in groups:
+        days, keep = _kind_limit(DRAFT_MAX_AGE_DAYS, kind), int(_kind_limit(DRAFT_MAX_PER_KIND, kind))
+        if days > 0:
+            since = (datetime.now() - timedelta(days=days)).isoformat()
+            async with db.execute(
+                "SELECT id FROM drafts WHERE tenant_id=? AND kind IS ? AND created_at<?", (tenant_id, kind, since)
+            ) as cur:
+                ids.update(r[0] for r in await cur.fetchall())
+        if keep > 0:
+            async with db.execute(
+                "SELECT id FROM drafts WHERE tenant_id=? AND kind IS ? ORDER BY created_at DESC LIMIT -1 OFFSET ?",
+                (tenant_id, kind, keep),
+            ) as cur:
+                ids.update(r[0] for r in await cur.fetchall())
+    if ids:
+        async with db.execute(_PINNED_DRAFTS_SQL) as cur:
+            ids.difference_update(r[0] for r in await cur.fetchall())
+    return sorted(ids)
+
+@timed("db")
+async def archive_drafts(ids: List[int]) -> int:
+    """Переносит черновики в drafts_archive (одной транзакцией). Возвращает, сколько перенесли."""
+    marks = ",".join("?" * len(ids))
+    now = datetime.now().isoformat()
+    async with db_tx() as db:
+        # перечитываем внутри транзакции: черновик могли успеть поставить в отправку
+        cur = await db.execute(
+            f"SELECT id, tenant_id, kind, status, created_at, text, image_prompt FROM drafts "
+            f"WHERE id IN ({marks}) AND id NOT IN ({_PINNED_DRAFTS_SQL})",
+            tuple(ids),
+        )
+        rows = await cur.fetchall()
+        if not rows:
+            return 0
+        await db.executemany(
+            "INSERT OR REPLACE INTO drafts_archive (id, tenant_id, kind, status, created_at, archived_at, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(draft_id, tenant_id, kind, status, created_at, now,
+              zlib.compress(json.dumps({"text": text, "image_prompt": image_prompt}, ensure_ascii=False).encode(), 9))
+             for draft_id, tenant_id, kind, status, created_at, text, image_prompt in rows],
+        )
+        moved = [r[0] for r in rows]
+        marks = ",".join("?" * len(moved))
+        await db.execute(f"DELETE FROM drafts WHERE id IN ({marks})", moved)
+        await db.execute(
+            f"DELETE FROM image_variants WHERE job_id IN (SELECT id FROM image_jobs WHERE draft_id IN ({marks}))", moved
+        )
+        await db.execute(f"DELETE FROM image_jobs WHERE draft_id IN ({marks})", moved)
+    return len(moved)
+
+@timed("db")
+async def _prune_tables() -> Dict[str, int]:
+    """Служебные таблицы: отправленное, старые расписания, варианты картинок, подписи похожих постов."""
+    now = datetime.now()
+    outbox_before = (now - timedelta(days=OUTBOX_RETENTION_DAYS)).isoformat()
+    jobs_before = (now - timedelta(hours=IMAGE_JOB_TTL_HOURS)).isoformat()
+    dedup_before = (now - timedelta(days=DUP_HISTORY_DAYS)).isoformat()
+    counts = {}
+    async with db_tx() as db:
+        cur = await db.execute(
+            "DELETE FROM outbox WHERE status IN ('sent', 'failed') AND created_at<?", (outbox_before,)
+        )
+        counts["outbox"] = cur.rowcount
+        cur = await db.execute(
+            "DELETE FROM scheduled_posts WHERE slot_at<? AND status IN ('published', 'failed')", (outbox_before[:16],)
+        )
+        counts["scheduled_posts"] = cur.rowcount
+        await db.execute(
+            "DELETE FROM image_variants WHERE job_id IN "
+            "(SELECT id FROM image_jobs WHERE status<>'running' AND created_at<?)", (jobs_before,)
+        )
+        cur = await db.execute("DELETE FROM image_jobs WHERE status<>'running' AND created_at<?", (jobs_before,))
+        counts["image_jobs"] = cur.rowcount
+        await db.execute(
+            "DELETE FROM dedup_bands WHERE doc_id IN (SELECT id FROM dedup_docs WHERE created_at<?)", (dedup_before,)
+        )
+        cur = await db.execute("DELETE FROM dedup_docs WHERE created_at<?", (dedup_before,))
+        counts["dedup_docs"] = cur.rowcount
+    return counts
+
+@timed("db")
+async def _referenced_images() -> set:
+    db = await get_db()
+    async with db.execute(
+        "SELECT image_ref FROM drafts UNION SELECT thumb_ref FROM drafts "
+        "UNION SELECT image_ref FROM image_variants UNION SELECT thumb_ref FROM image_variants "
+        "UNION SELECT image_ref FROM outbox UNION SELECT image_ref FROM scheduled_posts"
+    ) as cur:
+        return {r[0] for r in await cur.fetchall() if r[0]}
+
+def _remove_unreferenced_images(referenced: set) -> Tuple[int, int]:
+    """Удаляет файлы IMAGES_DIR без ссылок (старше IMAGE_GC_GRACE_SEC) → (файлов, байт)."""
+    removed = freed = 0
+    deadline = datetime.now().timestamp() - IMAGE_GC_GRACE_SEC
+    for root, _, files in os.walk(IMAGES_DIR):
+        for name in files:
+            if name in referenced:
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+                if st.st_mtime > deadline:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue  # убрал соседний процесс
+            removed += 1
+            freed += st.st_size
+    return removed, freed
+
+async def run_retention() -> Dict[str, int]:
+    stats = {"archived": 0}
+    while True:
+        ids = await _expired_draft_ids()
+        if not ids:
+            break
+        archived = 0
+        for i in range(0, len(ids), RETENTION_BATCH):
+            archived += await archive_drafts(ids[i:i + RETENTION_BATCH])
+            await asyncio.sleep(0)  # даём пройти интерактивным запросам между пачками
+        stats["archived"] += archived
+        if archived < len(ids):
+            break  # остальные закреплены (отправляются) — до следующего прохода
+    stats.update(await _prune_tables())
+    db = await get_db()
+    async with _db_write_lock:
+        async with db.execute("PRAGMA freelist_count") as cur:
+            stats["free_pages"] = (await cur.fetchone())[0]
+        # возвращаем освободившиеся страницы файлу базы (нужен auto_vacuum=INCREMENTAL, см. init_db)
+        async with db.execute("PRAGMA incremental_vacuum") as cur:
+            await cur.fetchall()
+    stats["images_removed"], stats["images_freed"] = await asyncio.to_thread(
+        _remove_unreferenced_images, await _referenced_images()
+    )
+    for key, value in stats.items():
+        if value:
+            metrics.inc("retention", key, value)
+    logging.info("Retention: %s", stats)
+    return stats
+
+async def retention_loop():
+    while True:
+        try:
+            await run_retention()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Retention pass failed")
+        await asyncio.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+@timed("db")
+async def draft_history(tenant_id: int, kind: Optional[str] = None, since: Optional[str] = None,
+                        limit: int = 20) -> List[Tuple[int, str, str, str, str, bool]]:
+    """
+    Последние черновики студии из drafts и архива (по индексам tenant_id, kind, created_at):
+    (id, kind, status, created_at, text, из архива ли), новые сверху.
+    """
+    where, params = "tenant_id=?", [tenant_id]
+    if kind:
+        where, params = where + " AND kind=?", params + [kind]
+    if since:
+        where, params = where + " AND created_at>=?", params + [since]
+    db = await get_db()
+    async with db.execute(
+        f"SELECT id, kind, status, created_at, text FROM drafts WHERE {where} ORDER BY created_at DESC LIMIT ?",
+        (*params, limit),
+    ) as cur:
+        rows = [(*r, False) for r in await cur.fetchall()]
+    async with db.execute(
+        f"SELECT id, kind, status, created_at, data FROM drafts_archive WHERE {where} ORDER BY created_at DESC LIMIT ?",
+        (*params, limit),
+    ) as cur:
+        rows += [(i, k, st, c, json.loads(zlib.decompress(data))["text"], True) for i, k, st, c, data in await cur.fetchall()]
+    rows.sort(key=lambda r: r[3] or "", reverse=True)
+    return rows[:limit]
+
+# ---------- LEADER ----------
+# Процессов может быть несколько (WEB_WORKERS), а автопост и тёплый пул должен вести один.
+# Каждый процесс раз в LEADER_LEASE_SEC/3 продлевает аренду 'worker:<id>' и пробует взять
+# (или продлить) 'leader'; лидер держит задачи планировщика и пул, остальные только отвечают на апдейты.
+_is_leader = False
+
+@timed("db")
+async def renew_leases() -> bool:
+    """Продлевает аренду воркера и пытается стать/остаться лидером. True — этот процесс лидер."""
+    now = datetime.now().timestamp()
+    expires = now + LEADER_LEASE_SEC
+    async with db_tx() as db:
+        await db.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET expires_at=excluded.expires_at",
+            (f"worker:{INSTANCE_ID}", INSTANCE_ID, expires),
+        )
+        # захват удаётся, только если аренда наша или истекла
+        before = db.total_changes
+        await db.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES ('leader', ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at "
+            "WHERE leases.owner=excluded.owner OR leases.expires_at<?",
+            (INSTANCE_ID, expires, now),
+        )
+        leader = db.total_changes > before
+        # записи упавших процессов
+        await db.execute("DELETE FROM leases WHERE name LIKE 'worker:%' AND expires_at<?", (now,))
+    return leader
+
+async def release_leases():
+    async with db_tx() as db:
+        await db.execute("DELETE FROM leases WHERE owner=?", (INSTANCE_ID,))
+
+async def sync_schedule_now():
+    """После /schedule: лидер переставляет изменившиеся слоты сразу, в остальных процессах — подхватит из БД."""
+    if _is_leader:
+        await sync_schedules()
+
+async def leader_loop():
+    global _is_leader
+    pool_task: Optional[asyncio.Task] = None
+    retention_task: Optional[asyncio.Task] = None
+    try:
+        while True:
+            try:
+                leader = await renew_leases()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # не смогли продлить — аренда скоро истечёт, не рискуем двойным автопостом
+                logging.exception("Lease renewal failed")
+                leader = False
+            if leader and not _is_leader:
+                logging.info("%s is the leader now: scheduler and draft pool are on", INSTANCE_ID)
+                await sync_schedules()
+                if POOL_SIZE > 0:
+                    pool_task = asyncio.create_task(pool_refill_loop())
+                retention_task = asyncio.create_task(retention_loop())
+            elif not leader and _is_leader:
+                logging.warning("%s lost leadership", INSTANCE_ID)
+                unschedule_all()
+                for task in (pool_task, retention_task):
+                    if task:
+                        task.cancel()
+                pool_task = retention_task = None
+            _is_leader = leader
+            if leader:
+                try:
+                    await outbox_recover()
+                    # /schedule мог прийти в другой процесс
+                    await sync_schedules()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logging.exception("Leader housekeeping failed")
+            await asyncio.sleep(LEADER_LEASE_SEC / 3)
+    finally:
+        _is_leader = False
+        for task in (pool_task, retention_task):
+            if task:
+                task.cancel()
 
 # ---------- ENTRY ----------
-async def main():
-    await init_db()
-    await setup_bot_commands()
+# Холодный старт по фазам (в лог одной строкой и в метрики как startup <фаза>): импорты, база и
+# Bot API (идут параллельно), готовность принимать апдейты и первый апдейт — всё от начала процесса.
+class StartupReport:
+    def __init__(self):
+        self.phases: List[Tuple[str, float]] = []
+        self.ready_at: Optional[float] = None
+        self.first_update_seen = False
+
+    def add(self, phase: str, seconds: float):
+        self.phases.append((phase, seconds))
+        metrics.observe("startup", phase, seconds)
+
+    async def run(self, phase: str, aw: Awaitable[T]) -> T:
+        start = time_monotonic()
+        try:
+            return await aw
+        finally:
+            self.add(phase, time_monotonic() - start)
+
+    def ready(self):
+        self.ready_at = time_monotonic()
+        self.add("ready", self.ready_at - _PROCESS_STARTED)
+        logging.info("Cold start: %s", ", ".join(f"{p} {s * 1000:.0f} ms" for p, s in self.phases))
+
+    def first_update(self):
+        if self.first_update_seen:
+            return
+        self.first_update_seen = True
+        now = time_monotonic()
+        self.add("first_update", now - _PROCESS_STARTED)
+        logging.info(
+            "First update %.0f ms after process start (%.0f ms after ready)",
+            (now - _PROCESS_STARTED) * 1000, (now - (self.ready_at or now)) * 1000,
+        )
+
+startup = StartupReport()
+
+class StartupMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        startup.first_update()
+        return await handler(event, data)
+
+async def _startup_task(phase: str, aw: Awaitable):
+    """Вызов, без которого апдейты принимать можно: в фоне, сбой — только в лог."""
+    try:
+        await startup.run(phase, aw)
+    except Exception:
+        logging.exception("Startup: %s failed", phase)
+
+def start_startup_tasks(commands: bool = True) -> List[asyncio.Task]:
+    # SDK OpenAI импортируем в потоке, пока ждём апдейтов: первой генерации не придётся его ждать
+    tasks = [asyncio.create_task(_startup_task("openai_client", asyncio.to_thread(get_oai)))]
+    if commands:
+        tasks.append(asyncio.create_task(_startup_task("set_my_commands", setup_bot_commands())))
+    return tasks
+
+def setup_middlewares():
+    dp.update.outer_middleware(StartupMiddleware())
     dp.update.middleware(LogUserIdMiddleware())
     dp.message.middleware(LogUserIdMiddleware())
     dp.callback_query.middleware(LogUserIdMiddleware())
-    # поднимем планировщик с текущим временем из БД
-    hhmm = await get_daily_time()
-    reschedule_daily(hhmm)
+    dp.message.middleware(MetricsMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware())
+    bot.session.middleware(MetricsRequestMiddleware())
+
+def start_background() -> List[asyncio.Task]:
     scheduler.start()
-    await dp.start_polling(bot)
+    tasks = [asyncio.create_task(outbox_worker()) for _ in range(max(1, OUTBOX_WORKERS))]
+    tasks.append(asyncio.create_task(leader_loop()))
+    return tasks
+
+async def stop_background(tasks: List[asyncio.Task], metrics_runner: Optional["web.AppRunner"]):
+    for t in tasks:
+        t.cancel()
+    # фоновые картинки тоже: задача пометит себя отменённой, пока база ещё открыта
+    jobs = list(_image_tasks.values())
+    for t in jobs:
+        t.cancel()
+    await asyncio.gather(*tasks, *jobs, return_exceptions=True)
+    scheduler.shutdown(wait=False)
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    try:
+        # отдаём лидерство сразу, а не через LEADER_LEASE_SEC
+        await release_leases()
+    finally:
+        await close_db()
+
+async def main():
+    startup.add("import", time_monotonic() - _PROCESS_STARTED)
+    setup_middlewares()
+    # база, снятие вебхука (после webhook-режима polling не заработает, пока он не снят)
+    # и порт метрик друг от друга не зависят
+    _, _, metrics_runner = await asyncio.gather(
+        startup.run("init_db", init_db()),
+        startup.run("delete_webhook", bot.delete_webhook()),
+        startup.run("metrics_server", start_metrics_server()),
+    )
+    tasks = start_background() + start_startup_tasks()
+    dp.startup.register(startup.ready)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await stop_background(tasks, metrics_runner)
+
+async def setup_webhook():
+    """Один раз перед запуском воркеров: схема БД, команды и регистрация вебхука."""
+    try:
+        await asyncio.gather(
+            startup.run("init_db", init_db()),
+            startup.run("set_my_commands", setup_bot_commands()),
+            startup.run("set_webhook", bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )),
+        )
+    finally:
+        await close_db()
+        await bot.session.close()
+
+async def serve_webhook(worker: int = 0):
+    startup.add("import", time_monotonic() - _PROCESS_STARTED)
+    setup_middlewares()
+    # у каждого процесса свои метрики — и свой порт для них
+    metrics_runner = await start_metrics_server(METRICS_PORT + worker if METRICS_PORT else 0)
+    # команды уже выставил setup_webhook в родительском процессе
+    tasks = start_background() + start_startup_tasks(commands=False)
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEB_HOST, WEB_PORT, reuse_port=WORKER_PROCESSES > 1).start()
+    logging.info("Worker %s (%s) is serving %s on %s:%s", worker, INSTANCE_ID, WEBHOOK_PATH, WEB_HOST, WEB_PORT)
+    startup.ready()
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await stop_background(tasks, metrics_runner)
+        await bot.session.close()
+
+def _webhook_worker(worker: int):
+    asyncio.run(serve_webhook(worker))
+
+def run_webhook():
+    asyncio.run(setup_webhook())
+    if WORKER_PROCESSES == 1:
+        return _webhook_worker(0)
+    # spawn, а не fork: каждому воркеру — чистый интерпретатор со своим event loop и коннектом к SQLite
+    import multiprocessing
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=_webhook_worker, args=(i,), name=f"worker-{i}") for i in range(WORKER_PROCESSES)]
+    for p in procs:
+        p.start()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for p in procs:
+            p.join()
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()  # SIGTERM: воркер дорабатывает и отдаёт аренды
+        for p in procs:
+            p.join(timeout=15)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        asyncio.run(main())
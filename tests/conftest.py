@@ -0,0 +1,42 @@
+"""
+Общие фикстуры: main импортируется с фиктивными ключами, база и картинки — во временном каталоге теста.
+Тесты синхронные: run(fn) гоняет корутину fn() в своём event loop между init_db и close_db.
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.update(
+    BOT_TOKEN="123456:TEST",
+    OPENAI_API_KEY="sk-test",
+    CHANNEL_ID="@test_channel",
+    ADMIN_IDS="1",
+    METRICS_PORT="0",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as bot  # noqa: E402
+
+ADMIN_ID = 1
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # fitness_bot.db создаётся в текущем каталоге
+    monkeypatch.setattr(bot, "IMAGES_DIR", str(tmp_path / "images"))
+    return bot
+
+
+@pytest.fixture
+def run(main):
+    def _run(fn):
+        async def wrapper():
+            await main.init_db()
+            try:
+                return await fn()
+            finally:
+                await main.close_db()
+        return asyncio.run(wrapper())
+    return _run
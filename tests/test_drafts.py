@@ -0,0 +1,28 @@
+TEXT = (
+    "💪 Спина скажет спасибо! Новая группа «Здоровая спина»: мягкая мобилизация, укрепление мышц кора "
+    "и растяжка без перегрузки. Подходит новичкам и тем, кто много сидит за компьютером. "
+    "Пробная тренировка — бесплатно по записи. #пилатес #здороваяспина"
+)
+
+
+class FakeMessage:
+    def __init__(self):
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+def test_cache_hit_is_not_reported_as_similar_to_its_source(main, run):
+    """Черновик из кэша генераций не помечается похожим на черновик, с которым его сгенерировали."""
+    m = FakeMessage()
+
+    async def scenario():
+        key = main.gen_cache_key(await main.get_profile(1), "tip", "про спину")
+        await main.gen_cache_put(key, TEXT)
+        await main.add_draft("tip", TEXT, image_prompt=None)  # источник кэша — уже в индексе похожих
+        assert await main.find_similar(TEXT, 1)
+        assert await main.reply_draft(m, "tip", "про спину", pooled=False) == TEXT
+
+    run(scenario)
+    assert "Похоже на" not in m.answers[-1]
@@ -0,0 +1,29 @@
+import pytest
+
+POST = (
+    "💪 Спина скажет спасибо! В STAVFITNESS26 стартует новая группа «Здоровая спина»: "
+    "мягкая мобилизация, укрепление мышц кора и растяжка без перегрузки.\n\n"
+    "📍 ул. Пирогова 15/2, 3 этаж. Пробная тренировка — бесплатно по записи, пиши в Телеграм!\n\n"
+    "#пилатес #здороваяспина #ставрополь #тренировка"
+)
+
+CASES = {
+    # обычные слова, которые старый NSFW_REGEX блокировал, и безобидные слова на запрещённый корень
+    "себя": None, "тебе": None, "хлеб": None, "канал": None, "анализ": None, "застрахуйте": None,
+    "нюдовые легинсы": None, "ебонит": None, "эбонитовая палочка": None, "sextant": None, "секстант": None,
+    POST: None,
+    # обфускация: латиница, цифры, разделители, побуквенно (в том числе после предлога), повторы
+    "xyй": "хуй", "х.у.й": "хуй", "Х У Й": "хуй", "х*уй": "хуй", "ХУУУЙ": "хуй", "х\u200bуй": "хуй",
+    "eбaть": "еб", "е б а т ь": "еб", "заебал": "заеб", "p0rn": "porn", "сeкс": "секс",
+    "в с е к с": "секс", "s e x": "sex", "анал": "анал", "распиздяй": "пизд",
+}
+
+
+@pytest.mark.parametrize("text, term", CASES.items())
+def test_check(main, text, term):
+    assert main.moderator.check(text) == term
+
+
+def test_batch_matches_single_checks(main):
+    texts = list(CASES)
+    assert main.moderate_many(texts) == [main.moderator.check(t) for t in texts]
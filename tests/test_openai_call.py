@@ -0,0 +1,93 @@
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+
+
+def test_cancelled_probe_releases_breaker(main, monkeypatch):
+    """Отменённый пробный вызов не оставляет предохранитель разомкнутым навсегда."""
+    breaker = main.CircuitBreaker("text", failures=1, cooldown=0.05)
+    monkeypatch.setitem(main._breakers, "text", breaker)
+
+    async def fail(timeout: float):
+        raise TimeoutError
+
+    async def hang(timeout: float):
+        await asyncio.sleep(10)
+
+    async def ok(timeout: float):
+        return "ok"
+
+    async def scenario():
+        with contextlib.suppress(main.GenerationError):
+            await main.openai_call("text", fail, 1, 1)
+        assert breaker.opened_at is not None
+        await asyncio.sleep(0.06)
+        probe = asyncio.create_task(main.openai_call("text", hang, 5, 5))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await probe
+        assert await main.openai_call("text", ok, 1, 1) == "ok"
+        assert breaker.opened_at is None
+
+    asyncio.run(scenario())
+
+
+def test_programming_error_propagates_and_leaves_breaker_alone(main, monkeypatch):
+    """Ошибка в нашем коде — не «OpenAI отклонил запрос»: пробрасывается как есть и не закрывает предохранитель."""
+    breaker = main.CircuitBreaker("text", failures=1, cooldown=0.05)
+    monkeypatch.setitem(main._breakers, "text", breaker)
+
+    async def fail(timeout: float):
+        raise TimeoutError
+
+    async def bug(timeout: float):
+        raise KeyError("oops")
+
+    async def ok(timeout: float):
+        return "ok"
+
+    async def scenario():
+        with contextlib.suppress(main.GenerationError):
+            await main.openai_call("text", fail, 1, 1)
+        await asyncio.sleep(0.06)
+        with pytest.raises(KeyError):
+            await main.openai_call("text", bug, 1, 1)  # пробный вызов
+        assert breaker.opened_at is not None  # ошибка в коде не считается здоровым ответом OpenAI
+        assert await main.openai_call("text", ok, 1, 1) == "ok"  # и не держит пробу занятой
+
+    asyncio.run(scenario())
+
+
+def test_client_error_becomes_generation_error(main, monkeypatch):
+    """Отказ OpenAI (4xx) — GenerationError для админа; сервис ответил, так что предохранитель не размыкается."""
+    import openai
+
+    monkeypatch.setitem(main._breakers, "text", main.CircuitBreaker("text", failures=1, cooldown=60))
+    request = SimpleNamespace(method="POST", url="https://api.openai.com/v1/chat/completions")
+    response = SimpleNamespace(status_code=400, headers={}, request=request)
+
+    async def rejected(timeout: float):
+        raise openai.BadRequestError("bad request", response=response, body=None)
+
+    with pytest.raises(main.GenerationError, match="отклонил"):
+        asyncio.run(main.openai_call("text", rejected, 1, 1))
+    assert main._breakers["text"].opened_at is None
+
+
+def test_hedged_skips_cancelled_loser(main):
+    """Первый запрос отменился сам — hedged ждёт второй, а не падает с CancelledError."""
+    calls = 0
+
+    async def start():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(0.05)
+            raise asyncio.CancelledError
+        await asyncio.sleep(0.1)
+        return "second"
+
+    assert asyncio.run(main.hedged(start, 0.01, "test")) == "second"
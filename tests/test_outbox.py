@@ -0,0 +1,26 @@
+import asyncio
+
+
+def test_row_is_requeued_when_delivery_fails_outside_send(main, run, monkeypatch):
+    """Сбой вне самой отправки не оставляет запись в 'sending' до рестарта: она снова в очереди, попытка учтена."""
+    def broken_bucket(chat_id):
+        raise RuntimeError("bucket broke")
+
+    monkeypatch.setattr(main, "_chat_bucket", broken_bucket)
+
+    async def scenario():
+        assert await main.publish_to_channel("Пробная тренировка — бесплатно по записи.", None, source="test:1") == 1
+        worker = asyncio.create_task(main.outbox_worker())
+        try:
+            for _ in range(100):
+                row = await main.db_fetchone("SELECT status, attempts, error FROM outbox")
+                if row[1] and row[0] != "sending":  # воркер взял запись и отпустил её
+                    break
+                await asyncio.sleep(0.02)
+        finally:
+            worker.cancel()
+        return row
+
+    status, attempts, error = run(scenario)
+    assert (status, attempts) == ("queued", 1)
+    assert "bucket broke" in error
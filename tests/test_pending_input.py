@@ -0,0 +1,59 @@
+from conftest import ADMIN_ID
+
+
+def test_expired_pending_input_is_ignored_and_deleted(main, run):
+    """Просроченное «✏️ Править» не публикует следующее сообщение админа и удаляется из базы."""
+    old = (main.datetime.now() - main.timedelta(minutes=main.PENDING_INPUT_TTL_MIN + 1)).isoformat()
+
+    async def backdate():
+        async with main.db_tx() as db:
+            await db.execute("UPDATE pending_input SET created_at=? WHERE user_id=?", (old, ADMIN_ID))
+
+    async def scenario():
+        await main.set_pending_input(ADMIN_ID, "edit:1")
+        assert await main.get_pending_input(ADMIN_ID) == "edit:1"
+        await backdate()
+        assert await main.get_pending_input(ADMIN_ID) is None
+        assert await main.db_fetchone("SELECT 1 FROM pending_input WHERE user_id=?", (ADMIN_ID,)) is None
+        await main.set_pending_input(ADMIN_ID, "edit:1")
+        await backdate()
+        assert await main.pop_pending_input(ADMIN_ID) is None
+
+    run(scenario)
+
+
+def _one_shot_handler(main):
+    return next(h for h in main.dp.message.handlers if h.callback.__name__ == "one_shot_publish")
+
+
+def _message(main, **fields):
+    from aiogram.types import Chat, User
+    return main.Message(message_id=1, date=main.datetime.now(), chat=Chat(id=ADMIN_ID, type="private"),
+                        from_user=User(id=ADMIN_ID, is_bot=False, first_name="admin"), **fields)
+
+
+def test_pending_edit_takes_only_text_messages(main, run):
+    """Фото с подписью при ожидании «✏️ Править» не публикуется вместо текста."""
+    from aiogram.types import PhotoSize
+
+    photo = _message(main, photo=[PhotoSize(file_id="f", file_unique_id="u", width=1, height=1)], caption="подпись")
+    text = _message(main, text="Новый текст поста")
+
+    async def scenario():
+        await main.set_pending_input(ADMIN_ID, "edit:1")
+        handler = _one_shot_handler(main)
+        return (await handler.check(photo))[0], (await handler.check(text))[0]
+
+    assert run(scenario) == (False, True)
+
+
+def test_super_admin_always_has_a_tenant(main, run):
+    """Суперадмин из ADMIN_IDS находится в студии, даже если строки tenant_admins нет: его ожидание не теряется."""
+    async def scenario():
+        assert await main.tenant_of(ADMIN_ID) == 1
+        async with main.db_tx() as db:
+            await db.execute("DELETE FROM tenant_admins WHERE user_id=?", (ADMIN_ID,))
+        main._admin_tenant_cache.pop(ADMIN_ID, None)
+        return await main.tenant_of(ADMIN_ID)
+
+    assert run(scenario) == 1
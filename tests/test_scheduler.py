@@ -0,0 +1,32 @@
+import time
+from datetime import timedelta
+
+import pytest
+
+
+@pytest.fixture
+def utc_host(monkeypatch):
+    """Хост в UTC, планировщик — в своём поясе (Europe/Moscow)."""
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_slot_jobs_fire_in_scheduler_timezone(main, utc_host):
+    """Подготовка срабатывает за SCHEDULE_LEAD_MINUTES до слота, а публикация — в минуту слота, по времени планировщика."""
+    slot_id = 999
+    try:
+        main._schedule_slot(slot_id, 1, "12:00", main.ALL_DAYS)
+        now = main.datetime.now(main.scheduler.timezone)
+        slot = main._next_slot("12:00", main.ALL_DAYS, now.replace(tzinfo=None))
+        post = main.scheduler.get_job(f"slot_post:{slot_id}").trigger.get_next_fire_time(None, now)
+        prep = main.scheduler.get_job(f"slot_prepare:{slot_id}").trigger.get_next_fire_time(None, now)
+        tz = main.scheduler.timezone
+        assert post.astimezone(tz).replace(tzinfo=None) == slot
+        lead = timedelta(minutes=main.SCHEDULE_LEAD_MINUTES)
+        # подготовка ближайшая — за lead до этого слота или (если окно уже идёт) до завтрашнего
+        assert prep.astimezone(tz).replace(tzinfo=None) in (slot - lead, slot - lead + timedelta(days=1))
+    finally:
+        main._unschedule_slot(slot_id)